@@ -2,13 +2,55 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import datetime
+import hashlib
 import io
 import bcrypt
 import json
+import re
 import os
+import threading
+import time
 from pathlib import Path
 from sqlalchemy import create_engine, text
 from usuarios_config import USUARIOS_CREDENCIALES, CREDENCIALES_INICIALES
+from calculos_inventario import (
+    C_ART,
+    C_LOC,
+    C_DESC,
+    C_STOCK,
+    C_COSTO,
+    parse_ar_number,
+    format_ar_series,
+    normalize_article_code,
+    normalize_article_codes,
+    normalize_cell_value,
+    calcular_cambios_conteo,
+    validar_paquete_conteo,
+    aplicar_actualizaciones_detalle,
+    construir_actualizaciones_validacion,
+    sugerir_clasificaciones,
+    emparejar_candidatos_canje,
+    SCAN_COLUMNAS,
+    parsear_lecturas_escaner,
+    agregar_lecturas,
+    aplicar_lecturas_a_muestra,
+    calcular_resultados_inventario,
+    calcular_resultados_por_inventario,
+    checksum_detalle,
+    materializar_cierre,
+    resultados_desde_cierre,
+    filas_con_snapshot,
+    resumir_historial,
+    KPI_COLUMNAS,
+    KPI_ADITIVOS,
+    KPI_NIVEL_INVENTARIO,
+    kpi_inventario,
+    actualizar_kpis,
+    reconstruir_kpis,
+    TENDENCIA_FRECUENCIAS,
+    tendencias_kpis,
+)
+from reportes import export_dataframe_to_excel, build_report_xlsx, exportar_reportes_zip, exportar_analitico, ANALITICO_FORMATOS
 
 # Version: 4.0 - SQLite persistent backend
 
@@ -32,15 +74,21 @@ elif DATABASE_URL.startswith("postgresql://"):
 
 SHEET_HIST = "Historial_Inventarios"
 SHEET_DET = "Detalle_Articulos"
-SHEET_AUDIT = "Audit_Log"
+SHEET_AUDIT = "Audit_Log"  # Legacy sheet, migrated once into the audit_log table
 SHEET_BASE = "Base_Excel_Articulos"
-
-# Columnas esperadas del Excel
-C_ART = "Artículo"
-C_LOC = "Locación"
-C_DESC = "Descripción"
-C_STOCK = "Stock"
-C_COSTO = "Cto.Rep."
+SHEET_KPI = "Dashboard_KPIs"
+
+# Audit_Log column -> audit_log table column
+AUDIT_COLUMNAS = {
+    "Timestamp": "marca_tiempo",
+    "Usuario": "usuario",
+    "Rol": "rol",
+    "Accion": "accion",
+    "ID_Inventario": "id_inventario",
+    "Filas": "filas",
+    "Status": "status",
+    "Mensaje": "mensaje",
+}
 
 COLUMN_ALIASES = {
     "Art?culo": C_ART,
@@ -749,6 +797,16 @@ def get_db_engine():
     connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
     return create_engine(DATABASE_URL, future=True, connect_args=connect_args)
 
+@st.cache_resource
+def get_detalle_write_lock() -> threading.Lock:
+    """Process-wide lock serializing read-modify-write cycles on Detalle_Articulos."""
+    return threading.Lock()
+
+@st.cache_resource
+def get_kpi_write_lock() -> threading.Lock:
+    """Process-wide lock serializing incremental updates of Dashboard_KPIs."""
+    return threading.Lock()
+
 def is_sqlite_backend(engine=None) -> bool:
     if engine is None:
         engine = get_db_engine()
@@ -773,10 +831,45 @@ def init_database():
                     updated_at TEXT NOT NULL
                 )
             """))
+            clave_audit = "INTEGER PRIMARY KEY AUTOINCREMENT" if is_sqlite_backend(engine) else "BIGSERIAL PRIMARY KEY"
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS audit_log (
+                    id {clave_audit},
+                    marca_tiempo TEXT NOT NULL,
+                    usuario TEXT,
+                    rol TEXT,
+                    accion TEXT,
+                    id_inventario TEXT,
+                    filas INTEGER,
+                    status TEXT,
+                    mensaje TEXT
+                )
+            """))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_audit_log_inventario ON audit_log (id_inventario, marca_tiempo)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_audit_log_marca_tiempo ON audit_log (marca_tiempo)"))
+            migrar_audit_log(conn)
     except Exception as e:
         st.error(f"Error inicializando base de datos: {e}")
         st.stop()
 
+def migrar_audit_log(conn):
+    """Copy the legacy Audit_Log sheet into audit_log once (only while the table is still empty)."""
+    if conn.execute(text("SELECT 1 FROM audit_log LIMIT 1")).fetchone():
+        return
+    row = conn.execute(text("SELECT data_json FROM worksheet_store WHERE name = :name"), {"name": SHEET_AUDIT}).fetchone()
+    data = json.loads(row[0]) if row and row[0] else []
+    if not data:
+        return
+    df = pd.DataFrame(data).reindex(columns=list(AUDIT_COLUMNAS))
+    filas = pd.to_numeric(df["Filas"], errors="coerce").fillna(0).astype(int)
+    df = df.astype(object).where(df.notna(), "").astype(str)
+    df["Filas"] = filas.astype(object)
+    registros = df.rename(columns=AUDIT_COLUMNAS).to_dict("records")
+    conn.execute(
+        text(f"INSERT INTO audit_log ({', '.join(AUDIT_COLUMNAS.values())}) VALUES ({', '.join(':' + c for c in AUDIT_COLUMNAS.values())})"),
+        registros,
+    )
+
 init_database()
 
 @st.cache_data(ttl=5)
@@ -869,20 +962,39 @@ def append_gspread_worksheet(ws_name: str, df_new: pd.DataFrame):
         return False
 
 
-def log_audit(action: str, id_inv: str, filas: int, status: str, mensaje: str = ""):
-    """Append an audit row to the Audit_Log sheet. Non-blocking: failures are logged to UI but do not raise."""
+def log_audit(action: str, id_inv: str, filas: int, status: str, mensaje: str = "", usuario: str | None = None, rol: str | None = None):
+    """Append an audit row to the audit_log table. Non-blocking: failures are logged to UI but do not raise.
+
+    `usuario`/`rol` default to the logged-in session; background workers must pass them explicitly.
+    """
+    log_audit_lote(action, [(id_inv, filas, status, mensaje)], usuario=usuario, rol=rol)
+
+def log_audit_lote(action: str, filas_audit: list[tuple], usuario: str | None = None, rol: str | None = None):
+    """log_audit for one action over many inventories: (id_inv, filas, status, mensaje) rows, one insert."""
     try:
-        row = pd.DataFrame([{
-            "Timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "Usuario": st.session_state.get("usuario", ""),
-            "Rol": st.session_state.get("rol", ""),
-            "Accion": action,
-            "ID_Inventario": id_inv,
-            "Filas": int(filas) if filas is not None else 0,
-            "Status": status,
-            "Mensaje": mensaje
-        }])
-        append_gspread_worksheet(SHEET_AUDIT, row)
+        comunes = {
+            "marca_tiempo": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "usuario": usuario if usuario is not None else st.session_state.get("usuario", ""),
+            "rol": rol if rol is not None else st.session_state.get("rol", ""),
+            "accion": action,
+        }
+        registros = [
+            {
+                **comunes,
+                "id_inventario": str(id_inv) if id_inv is not None else "",
+                "filas": int(filas) if filas is not None else 0,
+                "status": status,
+                "mensaje": mensaje,
+            }
+            for id_inv, filas, status, mensaje in filas_audit
+        ]
+        if not registros:
+            return
+        with get_db_engine().begin() as conn:
+            conn.execute(
+                text(f"INSERT INTO audit_log ({', '.join(registros[0])}) VALUES ({', '.join(':' + c for c in registros[0])})"),
+                registros,
+            )
     except Exception as e:
         # Non-fatal: show a warning in the UI for admin visibility
         try:
@@ -890,98 +1002,29 @@ def log_audit(action: str, id_inv: str, filas: int, status: str, mensaje: str =
         except Exception:
             pass
 
+def leer_audit_log(id_inv: str | None = None, limite: int | None = None) -> pd.DataFrame:
+    """Audit rows newest first (optionally one inventory / the last `limite`), with Audit_Log column names."""
+    columnas = ", ".join(f'{col} AS "{nombre}"' for nombre, col in AUDIT_COLUMNAS.items())
+    consulta = f"SELECT {columnas} FROM audit_log"
+    params = {}
+    if id_inv is not None:
+        consulta += " WHERE id_inventario = :id_inv"
+        params["id_inv"] = str(id_inv)
+    consulta += " ORDER BY marca_tiempo DESC, id DESC"
+    if limite is not None:
+        consulta += " LIMIT :limite"
+        params["limite"] = int(limite)
+    try:
+        with get_db_engine().connect() as conn:
+            resultado = conn.execute(text(consulta), params)
+            return pd.DataFrame(resultado.fetchall(), columns=list(resultado.keys()))
+    except Exception as e:
+        st.error(f"Error reading audit_log: {e}")
+        return pd.DataFrame(columns=list(AUDIT_COLUMNAS))
+
 # ----------------------------
 # EXPORT FUNCTIONS
 # ----------------------------
-def export_dataframe_to_excel(df: pd.DataFrame, sheet_name: str = "Datos", title: str = None) -> io.BytesIO:
-    """Export DataFrame to Excel with Argentine number formatting (. for thousands, , for decimals)"""
-    from openpyxl import Workbook
-    from openpyxl.utils.dataframe import dataframe_to_rows
-    from openpyxl.styles import Font, Alignment
-    from openpyxl.utils import get_column_letter
-    
-    buffer = io.BytesIO()
-    wb = Workbook()
-    ws = wb.active
-    ws.title = sheet_name[:31]  # Excel sheet name limit is 31 chars
-    
-    # Add title if provided
-    if title:
-        ws.merge_cells("A1:Z1")
-        ws["A1"] = title
-        ws["A1"].font = Font(size=12, bold=True)
-        ws["A1"].alignment = Alignment(horizontal="center", vertical="center")
-        start_row = 3
-    else:
-        start_row = 1
-    
-    # Track numeric columns for formatting
-    numeric_cols = {}
-    for col_idx, col_name in enumerate(df.columns, start=1):
-        # Try to detect numeric columns
-        try:
-            numeric_test = pd.to_numeric(df[col_name], errors="coerce")
-            if numeric_test.notna().sum() > 0:  # At least one numeric value
-                numeric_cols[col_idx] = col_name
-        except:
-            pass
-    
-    # Write DataFrame
-    for r_idx, row in enumerate(dataframe_to_rows(df, index=False, header=True), start=start_row):
-        for c_idx, value in enumerate(row, start=1):
-            cell = ws.cell(row=r_idx, column=c_idx, value=value)
-            if r_idx == start_row:
-                cell.font = Font(bold=True)
-            
-            # Apply numeric formatting if this column is numeric
-            if c_idx in numeric_cols:
-                try:
-                    num_val = float(value) if value not in (None, "", "NaN", "nan") else None
-                    if num_val is not None and str(num_val) not in ("nan", "inf", "-inf"):
-                        cell.value = num_val
-                        # Argentine format: #,##0.00 with . as thousands separator and , as decimal
-                        cell.number_format = '#,##0.00'
-                except:
-                    pass
-            
-            cell.alignment = Alignment(horizontal="left", vertical="center")
-    
-    # Auto-adjust column widths
-    for col_idx, column in enumerate(ws.iter_cols(min_row=1, max_row=ws.max_row, max_col=ws.max_column), start=1):
-        max_length = 0
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except Exception:
-                pass
-        adjusted_width = min(max_length + 2, 50)
-        ws.column_dimensions[get_column_letter(col_idx)].width = adjusted_width
-    
-    wb.save(buffer)
-    buffer.seek(0)
-    return buffer
-
-def parse_ar_number(series: pd.Series) -> pd.Series:
-    """Parse numbers that may use Argentine formatting (1.234,56)."""
-    s = series.astype(str).str.strip()
-    s = s.str.replace("$", "", regex=False).str.replace("ARS", "", regex=False).str.strip()
-    has_comma = s.str.contains(",", regex=False)
-    s = s.where(~has_comma, s.str.replace(".", "", regex=False).str.replace(",", ".", regex=False))
-    return pd.to_numeric(s, errors="coerce")
-
-def normalize_article_code(value) -> str:
-    if pd.isna(value):
-        return ""
-    code = str(value).strip()
-    if not code:
-        return ""
-    if code.endswith(".0"):
-        base = code[:-2]
-        if base.isdigit():
-            return base
-    return code
-
 def format_number_ar(value, decimals: int = 2) -> str:
     number = pd.to_numeric(pd.Series([value]), errors="coerce").iloc[0]
     if pd.isna(number):
@@ -993,37 +1036,64 @@ def format_currency_ar(value) -> str:
     formatted = format_number_ar(value, decimals=2)
     return f"$ {formatted}" if formatted else ""
 
-def buscar_articulo_en_base(id_inv: str, codigo_articulo: str) -> dict | None:
-    codigo = normalize_article_code(codigo_articulo)
-    if not codigo:
-        return None
-
+@st.cache_data(ttl=5, show_spinner=False)
+def indice_base_articulos(id_inv: str) -> pd.DataFrame:
+    """Base snapshot of one inventory aggregated by normalized article code, sorted for lookups."""
+    columnas = ["descripcion", "costo", "stock", "locacion"]
     df_base = read_gspread_worksheet(SHEET_BASE)
     if df_base.empty or "ID_Inventario" not in df_base.columns or C_ART not in df_base.columns:
-        return None
-
-    df_inv = df_base[df_base["ID_Inventario"].astype(str) == str(id_inv)].copy()
-    if df_inv.empty:
-        return None
-
-    codigos = df_inv[C_ART].apply(normalize_article_code)
-    matches = df_inv[codigos == codigo].copy()
-    if matches.empty:
-        return None
-
-    descripcion = matches[C_DESC].dropna().astype(str).iloc[0] if C_DESC in matches.columns and matches[C_DESC].notna().any() else ""
-    costo_series = parse_ar_number(matches[C_COSTO]) if C_COSTO in matches.columns else pd.Series(dtype=float)
-    costo = costo_series.dropna().iloc[0] if not costo_series.dropna().empty else 0.0
-    stock_total = parse_ar_number(matches[C_STOCK]).fillna(0).sum() if C_STOCK in matches.columns else 0.0
-    locaciones = ", ".join(matches[C_LOC].dropna().astype(str).unique().tolist()) if C_LOC in matches.columns else ""
-
-    return {
-        "codigo": codigo,
-        "descripcion": descripcion,
-        "costo": float(costo) if pd.notna(costo) else 0.0,
-        "stock": float(stock_total),
+        return pd.DataFrame(columns=columnas, index=pd.Index([], name="codigo"))
+
+    df_inv = df_base[df_base["ID_Inventario"].astype(str) == str(id_inv)]
+    vacio = pd.Series(np.nan, index=df_inv.index, dtype=object)
+    df_idx = pd.DataFrame({
+        # New snapshots store Artículo normalized; older ones may not, and it is idempotent
+        "codigo": normalize_article_codes(df_inv[C_ART]),
+        "descripcion": df_inv[C_DESC].astype(object) if C_DESC in df_inv.columns else vacio,
+        "costo": parse_ar_number(df_inv[C_COSTO]) if C_COSTO in df_inv.columns else np.nan,
+        "stock": parse_ar_number(df_inv[C_STOCK]).fillna(0) if C_STOCK in df_inv.columns else 0.0,
+        "locacion": df_inv[C_LOC].astype(object) if C_LOC in df_inv.columns else vacio,
+    })
+    df_idx = df_idx[df_idx["codigo"] != ""]
+    if df_idx.empty:
+        return pd.DataFrame(columns=columnas, index=pd.Index([], name="codigo"))
+
+    grupos = df_idx.groupby("codigo", sort=True)
+    locaciones = (
+        df_idx.dropna(subset=["locacion"])
+        .assign(locacion=lambda d: d["locacion"].astype(str))
+        .drop_duplicates(["codigo", "locacion"])
+        .groupby("codigo", sort=True)["locacion"]
+        .agg(", ".join)
+    )
+    return pd.DataFrame({
+        "descripcion": grupos["descripcion"].first().map(lambda v: "" if pd.isna(v) else str(v)),
+        "costo": grupos["costo"].first().fillna(0.0).astype(float),
+        "stock": grupos["stock"].sum().astype(float),
         "locacion": locaciones,
-    }
+    }).fillna({"locacion": ""})[columnas]
+
+def buscar_articulos_en_base(id_inv: str, codigos_articulo) -> dict:
+    """Look up several article codes with one index load; returns {codigo_ingresado: info | None}."""
+    indice = indice_base_articulos(id_inv)
+    resultado = {}
+    for codigo_articulo in codigos_articulo:
+        codigo = normalize_article_code(codigo_articulo)
+        if not codigo or codigo not in indice.index:
+            resultado[codigo_articulo] = None
+            continue
+        fila = indice.loc[codigo]
+        resultado[codigo_articulo] = {
+            "codigo": codigo,
+            "descripcion": fila["descripcion"],
+            "costo": float(fila["costo"]),
+            "stock": float(fila["stock"]),
+            "locacion": fila["locacion"],
+        }
+    return resultado
+
+def buscar_articulo_en_base(id_inv: str, codigo_articulo: str) -> dict | None:
+    return buscar_articulos_en_base(id_inv, [codigo_articulo])[codigo_articulo]
 
 def is_currency_column(col_name: str) -> bool:
     name = str(col_name).strip().lower()
@@ -1039,15 +1109,33 @@ def is_currency_column(col_name: str) -> bool:
     )
     return any(hint in name for hint in currency_hints)
 
+def version_columnas(df: pd.DataFrame) -> str:
+    """Content hash of a frame (values, index, names and dtypes) used as a memoization key."""
+    huella = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    huella.update(repr([(str(col), str(dtype)) for col, dtype in df.dtypes.items()]).encode("utf-8"))
+    return huella.hexdigest()
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def formatear_columnas_moneda(version: str, _df_moneda: pd.DataFrame) -> pd.DataFrame:
+    """Currency columns as "$ 1.234,56" text, memoized per content version across reruns."""
+    return pd.DataFrame(
+        {col: format_ar_series(parse_ar_number(_df_moneda[col]), decimals=2, prefix="$ ") for col in _df_moneda.columns},
+        index=_df_moneda.index,
+    )
+
 def prepare_currency_display(df: pd.DataFrame) -> tuple[pd.DataFrame, dict]:
     if df is None or df.empty:
         return df, {}
 
     df_view = df.copy()
+    currency_cols = [col for col in df_view.columns if is_currency_column(col)]
+    if not currency_cols:
+        return df_view, {}
 
-    for col in df_view.columns:
-        if is_currency_column(col):
-            df_view[col] = parse_ar_number(df_view[col]).apply(format_currency_ar)
+    df_moneda = df_view[currency_cols]
+    formateadas = formatear_columnas_moneda(version_columnas(df_moneda), df_moneda)
+    for col in currency_cols:
+        df_view[col] = formateadas[col]
 
     return df_view, {}
 
@@ -1065,6 +1153,63 @@ def render_data_editor(df: pd.DataFrame, column_config: dict | None = None, **kw
         return st.data_editor(df_view, column_config=merged_config, **kwargs)
     return st.data_editor(df_view, **kwargs)
 
+PAGE_SIZES = [25, 50, 100, 250]
+
+def filtrar_detalle(df: pd.DataFrame, categorias: list | None = None, locacion: str = "", solo_diferencias: bool = False) -> pd.DataFrame:
+    """Filter detail rows by Cat, Locación substring and non-zero Diferencia (index preserved)."""
+    if df is None or df.empty:
+        return df
+    mask = pd.Series(True, index=df.index)
+    if categorias and "Cat" in df.columns:
+        mask &= df["Cat"].astype(str).isin([str(c) for c in categorias])
+    if locacion and C_LOC in df.columns:
+        mask &= df[C_LOC].astype(str).str.contains(locacion.strip(), case=False, regex=False, na=False)
+    if solo_diferencias and "Diferencia" in df.columns:
+        mask &= pd.to_numeric(df["Diferencia"], errors="coerce").fillna(0) != 0
+    return df.loc[mask]
+
+def render_filtros_paginacion(df: pd.DataFrame, key: str, filtro_diferencia: bool = True, page_size: int = 50) -> pd.DataFrame:
+    """Render Cat/Locación/diferencia filters and a page selector; return only the visible page.
+
+    Only the returned slice should be formatted and rendered. The index of `df` is kept so callers
+    can map page rows back to their stable row IDs.
+    """
+    if df is None or df.empty:
+        return df
+
+    f1, f2, f3, f4 = st.columns([2, 2, 1, 1])
+    categorias = []
+    if "Cat" in df.columns:
+        opciones_cat = sorted(c for c in df["Cat"].dropna().astype(str).unique() if c)
+        categorias = f1.multiselect("Cat", opciones_cat, key=f"{key}_cat")
+    locacion = f2.text_input("Locación", key=f"{key}_loc", placeholder="Contiene...") if C_LOC in df.columns else ""
+    solo_dif = f3.checkbox("Solo con diferencia", key=f"{key}_dif") if filtro_diferencia and "Diferencia" in df.columns else False
+    size = f4.selectbox("Filas por página", PAGE_SIZES, index=PAGE_SIZES.index(page_size) if page_size in PAGE_SIZES else 1, key=f"{key}_size")
+
+    df_filtrado = filtrar_detalle(df, categorias, locacion, solo_dif)
+    total = len(df_filtrado)
+    paginas = max(1, int(np.ceil(total / size)))
+
+    page_key = f"{key}_page"
+    if st.session_state.get(page_key, 1) > paginas:
+        st.session_state[page_key] = paginas
+    pagina = int(st.number_input("Página", min_value=1, max_value=paginas, step=1, key=page_key)) if paginas > 1 else 1
+
+    inicio = (pagina - 1) * size
+    fin = min(inicio + size, total)
+    st.caption(f"Mostrando {inicio + 1 if total else 0}–{fin} de {total} filas" + (f" (filtradas de {len(df)})" if total != len(df) else ""))
+    return df_filtrado.iloc[inicio:fin]
+
+def clave_vista_paginada(key: str, df_pagina: pd.DataFrame) -> str:
+    """Key suffix for a data editor over a page from render_filtros_paginacion.
+
+    It changes with the filters, page size, page number and the rows shown, so Streamlit never
+    replays the edits of one view onto the rows of another.
+    """
+    filtros = [st.session_state.get(f"{key}_{campo}") for campo in ("cat", "loc", "dif", "size", "page")]
+    firma = json.dumps(filtros, default=str) + "|" + ",".join(map(str, df_pagina.index))
+    return hashlib.sha1(firma.encode("utf-8")).hexdigest()[:8]
+
 # ----------------------------
 def verify_password(password: str, password_hash: str) -> bool:
     """Verify password against bcrypt hash"""
@@ -1301,10 +1446,10 @@ def _admin_debug_show():
 
         # Mostrar últimos registros de Audit_Log si existe
         try:
-            dfa = read_gspread_worksheet(SHEET_AUDIT)
+            dfa = leer_audit_log(limite=10)
             if not dfa.empty:
                 st.write("**Audit_Log (últimas 10 filas)**")
-                render_dataframe(dfa.tail(10).sort_values("Timestamp", ascending=False), use_container_width=True)
+                render_dataframe(dfa, use_container_width=True)
             else:
                 st.write("**Audit_Log**: (vacío)")
         except Exception as e:
@@ -1334,6 +1479,13 @@ def listar_inventarios_cerrados():
     estados = df_hist["Estado"].astype(str).str.strip().str.lower()
     return df_hist[estados == "cerrado"].copy()
 
+def inventario_esta_cerrado(id_inv: str) -> bool:
+    df_hist = read_gspread_worksheet(SHEET_HIST)
+    if df_hist.empty or "ID_Inventario" not in df_hist.columns or "Estado" not in df_hist.columns:
+        return False
+    estados = df_hist.loc[df_hist["ID_Inventario"].astype(str) == str(id_inv), "Estado"]
+    return bool((estados.astype(str).str.strip().str.lower() == "cerrado").any())
+
 def ensure_unique_columns(df: pd.DataFrame) -> pd.DataFrame:
     if df is None or df.empty:
         return df.copy() if isinstance(df, pd.DataFrame) else pd.DataFrame()
@@ -1380,275 +1532,125 @@ def cargar_detalle(id_inv: str) -> pd.DataFrame:
     df = ensure_unique_columns(df)
     return df[df["ID_Inventario"].astype(str) == str(id_inv)].copy()
 
-def calcular_resultados_inventario(df_det: pd.DataFrame) -> dict:
-    """Calculate inventory results based on Auditor adjustments.
-    - Muestra Q & $ Ajuste: sum of ALL articles in sample (no filter)
-    - Faltantes/Sobrantes/etc: only rows where Tipo_Ajuste = "Ajuste"
-    - %: always over total muestra valuation
-    """
-    if df_det.empty:
-        return {"canjes": []}
-    
-    df_all = df_det.copy()
-    stock_col = C_STOCK if C_STOCK in df_all.columns else None
-    costo_col = C_COSTO if C_COSTO in df_all.columns else None
-    
-    if not stock_col or not costo_col:
-        return {"canjes": []}
-    
-    df_all["_stock"] = parse_ar_number(df_all[stock_col]).fillna(0)
-    df_all["_costo"] = parse_ar_number(df_all[costo_col]).fillna(0)
-    
-    # MUESTRA: sum of ALL articles (no filter)
-    cant_muestra = int(df_all["_stock"].sum())
-    valor_muestra = (df_all["_stock"] * df_all["_costo"]).sum()
-    pct_muestra = 100.0
-    
-    # Build movement set for quantitative calculations using all adjustments (principal + adicionales).
-    movimientos = []
-
-    if "Tipo_Ajuste" in df_all.columns:
-        df_principal = df_all[df_all["Tipo_Ajuste"].astype(str) == "Ajuste"].copy()
-        if not df_principal.empty:
-            ajuste_source = df_principal["Ajuste_Cantidad"] if "Ajuste_Cantidad" in df_principal.columns else pd.Series(0, index=df_principal.index)
-            df_principal["_ajuste"] = pd.to_numeric(ajuste_source, errors="coerce").fillna(0)
-            movimientos.append(df_principal[["_ajuste", "_costo"]])
-
-    if "Tipo_Ajuste_Adicional" in df_all.columns:
-        df_adicional = df_all[df_all["Tipo_Ajuste_Adicional"].astype(str) == "Ajuste"].copy()
-        if not df_adicional.empty:
-            ajuste_add_source = df_adicional["Ajuste_Cantidad_Adicional"] if "Ajuste_Cantidad_Adicional" in df_adicional.columns else pd.Series(0, index=df_adicional.index)
-            df_adicional["_ajuste"] = pd.to_numeric(ajuste_add_source, errors="coerce").fillna(0)
-            movimientos.append(df_adicional[["_ajuste", "_costo"]])
-
-    df_r = pd.concat(movimientos, ignore_index=True) if movimientos else pd.DataFrame(columns=["_ajuste", "_costo"])
-    
-    # If no adjustments, return results with 0 differences
-    if df_r.empty:
-        return {
-            "cant_muestra": cant_muestra,
-            "valor_muestra": valor_muestra,
-            "pct_muestra": pct_muestra,
-            "cant_faltantes": 0,
-            "valor_faltantes": 0,
-            "pct_faltantes": 0,
-            "cant_sobrantes": 0,
-            "valor_sobrantes": 0,
-            "pct_sobrantes": 0,
-            "cant_dif_neta": 0,
-            "valor_dif_neta": 0,
-            "pct_dif_neta": 0,
-            "cant_dif_absoluta": 0,
-            "valor_dif_absoluta": 0,
-            "pct_dif_absoluta": 0,
-            "pct_absoluto": 0,
-            "grado": 100,
-            "escala": [(0.00, 100), (0.10, 94), (0.80, 82), (1.60, 65), (2.40, 35), (3.30, 0)],
-            "canjes": []
-        }
-
-    # Faltantes (negative adjustments)
-    mask_falt = df_r["_ajuste"] < 0
-    cant_faltantes = int((df_r.loc[mask_falt, "_ajuste"].abs()).sum())
-    valor_faltantes = (df_r.loc[mask_falt, "_ajuste"].abs() * df_r.loc[mask_falt, "_costo"]).sum()
-    pct_faltantes = (valor_faltantes / valor_muestra * 100) if valor_muestra > 0 else 0
-    
-    # Sobrantes (positive adjustments)
-    mask_sobr = df_r["_ajuste"] > 0
-    cant_sobrantes = int(df_r.loc[mask_sobr, "_ajuste"].sum())
-    valor_sobrantes = (df_r.loc[mask_sobr, "_ajuste"] * df_r.loc[mask_sobr, "_costo"]).sum()
-    pct_sobrantes = (valor_sobrantes / valor_muestra * 100) if valor_muestra > 0 else 0
-    
-    # Diferencia neta y absoluta
-    cant_dif_neta = int(df_r["_ajuste"].sum())
-    valor_dif_neta = (df_r["_ajuste"] * df_r["_costo"]).sum()
-    pct_dif_neta = (valor_dif_neta / valor_muestra * 100) if valor_muestra > 0 else 0
-    
-    cant_dif_absoluta = int(df_r["_ajuste"].abs().sum())
-    valor_dif_absoluta = (df_r["_ajuste"].abs() * df_r["_costo"]).sum()
-    pct_dif_absoluta = (valor_dif_absoluta / valor_muestra * 100) if valor_muestra > 0 else 0
-    
-    # Escala de grado basada en % absoluto
-    pct_absoluto = pct_dif_absoluta
-    escala = [(0.00, 100), (0.10, 94), (0.80, 82), (1.60, 65), (2.40, 35), (3.30, 0)]
-    escala_sorted = sorted(escala, key=lambda x: x[0])
-    grado = 0
-    for th, g in escala_sorted:
-        if pct_absoluto >= th:
-            grado = g
-    
-    # Collect canjes (separate from adjustments)
-    canjes_list = []
-
-    def append_canje_movements(row, suffix: str = "", origen: str = "Principal"):
-        tipo_col = f"Tipo_Ajuste{suffix}" if suffix else "Tipo_Ajuste"
-        if str(row.get(tipo_col, "")) != "Canje":
-            return
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
 
-        ajuste_col = f"Ajuste_Cantidad{suffix}" if suffix else "Ajuste_Cantidad"
-        canje_ajuste_col = f"Canje_Ajuste_Cantidad{suffix}" if suffix else "Canje_Ajuste_Cantidad"
-        canje_art_col = f"Canje_Articulo{suffix}" if suffix else "Canje_Articulo"
-        canje_desc_col = f"Canje_Descripcion{suffix}" if suffix else "Canje_Descripcion"
-        canje_loc_col = f"Canje_Locacion{suffix}" if suffix else "Canje_Locacion"
-        canje_stock_col = f"Canje_Stock_Base{suffix}" if suffix else "Canje_Stock_Base"
-        canje_costo_col = f"Canje_Costo_Rep{suffix}" if suffix else "Canje_Costo_Rep"
-
-        costo_original = pd.to_numeric(row.get(C_COSTO, 0), errors="coerce")
-        ajuste_original = pd.to_numeric(row.get(ajuste_col, 0), errors="coerce")
-        canjes_list.append({
-            "Origen": origen,
-            "Tipo Movimiento": "Artículo original",
-            "Artículo": row.get(C_ART, ""),
-            "Descripción": row.get(C_DESC, ""),
-            "Locación": row.get(C_LOC, ""),
-            "Stock Base": parse_ar_number(pd.Series([row.get(C_STOCK, 0)])).fillna(0).iloc[0],
-            "Cantidad": ajuste_original,
-            "Costo Unitario": costo_original,
-            "Valor Total": ajuste_original * costo_original
-        })
+@st.cache_data(max_entries=32, show_spinner=False)
+def generar_descarga(tipo: str, id_inv: str, version: str, _construir) -> bytes:
+    """Bytes of a downloadable file, cached by (tipo, inventory, detail version); `_construir` is not hashed."""
+    return _construir().getvalue()
 
-        costo_canje = pd.to_numeric(row.get(canje_costo_col, row.get(C_COSTO, 0)), errors="coerce")
-        ajuste_canje = pd.to_numeric(row.get(canje_ajuste_col, row.get(ajuste_col, 0)), errors="coerce")
-        canjes_list.append({
-            "Origen": origen,
-            "Tipo Movimiento": "Artículo de canje",
-            "Artículo": row.get(canje_art_col, "") or row.get(C_ART, ""),
-            "Descripción": row.get(canje_desc_col, ""),
-            "Locación": row.get(canje_loc_col, row.get(C_LOC, "")),
-            "Stock Base": pd.to_numeric(row.get(canje_stock_col, 0), errors="coerce"),
-            "Cantidad": ajuste_canje,
-            "Costo Unitario": costo_canje,
-            "Valor Total": ajuste_canje * costo_canje
-        })
+def render_descarga_diferida(label: str, tipo: str, id_inv: str, version: str, construir, file_name: str, key: str):
+    """Download button whose file is built only after the user asks for it.
 
-    if not df_det.empty:
-        for _, row in df_det.iterrows():
-            append_canje_movements(row, suffix="", origen="Principal")
-            append_canje_movements(row, suffix="_Adicional", origen="Adicional")
-    
-    return {
-        "cant_muestra": cant_muestra,
-        "valor_muestra": valor_muestra,
-        "pct_muestra": pct_muestra,
-        "cant_faltantes": cant_faltantes,
-        "valor_faltantes": valor_faltantes,
-        "pct_faltantes": pct_faltantes,
-        "cant_sobrantes": cant_sobrantes,
-        "valor_sobrantes": valor_sobrantes,
-        "pct_sobrantes": pct_sobrantes,
-        "cant_dif_neta": cant_dif_neta,
-        "valor_dif_neta": valor_dif_neta,
-        "pct_dif_neta": pct_dif_neta,
-        "cant_dif_absoluta": cant_dif_absoluta,
-        "valor_dif_absoluta": valor_dif_absoluta,
-        "pct_dif_absoluta": pct_dif_absoluta,
-        "pct_absoluto": pct_absoluto,
-        "grado": grado,
-        "escala": escala_sorted,
-        "canjes": canjes_list
-    }
+    The workbook is generated once per inventory and detail version (see generar_descarga), so reruns
+    and page navigation do not rebuild it. Editing the detail changes `version` and asks again.
+    """
+    preparado = f"{key}_preparado_{version}"
+    if not st.session_state.get(preparado):
+        if not st.button(f"⚙️ Preparar {label[0].lower()}{label[1:]}", key=f"{key}_preparar"):
+            return
+        st.session_state[preparado] = True
 
-def build_report_xlsx(df_det: pd.DataFrame, resultados: dict) -> io.BytesIO:
-    from openpyxl import Workbook
-    from openpyxl.utils.dataframe import dataframe_to_rows
-    from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+    with st.spinner("Generando archivo..."):
+        data = generar_descarga(tipo, str(id_inv), version, construir)
+    st.download_button(f"⬇️ Descargar {label}", data=data, file_name=file_name, mime=XLSX_MIME, key=key)
 
-    buffer = io.BytesIO()
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Resultado"
-
-    title_font = Font(size=14, bold=True)
-    light_red = PatternFill(start_color="FFF2F2", end_color="FFF2F2", fill_type="solid")
-    bold = Font(bold=True)
-    center = Alignment(horizontal="center", vertical="center")
-    thin = Side(border_style="thin", color="000000")
-    border = Border(left=thin, right=thin, top=thin, bottom=thin)
-
-    ws.merge_cells("A1:D1")
-    ws["A1"] = "4. Resultado Inventario Rotativo"
-    ws["A1"].font = title_font
-    ws["A1"].alignment = center
-
-    ws["A3"] = "Resultado:"
-
-    start_row = 5
-    ws[f"A{start_row}"] = "Detalle"
-    ws[f"B{start_row}"] = "Cant"
-    ws[f"C{start_row}"] = "$"
-    ws[f"D{start_row}"] = "%"
-    for col in ["A", "B", "C", "D"]:
-        cell = ws[f"{col}{start_row}"]
-        cell.font = bold
-        cell.alignment = center
-        cell.border = border
-
-    rows = [
-        ("Muestra", resultados["cant_muestra"], resultados["valor_muestra"], resultados["pct_muestra"] / 100),
-        ("Faltantes", resultados["cant_faltantes"], resultados["valor_faltantes"], resultados["pct_faltantes"] / 100),
-        ("Sobrantes", resultados["cant_sobrantes"], resultados["valor_sobrantes"], resultados["pct_sobrantes"] / 100),
-        ("Dif Neta", resultados["cant_dif_neta"], resultados["valor_dif_neta"], resultados["pct_dif_neta"] / 100),
-        ("Dif Absoluta", resultados["cant_dif_absoluta"], resultados["valor_dif_absoluta"], resultados["pct_dif_absoluta"] / 100),
-    ]
+def generar_zip_reportes(ids_inv: list[str], df_cerrados: pd.DataFrame, resumen: pd.DataFrame, progreso=None) -> tuple[bytes, list[str]]:
+    """ZIP with the report of each closed inventory in `ids_inv` plus a summary sheet.
 
-    for i, r in enumerate(rows, start=start_row + 1):
-        ws[f"A{i}"] = r[0]
-        ws[f"B{i}"] = r[1]
-        ws[f"C{i}"] = r[2]
-        ws[f"D{i}"] = r[3]
-        ws[f"B{i}"].alignment = center
-        ws[f"C{i}"].number_format = '#,##0.00'
-        ws[f"D{i}"].number_format = "0.00%"
-        for col in ["A", "B", "C", "D"]:
-            ws[f"{col}{i}"].border = border
-
-    for r in [start_row + 3, start_row + 4]:
-        for col in ["B", "C", "D"]:
-            ws[f"{col}{r}"].fill = light_red
-
-    ws.merge_cells(f"F{start_row + 1}:G{start_row + 1}")
-    ws[f"F{start_row + 1}"] = f"{resultados['grado']}%"
-    ws[f"F{start_row + 1}"].font = Font(size=12, bold=True)
-    ws[f"F{start_row + 1}"].alignment = center
-
-    escala_start = start_row + 7
-    ws[f"B{escala_start}"] = "Dif. Abs. desde"
-    ws[f"C{escala_start}"] = "Grado de cumplim."
-    ws[f"B{escala_start}"].font = bold
-    ws[f"C{escala_start}"].font = bold
-    for j, (th, g) in enumerate(resultados.get("escala", []), start=escala_start + 1):
-        ws[f"B{j}"] = f"{th:.2f}%"
-        ws[f"C{j}"] = f"{g}%"
-        ws[f"B{j}"].alignment = center
-        ws[f"C{j}"].alignment = center
-
-    ws2 = wb.create_sheet(title="Detalle")
-    numeric_cols = {}
-    for col_idx, col_name in enumerate(df_det.columns, start=1):
-        try:
-            numeric_test = pd.to_numeric(df_det[col_name], errors="coerce")
-            if numeric_test.notna().sum() > 0:
-                numeric_cols[col_idx] = col_name
-        except Exception:
-            pass
+    The detail sheet is read once; each inventory's slice is handed to the report pool lazily.
+    """
+    df_all = ensure_unique_columns(read_gspread_worksheet(SHEET_DET))
+    grupos = df_all.groupby(df_all["ID_Inventario"].astype(str)).groups if "ID_Inventario" in df_all.columns else {}
+    filas_cierre = (
+        df_cerrados.assign(ID_Inventario=df_cerrados["ID_Inventario"].astype(str))
+        .drop_duplicates("ID_Inventario", keep="last")
+        .set_index("ID_Inventario", drop=False)
+    )
 
-    for r_idx, row in enumerate(dataframe_to_rows(df_det, index=False, header=True), start=1):
-        for c_idx, value in enumerate(row, start=1):
-            cell = ws2.cell(row=r_idx, column=c_idx, value=value)
-            if r_idx == 1:
-                cell.font = Font(bold=True)
-            if c_idx in numeric_cols:
-                try:
-                    num_val = float(value) if value not in (None, "", "NaN", "nan") else None
-                    if num_val is not None and str(num_val) not in ("nan", "inf", "-inf"):
-                        cell.value = num_val
-                        cell.number_format = '#,##0.00'
-                except Exception:
-                    pass
+    def trabajos():
+        for id_inv in ids_inv:
+            df_det = df_all.loc[grupos[id_inv]] if id_inv in grupos else pd.DataFrame()
+            fila = filas_cierre.loc[id_inv].to_dict() if id_inv in filas_cierre.index else None
+            yield id_inv, df_det, fila
+
+    destino = io.BytesIO()
+    max_workers = max(1, min(4, os.cpu_count() or 1, len(ids_inv)))
+    omitidos = exportar_reportes_zip(trabajos(), destino, total=len(ids_inv), resumen=resumen, max_workers=max_workers, progreso=progreso)
+    return destino.getvalue(), omitidos
+
+def render_exportacion_masiva(df_filtrado: pd.DataFrame, df_cerrados: pd.DataFrame):
+    """Historial expander: every closed inventory of the current filters (and a close-date range) as a ZIP
+    of XLSX reports or as typed Parquet/CSV tables."""
+    with st.expander("📦 Exportación masiva"):
+        fechas = pd.to_datetime(df_filtrado["Cierre_Fecha"], errors="coerce")
+        desde, hasta = (fechas.min(), fechas.max()) if fechas.notna().any() else (pd.Timestamp.today(), pd.Timestamp.today())
+        rango = st.date_input("Fecha de cierre", value=(desde.date(), hasta.date()), key="hist_batch_rango")
+        seleccion = df_filtrado
+        if isinstance(rango, (tuple, list)) and len(rango) == 2:
+            # Inventories without a close date cannot be placed in the range: keep them with the filters
+            dentro = fechas.dt.normalize().between(pd.Timestamp(rango[0]), pd.Timestamp(rango[1]))
+            seleccion = df_filtrado[(dentro | fechas.isna()).to_numpy()]
+        ids_inv = seleccion["ID_Inventario"].astype(str).tolist()
+        sin_fecha = int(pd.to_datetime(seleccion["Cierre_Fecha"], errors="coerce").isna().sum())
+        st.caption(
+            f"{len(ids_inv)} inventario(s) cerrados con los filtros actuales"
+            + (f" ({sin_fecha} sin fecha de cierre)." if sin_fecha else ".")
+        )
+        # Generated files belong to one selection; a changed filter or range hides them
+        version_seleccion = hashlib.sha1("|".join(ids_inv).encode("utf-8")).hexdigest()
+        st.write("**Reportes XLSX** (uno por inventario y un resumen)")
+
+        if st.button("⚙️ Generar ZIP de reportes", key="hist_batch_generar", disabled=not ids_inv):
+            barra = st.progress(0.0, text="Generando reportes...")
+            def progreso(hechos, total):
+                barra.progress(hechos / total, text=f"Generando reportes... {hechos}/{total}")
+            contenido, omitidos = generar_zip_reportes(ids_inv, df_cerrados, seleccion, progreso=progreso)
+            st.session_state["hist_batch_zip"] = (version_seleccion, contenido)
+            log_audit_lote("exportar_reportes", [
+                (id_inv, 0, "ERROR", "Sin detalle ni snapshot: no incluido en el ZIP de reportes") if id_inv in omitidos
+                else (id_inv, 1, "OK", f"ZIP de reportes ({len(ids_inv)} inventarios)")
+                for id_inv in ids_inv
+            ])
+            if omitidos:
+                st.warning(f"Sin detalle ni snapshot para reportar: {', '.join(omitidos)}")
+
+        zip_reportes = st.session_state.get("hist_batch_zip")
+        if zip_reportes and zip_reportes[0] == version_seleccion:
+            st.download_button(
+                "⬇️ Descargar ZIP",
+                data=zip_reportes[1],
+                file_name=f"Reportes_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+                mime="application/zip",
+                key="hist_batch_descargar",
+            )
 
-    wb.save(buffer)
-    buffer.seek(0)
-    return buffer
+        st.divider()
+        st.write("**Exportación analítica** (Historial con métricas de cierre, Detalle y canjes, con columnas tipadas)")
+        formato = st.radio("Formato", ANALITICO_FORMATOS, horizontal=True, format_func=str.upper, key="hist_analitico_formato")
+        if st.button("⚙️ Generar exportación analítica", key="hist_analitico_generar", disabled=not ids_inv):
+            destino = io.BytesIO()
+            with st.spinner("Exportando..."):
+                df_det_todo = read_gspread_worksheet(SHEET_DET)
+                filas = exportar_analitico(df_cerrados, df_det_todo, ids_inv, destino, formato=formato)
+            st.session_state["hist_analitico_zip"] = (version_seleccion, formato, destino.getvalue())
+            filas_det = df_det_todo["ID_Inventario"].astype(str).value_counts() if "ID_Inventario" in df_det_todo.columns else pd.Series(dtype=int)
+            resumen_tablas = ", ".join(f"{tabla}={n}" for tabla, n in filas.items())
+            log_audit_lote("exportar_analitico", [
+                (id_inv, int(filas_det.get(id_inv, 0)), "OK", f"{formato} ({len(ids_inv)} inventarios): {resumen_tablas}")
+                for id_inv in ids_inv
+            ])
+
+        analitico = st.session_state.get("hist_analitico_zip")
+        if analitico and analitico[0] == version_seleccion:
+            _, formato_zip, contenido = analitico
+            st.download_button(
+                f"⬇️ Descargar {formato_zip.upper()}",
+                data=contenido,
+                file_name=f"Inventarios_{formato_zip}_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+                mime="application/zip",
+                key="hist_analitico_descargar",
+            )
 
 def construir_resumen_historial(df_hist_cerrados: pd.DataFrame | None = None) -> pd.DataFrame:
     if df_hist_cerrados is None:
@@ -1656,88 +1658,362 @@ def construir_resumen_historial(df_hist_cerrados: pd.DataFrame | None = None) ->
     if df_hist_cerrados.empty:
         return pd.DataFrame()
 
-    resumen = []
-    for _, row in df_hist_cerrados.copy().iterrows():
-        id_inv = str(row.get("ID_Inventario", ""))
-        df_det = cargar_detalle(id_inv)
-        resultados = calcular_resultados_inventario(df_det) if not df_det.empty else {}
-
-        resumen.append({
-            "ID_Inventario": id_inv,
-            "Fecha": row.get("Fecha", ""),
-            "Cierre_Fecha": row.get("Cierre_Fecha", ""),
-            "Concesionaria": row.get("Concesionaria", ""),
-            "Sucursal": row.get("Sucursal", ""),
-            "Auditor": row.get("Auditor", ""),
-            "Cierre_Usuario": row.get("Cierre_Usuario", ""),
-            "Lineas": len(df_det),
-            "Muestra Q": resultados.get("cant_muestra", row.get("Cierre_Muestra_Q", 0)),
-            "Valor Muestra": resultados.get("valor_muestra", row.get("Cierre_Valor_Muestra", 0)),
-            "Faltantes Q": resultados.get("cant_faltantes", row.get("Cierre_Faltantes_Q", 0)),
-            "Sobrantes Q": resultados.get("cant_sobrantes", row.get("Cierre_Sobrantes_Q", 0)),
-            "Dif Neta Q": resultados.get("cant_dif_neta", row.get("Cierre_Dif_Neta_Q", 0)),
-            "Dif Absoluta Q": resultados.get("cant_dif_absoluta", row.get("Cierre_Dif_Absoluta_Q", 0)),
-            "Valor Dif Absoluta": resultados.get("valor_dif_absoluta", row.get("Cierre_Valor_Dif_Absoluta", 0)),
-            "Exactitud": resultados.get("grado", row.get("Cierre_Exactitud", 0)),
-        })
-
-    df_resumen = pd.DataFrame(resumen)
-    if "Cierre_Fecha" in df_resumen.columns:
-        df_resumen = df_resumen.sort_values("Cierre_Fecha", ascending=False)
-    return df_resumen
+    # Detail is only needed for inventories closed before snapshots existed; read it once for all of them.
+    con_snapshot = filas_con_snapshot(df_hist_cerrados)
+    df_det = ensure_unique_columns(read_gspread_worksheet(SHEET_DET)) if not con_snapshot.all() else None
+    return resumir_historial(df_hist_cerrados, df_det)
 
 def guardar_detalle_modificado(id_inv: str, df_mod: pd.DataFrame):
     """Update inventory details"""
+    if inventario_esta_cerrado(id_inv):
+        log_audit("guardar_detalle", id_inv, 0, "ERROR", "Inventario cerrado: el detalle no se puede modificar")
+        return False
     try:
         df_mod = df_mod.loc[:, ~pd.Index(df_mod.columns).duplicated(keep="last")].copy()
-        df_all = read_gspread_worksheet(SHEET_DET)
-        if df_all.empty:
-            ok, msg = write_gspread_worksheet(SHEET_DET, df_mod)
-            log_audit("guardar_detalle", id_inv, len(df_mod), "OK" if ok else "ERROR", msg if msg else "Creó hoja o sobreescribió")
-            return bool(ok)
-
-        df_all = df_all.loc[:, ~pd.Index(df_all.columns).duplicated(keep="last")].copy()
-        mask = df_all["ID_Inventario"].astype(str) == str(id_inv)
-        df_rest = df_all.loc[~mask].copy()
-        df_final = pd.concat([df_rest, df_mod], ignore_index=True)
-        ok, msg = write_gspread_worksheet(SHEET_DET, df_final)
+        with get_detalle_write_lock():
+            df_all = read_gspread_worksheet(SHEET_DET)
+            if df_all.empty:
+                ok, msg = write_gspread_worksheet(SHEET_DET, df_mod)
+                log_audit("guardar_detalle", id_inv, len(df_mod), "OK" if ok else "ERROR", msg if msg else "Creó hoja o sobreescribió")
+                return bool(ok)
+
+            df_all = df_all.loc[:, ~pd.Index(df_all.columns).duplicated(keep="last")].copy()
+            mask = df_all["ID_Inventario"].astype(str) == str(id_inv)
+            df_rest = df_all.loc[~mask].copy()
+            df_final = pd.concat([df_rest, df_mod], ignore_index=True)
+            ok, msg = write_gspread_worksheet(SHEET_DET, df_final)
         log_audit("guardar_detalle", id_inv, len(df_mod), "OK" if ok else "ERROR", msg if msg else "Actualizó detalle")
+        if ok:
+            actualizar_kpi_inventario(id_inv, df_mod)
         return bool(ok)
     except Exception as e:
         log_audit("guardar_detalle", id_inv, 0, "ERROR", str(e))
         return False
 
-def normalize_cell_value(value):
-    if isinstance(value, np.generic):
-        return value.item()
-    if isinstance(value, (pd.Series, pd.Index, np.ndarray, list, tuple)):
-        if len(value) == 0:
-            return ""
-        if len(value) == 1:
-            return normalize_cell_value(value[0])
-        return json.dumps([normalize_cell_value(v) for v in value], ensure_ascii=False)
+GUARDADO_OK = "ok"
+FALLO_PERMANENTE = "permanente"
+FALLO_TRANSITORIO = "transitorio"
+
+def guardar_conteos(id_inv: str, cambios: dict, usuario: str | None = None, rol: str | None = None) -> tuple[str, str]:
+    """Persist only the changed Conteo_Fisico cells of an inventory.
+
+    `cambios` maps the row position inside the inventory detail (as returned by
+    cargar_detalle) to the new count. Diferencia is recomputed only for those rows.
+    Returns (resultado, mensaje): GUARDADO_OK, FALLO_PERMANENTE when retrying the same
+    batch can never succeed (closed inventory, rows out of range) or FALLO_TRANSITORIO.
+    """
+    if not cambios:
+        return GUARDADO_OK, ""
+    if inventario_esta_cerrado(id_inv):
+        mensaje = "Inventario cerrado: el detalle no se puede modificar"
+        log_audit("guardar_conteo", id_inv, 0, "ERROR", mensaje, usuario=usuario, rol=rol)
+        return FALLO_PERMANENTE, mensaje
     try:
-        return "" if pd.isna(value) else value
-    except Exception:
-        return value
+        with get_detalle_write_lock():
+            df_all = read_gspread_worksheet(SHEET_DET)
+            if df_all.empty or "ID_Inventario" not in df_all.columns:
+                mensaje = "Detalle no encontrado"
+                log_audit("guardar_conteo", id_inv, 0, "ERROR", mensaje, usuario=usuario, rol=rol)
+                return FALLO_TRANSITORIO, mensaje
+
+            df_all = ensure_unique_columns(df_all).reset_index(drop=True)
+            posiciones_inv = np.flatnonzero((df_all["ID_Inventario"].astype(str) == str(id_inv)).to_numpy())
+
+            row_pos = np.array([int(p) for p in cambios.keys()], dtype=int)
+            validos = (row_pos >= 0) & (row_pos < len(posiciones_inv))
+            if not validos.all():
+                mensaje = "Filas de conteo fuera de rango"
+                log_audit("guardar_conteo", id_inv, 0, "ERROR", mensaje, usuario=usuario, rol=rol)
+                return FALLO_PERMANENTE, mensaje
+
+            destino = posiciones_inv[row_pos]
+            for col in ("Conteo_Fisico", "Diferencia"):
+                if col not in df_all.columns:
+                    df_all[col] = ""
+                df_all[col] = df_all[col].astype("object")
+
+            valores = pd.Series(list(cambios.values()), index=destino, dtype="object")
+            df_all.loc[destino, "Conteo_Fisico"] = valores
+
+            stock_num = parse_ar_number(df_all.loc[destino, C_STOCK]).fillna(0) if C_STOCK in df_all.columns else 0
+            conteo_num = parse_ar_number(valores)
+            # A cleared count leaves the row uncounted: Diferencia stays empty instead of -Stock.
+            df_all.loc[destino, "Diferencia"] = (conteo_num - stock_num).astype("object").where(conteo_num.notna(), "")
+
+            ok, msg = write_gspread_worksheet(SHEET_DET, df_all)
+        log_audit("guardar_conteo", id_inv, len(cambios), "OK" if ok else "ERROR", msg if msg else "Actualizó conteos modificados", usuario=usuario, rol=rol)
+        if ok:
+            actualizar_kpi_inventario(id_inv, df_all.iloc[posiciones_inv])
+            return GUARDADO_OK, ""
+        return FALLO_TRANSITORIO, msg or "No se pudo escribir el detalle"
+    except Exception as e:
+        log_audit("guardar_conteo", id_inv, 0, "ERROR", str(e), usuario=usuario, rol=rol)
+        return FALLO_TRANSITORIO, str(e)
 
-def set_detalle_value(df: pd.DataFrame, row_idx, column: str, value):
-    """Set a detail value preserving the original row index used by the UI."""
-    if column not in df.columns:
-        df[column] = ""
+class ConteoAutosaver:
+    """Background worker that coalesces count edits and persists them in small batches.
 
-    row_positions = np.flatnonzero(df.index.to_numpy() == row_idx)
-    if row_positions.size == 0:
-        return
+    Edits are keyed by (ID_Inventario, row position), so repeated edits of the same
+    cell collapse into one value. A batch is flushed once no new edit arrived for
+    `debounce_seconds` (or after `max_wait_seconds` of continuous editing).
+    Transient failures are retried with exponential backoff up to `max_reintentos`
+    times; batches that can never be saved are dropped and reported as "rechazado".
+    """
 
-    col_positions = np.flatnonzero(df.columns.to_numpy() == column)
-    if col_positions.size == 0:
-        return
+    def __init__(self, guardar_fn, debounce_seconds: float = 2.0, max_wait_seconds: float = 10.0,
+                 max_reintentos: int = 5, max_backoff_seconds: float = 60.0):
+        self._guardar_fn = guardar_fn
+        self._debounce = debounce_seconds
+        self._max_wait = max_wait_seconds
+        self._max_reintentos = max_reintentos
+        self._max_backoff = max_backoff_seconds
+        self._cond = threading.Condition()
+        self._pendientes: dict[str, dict] = {}
+        self._en_curso: dict[str, dict] = {}
+        self._rechazados: dict[str, dict] = {}
+        self._autores: dict[str, tuple] = {}
+        self._primer_cambio: dict[str, float] = {}
+        self._ultimo_cambio: dict[str, float] = {}
+        self._intentos: dict[str, int] = {}
+        self._reintentar_en: dict[str, float] = {}
+        self._estado: dict[str, dict] = {}
+        self._thread = threading.Thread(target=self._run, name="conteo-autosave", daemon=True)
+        self._thread.start()
+
+    def encolar(self, id_inv: str, cambios: dict, usuario: str = "", rol: str = "") -> int:
+        """Replace the queued counts of an inventory with the current change set of the page.
+
+        Rows missing from `cambios` (e.g. set back to the server value) leave the queue, and
+        values of a dropped batch are not queued again. Returns how many rows were added,
+        changed or removed.
+        """
+        id_inv = str(id_inv)
+        with self._cond:
+            omitir = {**self._rechazados.get(id_inv, {}), **self._en_curso.get(id_inv, {})}
+            cambios = {k: v for k, v in cambios.items() if k not in omitir or omitir[k] != v}
+            pendientes = self._pendientes.get(id_inv, {})
+            nuevos = [k for k, v in cambios.items() if k not in pendientes or pendientes[k] != v]
+            quitados = [k for k in pendientes if k not in cambios]
+            if not nuevos and not quitados:
+                return 0
+            if not cambios:
+                for cola in (self._pendientes, self._primer_cambio, self._ultimo_cambio, self._intentos, self._reintentar_en):
+                    cola.pop(id_inv, None)
+                if self._estado.get(id_inv, {}).get("estado") in ("pendiente", "error"):
+                    self._estado.pop(id_inv, None)
+                return len(quitados)
+            self._pendientes[id_inv] = dict(cambios)
+            ahora = time.monotonic()
+            self._primer_cambio.setdefault(id_inv, ahora)
+            self._ultimo_cambio[id_inv] = ahora
+            self._autores[id_inv] = (usuario, rol)
+            if self._estado.get(id_inv, {}).get("estado") != "error":
+                self._estado.setdefault(id_inv, {})["estado"] = "pendiente"
+            self._cond.notify()
+            return len(nuevos) + len(quitados)
+
+    def descartar(self, id_inv: str):
+        """Drop queued edits and failure state for an inventory (e.g. after a manual save)."""
+        id_inv = str(id_inv)
+        with self._cond:
+            for cola in (self._pendientes, self._rechazados, self._primer_cambio, self._ultimo_cambio, self._intentos, self._reintentar_en):
+                cola.pop(id_inv, None)
+            if self._estado.get(id_inv, {}).get("estado") in ("error", "rechazado"):
+                self._estado.pop(id_inv, None)
+
+    def estado(self, id_inv: str) -> dict:
+        with self._cond:
+            info = dict(self._estado.get(str(id_inv), {}))
+            info["pendientes"] = len(self._pendientes.get(str(id_inv), {}))
+            if str(id_inv) in self._reintentar_en:
+                info["reintento_en"] = max(0.0, self._reintentar_en[str(id_inv)] - time.monotonic())
+            return info
+
+    def _listos(self, ahora: float) -> list[str]:
+        return [
+            id_inv for id_inv, pend in self._pendientes.items()
+            if pend and ahora >= self._reintentar_en.get(id_inv, 0.0) and (
+                ahora - self._ultimo_cambio.get(id_inv, ahora) >= self._debounce
+                or ahora - self._primer_cambio.get(id_inv, ahora) >= self._max_wait
+            )
+        ]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                listos = self._listos(time.monotonic())
+                while not listos:
+                    self._cond.wait(timeout=self._debounce / 2 if self._pendientes else None)
+                    listos = self._listos(time.monotonic())
+                lotes = []
+                for id_inv in listos:
+                    lote = self._pendientes.pop(id_inv)
+                    self._en_curso[id_inv] = lote
+                    lotes.append((id_inv, lote, self._autores.get(id_inv, ("", ""))))
+                    self._primer_cambio.pop(id_inv, None)
+                    self._ultimo_cambio.pop(id_inv, None)
+                    self._estado.setdefault(id_inv, {})["estado"] = "guardando"
+
+            for id_inv, lote, (usuario, rol) in lotes:
+                try:
+                    resultado, mensaje = self._guardar_fn(id_inv, lote, usuario=usuario, rol=rol)
+                except Exception as e:
+                    resultado, mensaje = FALLO_TRANSITORIO, str(e)
+                with self._cond:
+                    self._en_curso.pop(id_inv, None)
+                    self._registrar_resultado(id_inv, lote, resultado, mensaje)
+
+    def _registrar_resultado(self, id_inv: str, lote: dict, resultado: str, mensaje: str):
+        """Update queue and status after a flush. Must be called with the condition held."""
+        estado_prev = self._estado.get(id_inv, {})
+        info = {"filas": len(lote), "mensaje": mensaje, "ultimo_guardado": estado_prev.get("ultimo_guardado", "")}
+        if resultado == GUARDADO_OK:
+            self._intentos.pop(id_inv, None)
+            self._reintentar_en.pop(id_inv, None)
+            info.update(estado="guardado", ultimo_guardado=datetime.datetime.now().strftime("%H:%M:%S"))
+        else:
+            intentos = self._intentos.get(id_inv, 0) + 1
+            if resultado == FALLO_PERMANENTE or intentos > self._max_reintentos:
+                # Retrying cannot help: drop the batch and remember it so reruns do not queue it again.
+                self._intentos.pop(id_inv, None)
+                self._reintentar_en.pop(id_inv, None)
+                self._rechazados.setdefault(id_inv, {}).update(lote)
+                if resultado != FALLO_PERMANENTE:
+                    mensaje = f"{mensaje} (se descartó tras {self._max_reintentos} reintentos)"
+                info.update(estado="rechazado", mensaje=mensaje)
+            else:
+                # Keep failed edits queued unless newer values arrived meanwhile, and back off.
+                self._intentos[id_inv] = intentos
+                espera = min(self._debounce * 2 ** (intentos - 1), self._max_backoff)
+                self._reintentar_en[id_inv] = time.monotonic() + espera
+                pendientes = self._pendientes.setdefault(id_inv, {})
+                for k, v in lote.items():
+                    pendientes.setdefault(k, v)
+                self._primer_cambio.setdefault(id_inv, time.monotonic())
+                self._ultimo_cambio.setdefault(id_inv, time.monotonic())
+                info.update(estado="error", intento=intentos, max_reintentos=self._max_reintentos)
+        self._estado[id_inv] = info
+        if self._pendientes.get(id_inv) and info["estado"] == "guardado":
+            self._estado[id_inv]["estado"] = "pendiente"
+
+@st.cache_resource
+def get_conteo_autosaver() -> ConteoAutosaver:
+    return ConteoAutosaver(guardar_conteos)
+
+def render_estado_autoguardado(id_inv: str):
+    info = get_conteo_autosaver().estado(id_inv)
+    estado = info.get("estado", "")
+    if estado == "rechazado":
+        st.error(f"❌ Autoguardado detenido: {info.get('mensaje', '')}. Esos conteos no se guardaron; revisá el inventario y guardá manualmente.")
+    elif estado == "error":
+        st.warning(
+            f"⚠️ Error de autoguardado: {info.get('mensaje', '')}. "
+            f"Reintento {info.get('intento', 1)} de {info.get('max_reintentos', 1)} en {info.get('reintento_en', 0):.0f} s."
+        )
+    elif estado == "guardando":
+        st.caption("💾 Guardando conteos...")
+    elif info.get("pendientes"):
+        st.caption(f"⏳ {info['pendientes']} conteo(s) en cola de autoguardado.")
+    elif estado == "guardado":
+        st.caption(f"✅ Autoguardado a las {info.get('ultimo_guardado', '')} ({info.get('filas', 0)} fila(s)).")
+    else:
+        st.caption("Autoguardado activo: los conteos modificados se guardan solos.")
+
+if hasattr(st, "fragment"):
+    # Refresh only the status line while the worker flushes in the background.
+    render_estado_autoguardado = st.fragment(run_every=2)(render_estado_autoguardado)
+
+PAQUETE_CONTEO_SHEET = "Conteo"
+PAQUETE_META_SHEET = "Paquete"
+PAQUETE_COLUMNAS = ["Fila", C_LOC, C_ART, C_DESC, C_STOCK, "Cat", "Conteo_Fisico", "Conteo_Exportado"]
+
+def exportar_paquete_conteo(id_inv: str, df_det: pd.DataFrame, usuario: str = "") -> io.BytesIO:
+    """Build an offline counting package (xlsx) for one inventory sample.
+
+    Rows are keyed by `Fila` (row position inside the inventory detail). The hidden
+    `Conteo_Exportado` column keeps the server count at export time for conflict detection.
+    """
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill
+    from openpyxl.utils import get_column_letter
+
+    df_pkg = df_det.reset_index(drop=True).copy()
+    df_pkg.insert(0, "Fila", np.arange(len(df_pkg)))
+    df_pkg["Conteo_Exportado"] = df_pkg["Conteo_Fisico"] if "Conteo_Fisico" in df_pkg.columns else ""
+    for col in PAQUETE_COLUMNAS:
+        if col not in df_pkg.columns:
+            df_pkg[col] = ""
+    df_pkg = df_pkg[PAQUETE_COLUMNAS].where(df_pkg[PAQUETE_COLUMNAS].notna(), "")
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = PAQUETE_CONTEO_SHEET
+    ws.append(PAQUETE_COLUMNAS)
+    for cell in ws[1]:
+        cell.font = Font(bold=True)
+    for row in df_pkg.itertuples(index=False):
+        ws.append([normalize_cell_value(v) for v in row])
+
+    editable_fill = PatternFill(start_color="FFF7D6", end_color="FFF7D6", fill_type="solid")
+    conteo_letter = get_column_letter(PAQUETE_COLUMNAS.index("Conteo_Fisico") + 1)
+    for cell in ws[conteo_letter]:
+        cell.fill = editable_fill
+    ws.column_dimensions[get_column_letter(PAQUETE_COLUMNAS.index("Conteo_Exportado") + 1)].hidden = True
+    ws.freeze_panes = "A2"
+
+    ws_meta = wb.create_sheet(title=PAQUETE_META_SHEET)
+    for clave, valor in [
+        ("ID_Inventario", str(id_inv)),
+        ("Exportado", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+        ("Usuario", usuario),
+        ("Filas", len(df_pkg)),
+    ]:
+        ws_meta.append([clave, valor])
+
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+def leer_paquete_conteo(archivo) -> tuple[dict, pd.DataFrame]:
+    """Read an offline counting package. Raises ValueError if the file is not a valid package."""
+    try:
+        hojas = pd.read_excel(archivo, sheet_name=None, header=None, dtype=object)
+    except Exception as e:
+        raise ValueError(f"No se pudo leer el archivo: {e}")
+    if PAQUETE_CONTEO_SHEET not in hojas or PAQUETE_META_SHEET not in hojas:
+        raise ValueError("El archivo no es un paquete de conteo válido.")
+
+    df_meta = hojas[PAQUETE_META_SHEET]
+    meta = {str(k): v for k, v in zip(df_meta.iloc[:, 0], df_meta.iloc[:, 1])} if df_meta.shape[1] >= 2 else {}
+
+    df_raw = hojas[PAQUETE_CONTEO_SHEET]
+    if df_raw.empty:
+        raise ValueError("El paquete no contiene filas de conteo.")
+    df_pkg = df_raw.iloc[1:].reset_index(drop=True)
+    df_pkg.columns = [COLUMN_ALIASES.get(str(col), str(col)) for col in df_raw.iloc[0]]
+    faltantes = [c for c in ["Fila", C_ART, C_LOC, "Conteo_Fisico", "Conteo_Exportado"] if c not in df_pkg.columns]
+    if faltantes:
+        raise ValueError(f"Faltan columnas en el paquete: {', '.join(faltantes)}")
+    return meta, df_pkg
+
+SCAN_ALIASES = {
+    "articulo": C_ART, "artículo": C_ART, "codigo": C_ART, "código": C_ART, "cod": C_ART, "sku": C_ART, "barcode": C_ART,
+    "locacion": C_LOC, "locación": C_LOC, "ubicacion": C_LOC, "ubicación": C_LOC, "loc": C_LOC,
+    "cantidad": "Cantidad", "cant": "Cantidad", "qty": "Cantidad", "conteo": "Cantidad",
+}
 
-    scalar_value = normalize_cell_value(value)
-    for row_pos in row_positions:
-        for col_pos in col_positions:
-            df.iat[int(row_pos), int(col_pos)] = scalar_value
+def leer_lecturas_csv(archivo) -> pd.DataFrame:
+    """Read a handheld scanner CSV dump into the (Artículo, Locación, Cantidad) event layout."""
+    df = pd.read_csv(archivo, sep=None, engine="python", dtype=str)
+    df = df.rename(columns={col: SCAN_ALIASES.get(str(col).strip().lower(), COLUMN_ALIASES.get(col, col)) for col in df.columns})
+    if C_ART not in df.columns:
+        df = df.rename(columns={df.columns[0]: C_ART})
+    if C_LOC not in df.columns:
+        df[C_LOC] = ""
+    if "Cantidad" not in df.columns:
+        df["Cantidad"] = "1"
+    return df[SCAN_COLUMNAS].fillna("")
 
 def cerrar_inventario(id_inv: str, usuario: str):
     """Close inventory"""
@@ -1753,31 +2029,124 @@ def cerrar_inventario(id_inv: str, usuario: str):
     df_hist.loc[mask, "Cierre_Usuario"] = usuario
     df_det = cargar_detalle(id_inv)
     if not df_det.empty:
-        resultados = calcular_resultados_inventario(df_det)
-        cierre_cols = {
-            "Cierre_Lineas": len(df_det),
-            "Cierre_Muestra_Q": resultados.get("cant_muestra", 0),
-            "Cierre_Valor_Muestra": resultados.get("valor_muestra", 0),
-            "Cierre_Faltantes_Q": resultados.get("cant_faltantes", 0),
-            "Cierre_Valor_Faltantes": resultados.get("valor_faltantes", 0),
-            "Cierre_Sobrantes_Q": resultados.get("cant_sobrantes", 0),
-            "Cierre_Valor_Sobrantes": resultados.get("valor_sobrantes", 0),
-            "Cierre_Dif_Neta_Q": resultados.get("cant_dif_neta", 0),
-            "Cierre_Valor_Dif_Neta": resultados.get("valor_dif_neta", 0),
-            "Cierre_Dif_Absoluta_Q": resultados.get("cant_dif_absoluta", 0),
-            "Cierre_Valor_Dif_Absoluta": resultados.get("valor_dif_absoluta", 0),
-            "Cierre_Exactitud": resultados.get("grado", 0),
-        }
-        for col, value in cierre_cols.items():
+        for col, value in materializar_cierre(df_det).items():
+            if col not in df_hist.columns:
+                df_hist[col] = ""
+            df_hist[col] = df_hist[col].astype("object")
             df_hist.loc[mask, col] = value
     ok, msg = write_gspread_worksheet(SHEET_HIST, df_hist)
     log_audit("cerrar_inventario", id_inv, 0, "OK" if ok else "ERROR", msg if msg else "Cerró inventario")
+    if ok:
+        actualizar_kpi_inventario(id_inv, df_det)
 
-def calcular_dashboard_kpis() -> dict:
+def materializar_cierres(ids_inv: list[str], usuario: str) -> tuple[int, list[str]]:
+    """Recompute and store the closing snapshot of closed inventories from a single detail read.
+
+    Inventories without detail rows are skipped (their snapshot would be all zeros) and returned as
+    `omitidos`, like exportar_reportes_zip does. Returns (actualizados, omitidos).
+    """
+    ids_inv = list(dict.fromkeys(str(i) for i in ids_inv))
     df_hist = read_gspread_worksheet(SHEET_HIST)
-    df_det = read_gspread_worksheet(SHEET_DET)
+    df_all = read_gspread_worksheet(SHEET_DET)
+    if df_hist.empty or not ids_inv:
+        return 0, []
+    if df_all.empty or "ID_Inventario" not in df_all.columns:
+        return 0, ids_inv
 
-    if df_hist.empty:
+    df_all = ensure_unique_columns(df_all)
+    claves = df_all["ID_Inventario"].astype(str)
+    df_sel = df_all[claves.isin(ids_inv)].assign(ID_Inventario=claves)
+    resultados = calcular_resultados_por_inventario(df_sel)
+
+    df_hist = df_hist.copy()
+    hist_ids = df_hist["ID_Inventario"].astype(str)
+    grupos = df_sel.groupby("ID_Inventario").groups
+    omitidos = [id_inv for id_inv in ids_inv if id_inv not in grupos]
+    materializados = []
+    for id_inv in ids_inv:
+        if id_inv in omitidos:
+            continue
+        res = resultados.loc[[id_inv]].to_dict("records")[0] if id_inv in resultados.index else None
+        mask = hist_ids == id_inv
+        for col, value in materializar_cierre(df_all.loc[grupos[id_inv]], res).items():
+            if col not in df_hist.columns:
+                df_hist[col] = ""
+            df_hist[col] = df_hist[col].astype("object")
+            df_hist.loc[mask, col] = value
+        if mask.any():
+            materializados.append(id_inv)
+
+    if not materializados:
+        log_audit_lote("recalcular_cierre", [(id_inv, 0, "ERROR", "Sin detalle: snapshot de cierre no materializado") for id_inv in omitidos], usuario=usuario)
+        return 0, omitidos
+
+    ok, msg = write_gspread_worksheet(SHEET_HIST, df_hist)
+    log_audit_lote("recalcular_cierre", [
+        (id_inv, len(grupos[id_inv]), "OK" if ok else "ERROR", msg if msg else "Recalculó snapshot de cierre") for id_inv in materializados
+    ] + [(id_inv, 0, "ERROR", "Sin detalle: snapshot de cierre no materializado") for id_inv in omitidos], usuario=usuario)
+    if ok:
+        for id_inv in materializados:
+            actualizar_kpi_inventario(id_inv, df_all.loc[grupos[id_inv]])
+    return (len(materializados) if ok else 0), omitidos
+
+def leer_kpis() -> pd.DataFrame:
+    df_kpi = read_gspread_worksheet(SHEET_KPI)
+    if df_kpi.empty or "Nivel" not in df_kpi.columns:
+        return pd.DataFrame(columns=KPI_COLUMNAS)
+    df_kpi = df_kpi.reindex(columns=KPI_COLUMNAS)
+    df_kpi[KPI_ADITIVOS + ["Exactitud"]] = df_kpi[KPI_ADITIVOS + ["Exactitud"]].apply(pd.to_numeric, errors="coerce").fillna(0)
+    for col in ["Nivel", "Clave", "ID_Inventario", "Concesionaria", "Sucursal", "Mes", "Estado"]:
+        df_kpi[col] = df_kpi[col].fillna("").astype(str)
+    return df_kpi
+
+def reconstruir_kpis_dashboard(usuario: str | None = None) -> pd.DataFrame:
+    """Rebuild Dashboard_KPIs from Historial and the whole detail (one grouped pass)."""
+    with get_kpi_write_lock():
+        df_hist = read_gspread_worksheet(SHEET_HIST)
+        df_det = read_gspread_worksheet(SHEET_DET)
+        df_kpi = reconstruir_kpis(df_hist, ensure_unique_columns(df_det))
+        ok, msg = write_gspread_worksheet(SHEET_KPI, df_kpi)
+    log_audit("reconstruir_kpis", "", len(df_kpi), "OK" if ok else "ERROR", msg if msg else "Reconstruyó KPIs de dashboards", usuario=usuario)
+    return df_kpi
+
+def actualizar_kpi_inventario(id_inv: str, df_det: pd.DataFrame | None = None) -> bool:
+    """Refresh one inventory's KPI row and apply its delta to the rollups of Dashboard_KPIs.
+
+    `df_det` is the inventory detail just written, if the caller has it at hand. When the
+    table does not exist yet it is built in full instead.
+    """
+    try:
+        df_hist = read_gspread_worksheet(SHEET_HIST)
+        if df_hist.empty or "ID_Inventario" not in df_hist.columns:
+            return False
+        filas = df_hist[df_hist["ID_Inventario"].astype(str) == str(id_inv)]
+        if filas.empty:
+            return False
+        if read_gspread_worksheet(SHEET_KPI).empty:
+            reconstruir_kpis_dashboard()
+            return True
+
+        if df_det is None:
+            df_det = cargar_detalle(id_inv)
+        nueva = kpi_inventario(filas.iloc[-1], df_det if df_det is not None else pd.DataFrame())
+        with get_kpi_write_lock():
+            ok, msg = write_gspread_worksheet(SHEET_KPI, actualizar_kpis(leer_kpis(), nueva))
+        if not ok:
+            log_audit("actualizar_kpis", id_inv, 0, "ERROR", msg)
+        return bool(ok)
+    except Exception as e:
+        log_audit("actualizar_kpis", id_inv, 0, "ERROR", str(e))
+        return False
+
+def calcular_dashboard_kpis() -> dict:
+    """Dashboard KPIs read from the pre-aggregated Dashboard_KPIs table (built on first use)."""
+    df_kpi = leer_kpis()
+    if df_kpi.empty and not read_gspread_worksheet(SHEET_HIST).empty:
+        df_kpi = reconstruir_kpis_dashboard()
+        df_kpi[KPI_ADITIVOS] = df_kpi[KPI_ADITIVOS].apply(pd.to_numeric, errors="coerce").fillna(0)
+
+    total = df_kpi[df_kpi["Nivel"] == "global"]
+    if total.empty:
         return {
             "inventarios_totales": 0,
             "inventarios_abiertos": 0,
@@ -1790,69 +2159,326 @@ def calcular_dashboard_kpis() -> dict:
             "ranking_sucursales": pd.DataFrame(),
         }
 
-    df_hist = df_hist.copy()
-    estados = df_hist.get("Estado", pd.Series(dtype=str)).astype(str).str.strip().str.lower()
-    inventarios_totales = len(df_hist)
-    inventarios_abiertos = int((estados == "abierto").sum())
-    inventarios_cerrados = int((estados == "cerrado").sum())
-    tasa_cierre = (inventarios_cerrados / inventarios_totales * 100) if inventarios_totales else 0.0
-
-    lineas_muestreadas = len(df_det) if not df_det.empty else 0
-    valuacion_muestra = 0.0
-    exactitudes = []
-    resumen_inventarios = []
-
-    if not df_det.empty and "ID_Inventario" in df_det.columns:
-        df_det = df_det.copy()
-        df_det["_stock"] = parse_ar_number(df_det.get(C_STOCK, pd.Series(dtype=object))).fillna(0)
-        df_det["_costo"] = parse_ar_number(df_det.get(C_COSTO, pd.Series(dtype=object))).fillna(0)
-        df_det["_diferencia"] = parse_ar_number(df_det.get("Diferencia", pd.Series(dtype=object))).fillna(0)
-        df_det["_valor_linea"] = df_det["_stock"] * df_det["_costo"]
-        valuacion_muestra = float(df_det["_valor_linea"].sum())
-
-        for id_inv, grupo in df_det.groupby("ID_Inventario"):
-            resultados = calcular_resultados_inventario(grupo.copy())
-            exactitudes.append(float(resultados.get("grado", 0)))
-            resumen_inventarios.append({
-                "ID_Inventario": id_inv,
-                "Sucursal": grupo.get("Sucursal", pd.Series([""])).iloc[0] if not grupo.empty else "",
-                "Líneas": len(grupo),
-                "Valuación": float((grupo["_stock"] * grupo["_costo"]).sum()),
-                "Líneas con diferencia": int((grupo["_diferencia"] != 0).sum()),
-                "Exactitud": float(resultados.get("grado", 0)),
-            })
-
-        detalle_resumen = pd.DataFrame(resumen_inventarios).sort_values(["Exactitud", "Valuación"], ascending=[True, False])
-
-        ranking_sucursales = (
-            pd.DataFrame(resumen_inventarios)
-            .groupby("Sucursal", dropna=False)
-            .agg(
-                Inventarios=("ID_Inventario", "count"),
-                Valuación=("Valuación", "sum"),
-                Exactitud_Promedio=("Exactitud", "mean"),
-            )
-            .reset_index()
-            .sort_values(["Exactitud_Promedio", "Valuación"], ascending=[True, False])
-        ) if resumen_inventarios else pd.DataFrame()
-    else:
-        detalle_resumen = pd.DataFrame()
-        ranking_sucursales = pd.DataFrame()
-
-    exactitud_promedio = float(np.mean(exactitudes)) if exactitudes else 0.0
+    total = total.iloc[0]
+    inventarios_totales = int(total["Inventarios"])
+    inventarios_cerrados = int(total["Cerrados"])
+    con_detalle = int(total["Con_Detalle"])
+
+    inventarios = df_kpi[(df_kpi["Nivel"] == KPI_NIVEL_INVENTARIO) & (df_kpi["Lineas"] > 0)]
+    detalle_resumen = pd.DataFrame({
+        "ID_Inventario": inventarios["ID_Inventario"],
+        "Sucursal": inventarios["Sucursal"],
+        "Líneas": inventarios["Lineas"].astype(int),
+        "Valuación": inventarios["Valuacion"].astype(float),
+        "Líneas con diferencia": inventarios["Lineas_Diferencia"].astype(int),
+        "Exactitud": inventarios["Exactitud"].astype(float),
+    }).sort_values(["Exactitud", "Valuación"], ascending=[True, False]).reset_index(drop=True)
+
+    sucursales = df_kpi[(df_kpi["Nivel"] == "sucursal") & (df_kpi["Con_Detalle"] > 0)]
+    ranking_sucursales = pd.DataFrame({
+        "Sucursal": sucursales["Sucursal"],
+        "Inventarios": sucursales["Con_Detalle"].astype(int),
+        "Valuación": sucursales["Valuacion"].astype(float),
+        "Exactitud_Promedio": sucursales["Suma_Exactitud"] / sucursales["Con_Detalle"],
+    }).sort_values(["Exactitud_Promedio", "Valuación"], ascending=[True, False]).reset_index(drop=True)
 
     return {
         "inventarios_totales": inventarios_totales,
-        "inventarios_abiertos": inventarios_abiertos,
+        "inventarios_abiertos": int(total["Abiertos"]),
         "inventarios_cerrados": inventarios_cerrados,
-        "tasa_cierre": tasa_cierre,
-        "lineas_muestreadas": lineas_muestreadas,
-        "valuacion_muestra": valuacion_muestra,
-        "exactitud_promedio": exactitud_promedio,
+        "tasa_cierre": (inventarios_cerrados / inventarios_totales * 100) if inventarios_totales else 0.0,
+        "lineas_muestreadas": int(total["Lineas"]),
+        "valuacion_muestra": float(total["Valuacion"]),
+        "exactitud_promedio": float(total["Suma_Exactitud"] / con_detalle) if con_detalle else 0.0,
         "detalle_resumen": detalle_resumen,
         "ranking_sucursales": ranking_sucursales,
     }
 
+def render_sugerencias_clasificacion(id_inv: str, df_det: pd.DataFrame, df_dif: pd.DataFrame, validar: bool, validador: str):
+    """Rules-engine suggestions with an "Aceptar" column; accepted rows are applied in one save."""
+    sugerencias = sugerir_clasificaciones(df_dif)
+    if sugerencias.empty:
+        st.caption("No se detectaron patrones de locación o canje entre las diferencias.")
+        return
+
+    actuales = df_dif.set_index("__row_pos__").reindex(sugerencias.index)
+    col_pendiente = "Tipo_Ajuste" if validar else "Justificacion"
+    pendiente = actuales.get(col_pendiente, pd.Series("", index=sugerencias.index)).fillna("").astype(str).str.strip() == ""
+    df_grid = sugerencias.assign(Aceptar=pendiente.to_numpy())
+    df_grid = df_grid[["Aceptar", *sugerencias.columns]]
+
+    with st.form(f"sugerencias_{id_inv}"):
+        editado = render_data_editor(
+            df_grid,
+            use_container_width=True,
+            hide_index=True,
+            num_rows="fixed",
+            disabled=list(sugerencias.columns),
+            column_config={
+                "Aceptar": st.column_config.CheckboxColumn("Aceptar", help="Aceptá ambas filas de cada pareja para mantener el ajuste consistente."),
+                "Pareja": None,
+            },
+            key=f"sugerencias_editor_{id_inv}",
+        )
+        enviado = st.form_submit_button("✅ Aplicar sugerencias aceptadas")
+
+    if not enviado:
+        return
+
+    aceptadas = sugerencias.loc[editado["Aceptar"].fillna(False).astype(bool).reindex(sugerencias.index, fill_value=False)]
+    if aceptadas.empty:
+        st.info("No hay sugerencias aceptadas.")
+        return
+
+    justif_vacia = actuales.get("Justificacion", pd.Series("", index=sugerencias.index)).fillna("").astype(str).str.strip() == ""
+    if not validar:
+        df_updates = aceptadas[["Justificacion_Sugerida"]].rename(columns={"Justificacion_Sugerida": "Justificacion"})
+    else:
+        df_updates = construir_actualizaciones_sugeridas(id_inv, aceptadas, validador, justif_vacia)
+    guardar_sugerencias_aceptadas(id_inv, df_det, df_updates)
+
+def construir_actualizaciones_sugeridas(id_inv: str, aceptadas: pd.DataFrame, validador: str, justif_vacia: pd.Series) -> pd.DataFrame:
+    """Validation update frame for accepted suggestions (Tipo_Ajuste/Ajuste_Cantidad/Canje_Articulo per row)."""
+    canjes = aceptadas.loc[aceptadas["Tipo_Ajuste"] == "Canje", "Canje_Articulo"].unique()
+    infos = buscar_articulos_en_base(id_inv, canjes)
+    sin_base = aceptadas["Canje_Articulo"].map(lambda c: bool(c) and not infos.get(c))
+    if sin_base.any():
+        st.warning(f"Se omiten {int(sin_base.sum())} canje(s) cuyo artículo no está en la base del Excel importado.")
+        aceptadas = aceptadas.loc[~sin_base]
+    ajustes = {
+        row_pos: (fila.Tipo_Ajuste, float(fila.Ajuste_Cantidad), fila.Canje_Articulo, infos.get(fila.Canje_Articulo), "NO", "", 0.0, "", None)
+        for row_pos, fila in aceptadas.iterrows()
+    }
+    df_updates = construir_actualizaciones_validacion(
+        {row_pos: "SI" for row_pos in ajustes},
+        ajustes,
+        validador,
+        datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
+    )
+    if not df_updates.empty:
+        df_updates["Justificacion"] = aceptadas["Justificacion_Sugerida"].where(justif_vacia.reindex(aceptadas.index, fill_value=False))
+    return df_updates
+
+def guardar_sugerencias_aceptadas(id_inv: str, df_det: pd.DataFrame, df_updates: pd.DataFrame):
+    if df_updates.empty:
+        return
+    df_det2 = aplicar_actualizaciones_detalle(prepare_editable_detalle_columns(df_det), df_updates)
+    ok = guardar_detalle_modificado(id_inv, df_det2.drop(columns=["__row_pos__"], errors="ignore"))
+    if ok:
+        st.success(f"✅ {len(df_updates)} sugerencia(s) aplicada(s)")
+    else:
+        st.error("Error al aplicar sugerencias. Revisá Audit_Log.")
+    st.rerun()
+
+def render_candidatos_canje(id_inv: str, df_det: pd.DataFrame, df_dif: pd.DataFrame, validador: str):
+    """Ranked canje candidates per faltante; the best accepted candidate of each row is applied."""
+    candidatos = emparejar_candidatos_canje(df_dif, indice_base_articulos(id_inv))
+    if candidatos.empty:
+        st.caption("No hay faltantes con candidatos de canje.")
+        return
+
+    df_grid = candidatos.reset_index().assign(Aceptar=False)
+    df_grid = df_grid[["Aceptar", *df_grid.columns[:-1]]]
+    with st.form(f"candidatos_canje_{id_inv}"):
+        editado = render_data_editor(
+            df_grid,
+            use_container_width=True,
+            hide_index=True,
+            num_rows="fixed",
+            disabled=[c for c in df_grid.columns if c != "Aceptar"],
+            column_config={
+                "Aceptar": st.column_config.CheckboxColumn("Aceptar"),
+                "__row_pos__": None,
+                "Tipo_Ajuste": None,
+                "Canje_Articulo": None,
+                "Justificacion_Sugerida": None,
+            },
+            key=f"candidatos_canje_editor_{id_inv}",
+        )
+        enviado = st.form_submit_button("✅ Aplicar canjes seleccionados")
+
+    if not enviado:
+        return
+
+    aceptados = df_grid.loc[editado["Aceptar"].fillna(False).astype(bool).to_numpy()]
+    aceptados = aceptados.sort_values("Rango").drop_duplicates("__row_pos__").set_index("__row_pos__")
+    if aceptados.empty:
+        st.info("No hay candidatos seleccionados.")
+        return
+
+    justif = df_dif.set_index("__row_pos__").reindex(aceptados.index).get("Justificacion", pd.Series("", index=aceptados.index))
+    justif_vacia = justif.fillna("").astype(str).str.strip() == ""
+    guardar_sugerencias_aceptadas(id_inv, df_det, construir_actualizaciones_sugeridas(id_inv, aceptados, validador, justif_vacia))
+
+MODO_GRILLA = "Grilla (por lote)"
+MODO_FILA = "Fila por fila"
+OPCIONES_VALIDADA = ["", "SI", "NO"]
+OPCIONES_TIPO_AJUSTE = ["", "Ajuste", "Canje", "Sin Ajuste"]
+OPCIONES_REQUIERE_ADICIONAL = ["NO", "SI"]
+COLUMNAS_GRILLA_VALIDACION = [
+    "Justif_Validada",
+    "Tipo_Ajuste",
+    "Ajuste_Cantidad",
+    "Canje_Articulo",
+    "Requiere_Ajuste_Adicional",
+    "Tipo_Ajuste_Adicional",
+    "Ajuste_Cantidad_Adicional",
+    "Canje_Articulo_Adicional",
+]
+
+def preparar_grilla_validacion(df_pagina: pd.DataFrame) -> pd.DataFrame:
+    """Typed, editable view of the differences page indexed by __row_pos__."""
+    base = df_pagina.set_index("__row_pos__")
+    vacio = pd.Series("", index=base.index)
+    cols_info = [c for c in [C_ART, C_LOC, "Diferencia", C_COSTO, "Justificacion"] if c in base.columns]
+    df_grid = base[cols_info].copy()
+    for col, opciones in [
+        ("Justif_Validada", OPCIONES_VALIDADA),
+        ("Tipo_Ajuste", OPCIONES_TIPO_AJUSTE),
+        ("Requiere_Ajuste_Adicional", OPCIONES_REQUIERE_ADICIONAL),
+        ("Tipo_Ajuste_Adicional", OPCIONES_TIPO_AJUSTE),
+    ]:
+        valores = base.get(col, vacio).fillna("").astype(str).str.strip()
+        df_grid[col] = valores.where(valores.isin(opciones), opciones[0])
+    for col in ["Ajuste_Cantidad", "Ajuste_Cantidad_Adicional"]:
+        df_grid[col] = pd.to_numeric(base.get(col, vacio), errors="coerce").fillna(0.0).astype(float)
+    for col in ["Canje_Articulo", "Canje_Articulo_Adicional"]:
+        df_grid[col] = base.get(col, vacio).fillna("").astype(str)
+    return df_grid[cols_info + COLUMNAS_GRILLA_VALIDACION]
+
+def resolver_grilla_validacion(id_inv: str, df_grid: pd.DataFrame) -> tuple[dict, dict, list]:
+    """Turn submitted grid rows into the (validaciones, ajustes, canjes_invalidos) used by the row-by-row mode.
+
+    Canje codes are resolved in one batch against the base index.
+    """
+    codigos = pd.concat([df_grid["Canje_Articulo"], df_grid["Canje_Articulo_Adicional"]]).astype(str).str.strip()
+    cache_canjes = buscar_articulos_en_base(id_inv, codigos[codigos != ""].unique())
+
+    def buscar(codigo: str):
+        return cache_canjes.get(str(codigo or "").strip())
+
+    validaciones, ajustes, invalidos = {}, {}, []
+    for row_pos, row in df_grid.iterrows():
+        val = row["Justif_Validada"]
+        tipo, cant, canje_codigo, canje_info = "", 0.0, "", None
+        requiere, tipo_adic, cant_adic, canje_codigo_adic, canje_info_adic = "NO", "", 0.0, "", None
+        if val == "SI":
+            tipo = row["Tipo_Ajuste"] or "Sin Ajuste"
+            cant = float(row["Ajuste_Cantidad"] or 0.0) if tipo in ("Ajuste", "Canje") else 0.0
+            if tipo == "Canje":
+                canje_codigo = str(row["Canje_Articulo"] or "").strip()
+                canje_info = buscar(canje_codigo)
+                if not canje_info:
+                    invalidos.append(row_pos)
+            requiere = row["Requiere_Ajuste_Adicional"] or "NO"
+            if requiere == "SI":
+                tipo_adic = row["Tipo_Ajuste_Adicional"] or "Sin Ajuste"
+                cant_adic = float(row["Ajuste_Cantidad_Adicional"] or 0.0) if tipo_adic in ("Ajuste", "Canje") else 0.0
+                if tipo_adic == "Canje":
+                    canje_codigo_adic = str(row["Canje_Articulo_Adicional"] or "").strip()
+                    canje_info_adic = buscar(canje_codigo_adic)
+                    if not canje_info_adic:
+                        invalidos.append(row_pos)
+        validaciones[row_pos] = val
+        ajustes[row_pos] = (tipo, cant, canje_codigo, canje_info, requiere, tipo_adic, cant_adic, canje_codigo_adic, canje_info_adic)
+    return validaciones, ajustes, invalidos
+
+def filas_editadas(df_original: pd.DataFrame, df_editado: pd.DataFrame, columnas: list[str]) -> pd.Index:
+    """Index labels whose editable columns changed in a data editor."""
+    antes = df_original[columnas].astype(str)
+    despues = df_editado[columnas].reindex(df_original.index).astype(str)
+    return df_original.index[(antes != despues).any(axis=1).to_numpy()]
+
+def render_grilla_justificaciones(id_inv: str, df_det: pd.DataFrame, df_pagina: pd.DataFrame, vista: str = ""):
+    df_grid = df_pagina.set_index("__row_pos__")
+    cols_grid = [c for c in [C_ART, C_LOC, C_STOCK, "Conteo_Fisico", "Diferencia"] if c in df_grid.columns]
+    df_grid = df_grid[cols_grid].assign(Justificacion=df_grid.get("Justificacion", pd.Series("", index=df_grid.index)).fillna("").astype(str))
+
+    with st.form(f"grilla_just_{id_inv}"):
+        editado = render_data_editor(
+            df_grid,
+            use_container_width=True,
+            hide_index=True,
+            num_rows="fixed",
+            disabled=cols_grid,
+            column_config={"Justificacion": st.column_config.TextColumn("Justificación", width="large")},
+            key=f"grilla_just_editor_{id_inv}_{vista}",
+        )
+        enviado = st.form_submit_button("💾 Guardar justificaciones")
+
+    if enviado:
+        cambiadas = filas_editadas(df_grid, editado, ["Justificacion"])
+        if len(cambiadas) == 0:
+            st.info("No hay cambios para guardar.")
+            return
+        df_updates = editado.loc[cambiadas, ["Justificacion"]]
+        df_det2 = aplicar_actualizaciones_detalle(prepare_editable_detalle_columns(df_det), df_updates)
+        ok = guardar_detalle_modificado(id_inv, df_det2.drop(columns=["__row_pos__"], errors="ignore"))
+        if ok:
+            st.success(f"✅ {len(cambiadas)} justificación(es) guardada(s)")
+        else:
+            st.error("Error al guardar justificaciones. Revisá Audit_Log.")
+        st.rerun()
+
+def render_grilla_validacion(id_inv: str, df_det: pd.DataFrame, df_pagina: pd.DataFrame, validador: str, vista: str = ""):
+    df_grid = preparar_grilla_validacion(df_pagina)
+    cols_info = [c for c in df_grid.columns if c not in COLUMNAS_GRILLA_VALIDACION]
+
+    with st.form(f"grilla_val_{id_inv}"):
+        editado = render_data_editor(
+            df_grid,
+            use_container_width=True,
+            hide_index=True,
+            num_rows="fixed",
+            disabled=cols_info,
+            column_config={
+                "Justif_Validada": st.column_config.SelectboxColumn("¿Validada?", options=OPCIONES_VALIDADA),
+                "Tipo_Ajuste": st.column_config.SelectboxColumn("Tipo de Ajuste", options=OPCIONES_TIPO_AJUSTE),
+                "Ajuste_Cantidad": st.column_config.NumberColumn("Cantidad", step=1.0, help="Negativo faltante, positivo sobrante"),
+                "Canje_Articulo": st.column_config.TextColumn("Código canje"),
+                "Requiere_Ajuste_Adicional": st.column_config.SelectboxColumn("¿Ajuste adicional?", options=OPCIONES_REQUIERE_ADICIONAL),
+                "Tipo_Ajuste_Adicional": st.column_config.SelectboxColumn("Tipo adicional", options=OPCIONES_TIPO_AJUSTE),
+                "Ajuste_Cantidad_Adicional": st.column_config.NumberColumn("Cantidad adicional", step=1.0),
+                "Canje_Articulo_Adicional": st.column_config.TextColumn("Código canje adicional"),
+            },
+            key=f"grilla_val_editor_{id_inv}_{vista}",
+        )
+        enviado = st.form_submit_button("💾 Guardar validación y ajustes")
+
+    if enviado:
+        cambiadas = filas_editadas(df_grid, editado, COLUMNAS_GRILLA_VALIDACION)
+        if len(cambiadas) == 0:
+            st.info("No hay cambios para guardar.")
+            return
+        editado = editado.loc[cambiadas].fillna({
+            "Justif_Validada": "",
+            "Tipo_Ajuste": "",
+            "Ajuste_Cantidad": 0.0,
+            "Canje_Articulo": "",
+            "Requiere_Ajuste_Adicional": "NO",
+            "Tipo_Ajuste_Adicional": "",
+            "Ajuste_Cantidad_Adicional": 0.0,
+            "Canje_Articulo_Adicional": "",
+        })
+        validaciones, ajustes, invalidos = resolver_grilla_validacion(id_inv, editado)
+        if invalidos:
+            arts = ", ".join(df_grid.loc[sorted(set(invalidos)), C_ART].astype(str).tolist()) if C_ART in df_grid.columns else ""
+            st.error(f"Hay canjes sin código o con código no encontrado en la base del Excel importado: {arts}")
+            return
+        df_updates = construir_actualizaciones_validacion(
+            validaciones,
+            ajustes,
+            validador,
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
+        )
+        df_det2 = aplicar_actualizaciones_detalle(prepare_editable_detalle_columns(df_det), df_updates)
+        ok = guardar_detalle_modificado(id_inv, df_det2.drop(columns=["__row_pos__"], errors="ignore"))
+        if ok:
+            st.success(f"✅ {len(cambiadas)} fila(s) validada(s)")
+        else:
+            st.error("Error al guardar validaciones y ajustes. Revisá Audit_Log.")
+        st.rerun()
+
 # ----------------------------
 # UI
 # ----------------------------
@@ -1986,17 +2612,20 @@ if modulo_activo == "nuevo":
 
                 df_base_store = df_base.copy()
                 if C_ART in df_base_store.columns:
-                    df_base_store[C_ART] = df_base_store[C_ART].apply(normalize_article_code)
+                    df_base_store[C_ART] = normalize_article_codes(df_base_store[C_ART])
                 df_base_store["ID_Inventario"] = id_inv
                 df_base_store["Concesionaria"] = concesionaria
                 df_base_store["Sucursal"] = sucursal
                 ok_base = append_gspread_worksheet(SHEET_BASE, df_base_store)
 
                 muestra["ID_Inventario"] = id_inv
-                ok_det = append_gspread_worksheet(SHEET_DET, muestra)
+                with get_detalle_write_lock():
+                    ok_det = append_gspread_worksheet(SHEET_DET, muestra)
 
                 # Log actions
                 log_audit("generar_inventario", id_inv, len(muestra), "OK" if (ok_hist and ok_det and ok_base) else "ERROR", f"hist_ok={ok_hist}, det_ok={ok_det}, base_ok={ok_base}")
+                if ok_hist and ok_det:
+                    actualizar_kpi_inventario(id_inv, muestra)
 
                 if ok_hist and ok_det and ok_base:
                     st.success(f"✅ Inventario {id_inv} creado y detalle guardado ({len(muestra)} filas).")
@@ -2053,58 +2682,78 @@ elif modulo_activo == "conteo":
             if df_det.empty:
                 st.warning("No hay detalle")
             else:
+                # The row position inside the inventory detail is the stable row ID used by the editor.
+                df_det = df_det.reset_index(drop=True)
                 cols_show = ["Concesionaria","Sucursal",C_LOC,C_ART,C_DESC,C_STOCK,C_COSTO,"Cat","Conteo_Fisico","Diferencia"]
                 cols_show = [c for c in cols_show if c in df_det.columns]
-                df_edit = df_det[cols_show].copy()
 
-                edited = render_data_editor(
-                    df_edit,
-                    use_container_width=True,
-                    num_rows="fixed",
-                    disabled=[c for c in df_edit.columns if c != "Conteo_Fisico"],
+                autoguardado = st.toggle(
+                    "Autoguardado",
+                    value=True,
+                    key="conteo_autoguardado",
+                    help="Guarda los conteos modificados en segundo plano, agrupando ediciones rápidas.",
                 )
 
-                df_det2 = df_det.copy()
-                key_cols = [C_ART, C_LOC]
-                if not all(c in df_det2.columns for c in key_cols):
+                if not all(c in df_det.columns for c in [C_ART, C_LOC, C_STOCK]):
                     st.error("Columnas no encontradas")
                 else:
-                    edited2 = edited.copy()
-                    for c in key_cols:
-                        edited2[c] = edited2[c].astype(str)
-                        df_det2[c] = df_det2[c].astype(str)
-
-                    df_merge = df_det2.merge(
-                        edited2[key_cols + ["Conteo_Fisico"]],
-                        on=key_cols,
-                        how="left",
-                        suffixes=("", "_new")
+                    # Counts edited on any page and not yet persisted, keyed by row ID.
+                    pendientes_key = f"conteo_pendientes_{id_sel}"
+                    pendientes = calcular_cambios_conteo(
+                        df_det,
+                        pd.DataFrame({"Conteo_Fisico": pd.Series(st.session_state.get(pendientes_key, {}), dtype="object")}),
                     )
 
-                    df_merge["Conteo_Fisico"] = df_merge["Conteo_Fisico_new"].combine_first(df_merge.get("Conteo_Fisico"))
-                    if "Conteo_Fisico_new" in df_merge.columns:
-                        df_merge = df_merge.drop(columns=["Conteo_Fisico_new"])
+                    df_pagina = render_filtros_paginacion(df_det[cols_show], key=f"conteo_{id_sel}")
+                    vista_pagina = clave_vista_paginada(f"conteo_{id_sel}", df_pagina)
+                    df_edit = df_pagina.copy()
+                    en_pagina = [fila for fila in pendientes if fila in df_edit.index]
+                    if en_pagina:
+                        df_edit["Conteo_Fisico"] = df_edit["Conteo_Fisico"].astype("object")
+                        df_edit.loc[en_pagina, "Conteo_Fisico"] = [pendientes[fila] for fila in en_pagina]
+
+                    edited = render_data_editor(
+                        df_edit,
+                        use_container_width=True,
+                        num_rows="fixed",
+                        hide_index=True,
+                        disabled=[c for c in df_edit.columns if c != "Conteo_Fisico"],
+                        key=f"conteo_editor_{id_sel}_{vista_pagina}",
+                    )
 
-                    stock_num = parse_ar_number(df_merge[C_STOCK]).fillna(0)
-                    conteo_num = parse_ar_number(df_merge["Conteo_Fisico"]).fillna(0)
-                    df_merge["Diferencia"] = conteo_num - stock_num
+                    cambios_pagina = calcular_cambios_conteo(df_pagina, edited)
+                    pendientes = {fila: v for fila, v in pendientes.items() if fila not in df_pagina.index}
+                    pendientes.update(cambios_pagina)
+                    st.session_state[pendientes_key] = pendientes
+                    cambios_conteo = pendientes
+
+                    if autoguardado:
+                        # The full change set replaces the queued one, so reverted cells leave the queue.
+                        get_conteo_autosaver().encolar(id_sel, cambios_conteo, usuario_actual, rol_actual)
+                        render_estado_autoguardado(id_sel)
+                    elif cambios_conteo:
+                        st.caption(f"{len(cambios_conteo)} conteo(s) modificado(s) sin guardar.")
 
                     col_save, col_dl = st.columns([1, 1])
                     with col_save:
                         if st.button("💾 Guardar conteo"):
-                            ok = guardar_detalle_modificado(id_sel, df_merge)
-                            if ok:
+                            get_conteo_autosaver().descartar(id_sel)
+                            resultado, mensaje = guardar_conteos(id_sel, cambios_conteo)
+                            if resultado == GUARDADO_OK:
+                                st.session_state[pendientes_key] = {}
                                 st.success("✅ Conteo guardado")
                             else:
-                                st.error("Error al guardar conteo. Revisá Audit_Log o mensajes de error.")
+                                st.error(f"Error al guardar conteo: {mensaje}. Revisá Audit_Log o mensajes de error.")
                             st.rerun()
 
                     with col_dl:
-                        df_view = df_edit.copy()
-                        df_view["Conteo_Fisico"] = edited["Conteo_Fisico"]
+                        df_view = df_det[cols_show].copy()
+                        if cambios_conteo:
+                            df_view["Conteo_Fisico"] = df_view["Conteo_Fisico"].astype("object")
+                            df_view.loc[list(cambios_conteo.keys()), "Conteo_Fisico"] = list(cambios_conteo.values())
                         stock_num_view = parse_ar_number(df_view[C_STOCK]).fillna(0)
-                        conteo_num_view = parse_ar_number(df_view["Conteo_Fisico"]).fillna(0)
-                        df_view["Diferencia"] = conteo_num_view - stock_num_view
+                        conteo_num_view = parse_ar_number(df_view["Conteo_Fisico"])
+                        df_view["Diferencia"] = (conteo_num_view - stock_num_view).astype("object").where(conteo_num_view.notna(), "")
 
                         cols_export = [c for c in cols_show if c in df_view.columns]
                         df_export = df_view[cols_export].copy()
@@ -2116,6 +2765,124 @@ elif modulo_activo == "conteo":
                             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                         )
 
+                    st.divider()
+                    mensaje_scan = st.session_state.pop(f"scan_mensaje_{id_sel}", None)
+                    if mensaje_scan:
+                        st.success(mensaje_scan)
+                    with st.expander("📷 Ingreso por escáner", expanded=False):
+                        st.caption("Escaneá con el lector (una lectura por Enter) o pegá/subí el volcado del escáner. Formato por línea: CODIGO, CODIGO;CANT o CODIGO;LOCACION;CANT.")
+                        buffer_key = f"scan_buffer_{id_sel}"
+                        st.session_state.setdefault(buffer_key, [])
+                        # Rotating the nonce gives the paste area and uploader fresh (empty) widgets
+                        nonce_key = f"scan_nonce_{id_sel}"
+                        nonce_scan = st.session_state.setdefault(nonce_key, 0)
+
+                        def vaciar_lecturas():
+                            st.session_state[buffer_key] = []
+                            st.session_state[nonce_key] = nonce_scan + 1
+
+                        with st.form(f"scan_form_{id_sel}", clear_on_submit=True):
+                            lectura = st.text_input("Lectura", key=f"scan_input_{id_sel}", placeholder="Escaneá un código...")
+                            if st.form_submit_button("Agregar lectura") and lectura.strip():
+                                st.session_state[buffer_key].append(lectura.strip())
+
+                        texto_lecturas = st.text_area("Lecturas pegadas", key=f"scan_text_{id_sel}_{nonce_scan}", height=100)
+                        archivo_scan = st.file_uploader("Volcado del escáner (.csv/.txt)", type=["csv", "txt"], key=f"scan_csv_{id_sel}_{nonce_scan}")
+
+                        partes_scan = [parsear_lecturas_escaner("\n".join(st.session_state[buffer_key] + [texto_lecturas]))]
+                        if archivo_scan:
+                            try:
+                                partes_scan.append(leer_lecturas_csv(archivo_scan))
+                            except Exception as e:
+                                st.error(f"No se pudo leer el volcado del escáner: {e}")
+                        df_lecturas = pd.concat(partes_scan, ignore_index=True)
+
+                        if not df_lecturas.empty:
+                            modo_scan = st.radio(
+                                "Aplicación",
+                                options=["Sumar al conteo actual", "Reemplazar conteo"],
+                                horizontal=True,
+                                key=f"scan_modo_{id_sel}",
+                            )
+                            agregadas, errores_scan = agregar_lecturas(df_lecturas)
+                            resultado_scan = aplicar_lecturas_a_muestra(df_det, agregadas, sumar=modo_scan == "Sumar al conteo actual")
+                            cambios_scan = resultado_scan["cambios"]
+
+                            st.write(f"Lecturas: **{len(df_lecturas)}** · Artículos distintos: **{len(agregadas)}** · Filas a actualizar: **{len(cambios_scan)}**")
+                            for err in errores_scan:
+                                st.warning(err)
+                            if resultado_scan["no_encontrados"]:
+                                st.warning(f"No están en la muestra: {', '.join(resultado_scan['no_encontrados'][:20])}")
+                            if resultado_scan["ambiguos"]:
+                                st.warning(f"Artículo en varias locaciones, indicá la locación: {', '.join(resultado_scan['ambiguos'][:20])}")
+
+                            if cambios_scan:
+                                df_preview = df_det.loc[list(cambios_scan.keys()), [C_ART, C_LOC, C_STOCK]].copy()
+                                df_preview["Conteo_Nuevo"] = list(cambios_scan.values())
+                                render_dataframe(df_preview, use_container_width=True, hide_index=True)
+
+                            c_apply, c_clear = st.columns(2)
+                            with c_apply:
+                                if st.button("✅ Aplicar lecturas", disabled=not cambios_scan, key=f"scan_apply_{id_sel}"):
+                                    get_conteo_autosaver().descartar(id_sel)
+                                    resultado, mensaje = guardar_conteos(id_sel, cambios_scan)
+                                    if resultado == GUARDADO_OK:
+                                        vaciar_lecturas()
+                                        st.session_state[f"scan_mensaje_{id_sel}"] = f"✅ {len(cambios_scan)} conteo(s) actualizados desde {len(df_lecturas)} lectura(s)"
+                                        st.rerun()
+                                    else:
+                                        st.error(f"Error al aplicar lecturas: {mensaje}. Revisá Audit_Log.")
+                            with c_clear:
+                                if st.button("🗑️ Vaciar lecturas", key=f"scan_clear_{id_sel}"):
+                                    vaciar_lecturas()
+                                    st.rerun()
+
+                    with st.expander("📴 Conteo sin conexión", expanded=False):
+                        st.caption("Descargá el paquete, completá la columna Conteo_Fisico sin conexión y volvé a subirlo para sincronizar todos los conteos en un solo guardado.")
+                        # The package carries the exporting user in its metadata, so it is part of the version
+                        render_descarga_diferida(
+                            "paquete de conteo", "paquete", id_sel, f"{checksum_detalle(df_det)}:{usuario_actual}",
+                            lambda: exportar_paquete_conteo(id_sel, df_det, usuario_actual),
+                            f"Paquete_Conteo_{id_sel}.xlsx", key=f"paquete_dl_{id_sel}",
+                        )
+
+                        archivo_paquete = st.file_uploader("Subir paquete completado (.xlsx)", type=["xlsx"], key=f"paquete_up_{id_sel}")
+                        if archivo_paquete:
+                            try:
+                                meta_paquete, df_paquete = leer_paquete_conteo(archivo_paquete)
+                            except ValueError as e:
+                                st.error(str(e))
+                            else:
+                                sync = validar_paquete_conteo(id_sel, meta_paquete, df_paquete, df_det, cerrado=inventario_esta_cerrado(id_sel))
+                                for err in sync["errores"]:
+                                    st.warning(err)
+
+                                cambios_sync = dict(sync["cambios"])
+                                df_conflictos = sync["conflictos"]
+                                st.write(f"Conteos a sincronizar: **{len(cambios_sync)}** · Conflictos: **{len(df_conflictos)}**")
+                                if not df_conflictos.empty:
+                                    st.write("Estas filas fueron modificadas en el servidor después de exportar el paquete:")
+                                    render_dataframe(df_conflictos, use_container_width=True, hide_index=True)
+                                    resolucion = st.radio(
+                                        "Resolución de conflictos",
+                                        options=["Mantener valor del servidor", "Usar valor del paquete"],
+                                        horizontal=True,
+                                        key=f"paquete_conflictos_{id_sel}",
+                                    )
+                                    if resolucion == "Mantener valor del servidor":
+                                        for fila in df_conflictos["Fila"]:
+                                            cambios_sync.pop(fila, None)
+
+                                if st.button("🔄 Sincronizar conteos", disabled=not cambios_sync, key=f"paquete_sync_{id_sel}"):
+                                    get_conteo_autosaver().descartar(id_sel)
+                                    resultado, mensaje = guardar_conteos(id_sel, cambios_sync)
+                                    if resultado == GUARDADO_OK:
+                                        log_audit("sincronizar_paquete", id_sel, len(cambios_sync), "OK", f"Paquete exportado {meta_paquete.get('Exportado', '')}")
+                                        st.success(f"✅ {len(cambios_sync)} conteo(s) sincronizado(s)")
+                                    else:
+                                        st.error(f"Error al sincronizar conteos: {mensaje}. Revisá Audit_Log.")
+                                    st.rerun()
+
 # ----------------------------
 # MÓDULO 3
 # ----------------------------
@@ -2143,9 +2910,11 @@ elif modulo_activo == "justificaciones":
             else:
                 # Mostrar tabla resumen de conteos y diferencias
                 st.write("### 📋 Resumen de Conteos y Diferencias")
+                df_dif_pagina = render_filtros_paginacion(df_dif, key=f"just_{id_sel}", filtro_diferencia=False)
+                vista_pagina = clave_vista_paginada(f"just_{id_sel}", df_dif_pagina)
                 cols_resumen = [C_ART, C_LOC, C_STOCK, "Conteo_Fisico", "Diferencia", C_COSTO]
-                cols_resumen = [c for c in cols_resumen if c in df_dif.columns]
-                df_resumen = df_dif[cols_resumen].copy()
+                cols_resumen = [c for c in cols_resumen if c in df_dif_pagina.columns]
+                df_resumen = df_dif_pagina[cols_resumen].copy()
                 render_dataframe(df_resumen, use_container_width=True, hide_index=True)
                 st.divider()
                 
@@ -2159,223 +2928,239 @@ elif modulo_activo == "justificaciones":
                 else:
                     modo_admin = None
 
-                if rol_actual == ROLE_JEFE_REPUESTOS or (rol_actual == ROLE_ADMIN and modo_admin == "Cargar justificaciones"):
+                modo_edicion = st.radio(
+                    "Edición",
+                    options=[MODO_GRILLA, MODO_FILA],
+                    horizontal=True,
+                    key="modo_edicion_justificaciones",
+                    help="La grilla procesa todos los cambios de la página al guardar; fila por fila recarga con cada edición.",
+                )
+
+                modo_validar = not (rol_actual == ROLE_JEFE_REPUESTOS or (rol_actual == ROLE_ADMIN and modo_admin == "Cargar justificaciones"))
+                with st.expander("🤖 Sugerencias automáticas", expanded=False):
+                    render_sugerencias_clasificacion(id_sel, df_det, df_dif, modo_validar, usuario_actual)
+                if modo_validar:
+                    with st.expander("🔁 Candidatos de canje", expanded=False):
+                        render_candidatos_canje(id_sel, df_det, df_dif, usuario_actual)
+
+                if not modo_validar:
                     st.write("**Ingresá justificaciones:**")
-                    justificaciones_dict = {}
-                    
-                    for _, row in df_dif.iterrows():
-                        row_pos = int(row["__row_pos__"])
-                        art = row[C_ART]
-                        loc = row[C_LOC]
-                        dif = row["Diferencia"]
-                        just_actual = row.get("Justificacion", "")
-                        
-                        st.write(f"**{art} ({loc}) - Diferencia: {dif}**")
-                        just = st.text_area(
-                            f"Justificación",
-                            value=just_actual,
-                            height=80,
-                            key=f"just_{row_pos}"
-                        )
-                        justificaciones_dict[row_pos] = just
-                        st.divider()
+                    if modo_edicion == MODO_GRILLA:
+                        render_grilla_justificaciones(id_sel, df_det, df_dif_pagina, vista_pagina)
+                    else:
+                        # Drafts survive page changes; only the visible page gets widgets.
+                        justificaciones_dict = st.session_state.setdefault(f"just_borrador_{id_sel}", {})
                     
-                    if st.button("💾 Guardar justificaciones"):
-                        df_det2 = prepare_editable_detalle_columns(df_det.copy())
-                        for row_pos, just in justificaciones_dict.items():
-                            df_det2.loc[df_det2["__row_pos__"] == row_pos, "Justificacion"] = normalize_cell_value(just)
-                        df_det2 = df_det2.drop(columns=["__row_pos__"], errors="ignore")
+                        for _, row in df_dif_pagina.iterrows():
+                            row_pos = int(row["__row_pos__"])
+                            art = row[C_ART]
+                            loc = row[C_LOC]
+                            dif = row["Diferencia"]
+                            just_actual = justificaciones_dict.get(row_pos, row.get("Justificacion", ""))
                         
-                        ok = guardar_detalle_modificado(id_sel, df_det2)
-                        if ok:
-                            st.success("✅ Guardado")
-                            # Opción de descargar
+                            st.write(f"**{art} ({loc}) - Diferencia: {dif}**")
+                            just = st.text_area(
+                                f"Justificación",
+                                value=just_actual,
+                                height=80,
+                                key=f"just_{row_pos}"
+                            )
+                            justificaciones_dict[row_pos] = just
                             st.divider()
-                            st.write("### 📥 Descargar justificaciones:")
-                            cols_export = [C_ART, C_LOC, C_STOCK, "Conteo_Fisico", "Diferencia", "Justificacion", C_COSTO]
-                            cols_export = [c for c in cols_export if c in df_det2.columns]
-                            df_export = df_det2[cols_export].copy()
-                            xlsx_data = export_dataframe_to_excel(df_export, sheet_name="Justificaciones", title=f"Justificaciones - {id_sel}")
-                            st.download_button(
-                                "⬇️ Descargar Justificaciones Excel",
-                                data=xlsx_data,
-                                file_name=f"Justificaciones_{id_sel}.xlsx",
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                    
+                        if st.button("💾 Guardar justificaciones"):
+                            df_det2 = aplicar_actualizaciones_detalle(
+                                prepare_editable_detalle_columns(df_det),
+                                {row_pos: {"Justificacion": just} for row_pos, just in justificaciones_dict.items()},
                             )
-                        else:
-                            st.error("Error al guardar justificaciones. Revisá Audit_Log.")
-                        st.rerun()
+                            df_det2 = df_det2.drop(columns=["__row_pos__"], errors="ignore")
+                        
+                            ok = guardar_detalle_modificado(id_sel, df_det2)
+                            if ok:
+                                st.session_state.pop(f"just_borrador_{id_sel}", None)
+                                st.success("✅ Guardado")
+                                # Opción de descargar
+                                st.divider()
+                                st.write("### 📥 Descargar justificaciones:")
+                                cols_export = [C_ART, C_LOC, C_STOCK, "Conteo_Fisico", "Diferencia", "Justificacion", C_COSTO]
+                                cols_export = [c for c in cols_export if c in df_det2.columns]
+                                df_export = df_det2[cols_export].copy()
+                                xlsx_data = export_dataframe_to_excel(df_export, sheet_name="Justificaciones", title=f"Justificaciones - {id_sel}")
+                                st.download_button(
+                                    "⬇️ Descargar Justificaciones Excel",
+                                    data=xlsx_data,
+                                    file_name=f"Justificaciones_{id_sel}.xlsx",
+                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                                )
+                            else:
+                                st.error("Error al guardar justificaciones. Revisá Audit_Log.")
+                            st.rerun()
                 else:
                     st.write("**Validá justificaciones y asignà ajustes:**")
-                    validaciones_dict = {}
-                    ajustes_dict = {}
-                    canjes_invalidos = []
+                    if modo_edicion == MODO_GRILLA:
+                        render_grilla_validacion(id_sel, df_det, df_dif_pagina, usuario_actual, vista_pagina)
+                    else:
+                        # Drafts survive page changes; only the visible page gets widgets.
+                        borradores_val = st.session_state.setdefault(f"val_borrador_{id_sel}", {})
+                        canjes_invalidos = []
                     
-                    for _, row in df_dif.iterrows():
-                        row_pos = int(row["__row_pos__"])
-                        art = row[C_ART]
-                        loc = row[C_LOC]
-                        dif = row.get("Diferencia", 0)
-                        costo = pd.to_numeric(row.get(C_COSTO, 0), errors="coerce")
-                        just = row.get("Justificacion", "")
-                        val_actual = row.get("Justif_Validada", "")
-                        tipo_ajuste_actual = row.get("Tipo_Ajuste", "")
-                        ajuste_cant_actual = row.get("Ajuste_Cantidad", "")
-                        canje_codigo_actual = row.get("Canje_Articulo", "")
-                        requiere_ajuste_adic_actual = row.get("Requiere_Ajuste_Adicional", "NO")
-                        tipo_ajuste_adic_actual = row.get("Tipo_Ajuste_Adicional", "")
-                        ajuste_cant_adic_actual = row.get("Ajuste_Cantidad_Adicional", "")
-                        canje_codigo_adic_actual = row.get("Canje_Articulo_Adicional", "")
-                        
-                        st.write(f"**{art} ({loc}) - Diferencia: {dif} - Costo: {format_currency_ar(costo)}**")
-                        st.write(f"*{just if just else '(sin justificación)'}*")
+                        for _, row in df_dif_pagina.iterrows():
+                            row_pos = int(row["__row_pos__"])
+                            art = row[C_ART]
+                            loc = row[C_LOC]
+                            dif = row.get("Diferencia", 0)
+                            costo = pd.to_numeric(row.get(C_COSTO, 0), errors="coerce")
+                            just = row.get("Justificacion", "")
+                            val_actual = row.get("Justif_Validada", "")
+                            tipo_ajuste_actual = row.get("Tipo_Ajuste", "")
+                            ajuste_cant_actual = row.get("Ajuste_Cantidad", "")
+                            canje_codigo_actual = row.get("Canje_Articulo", "")
+                            requiere_ajuste_adic_actual = row.get("Requiere_Ajuste_Adicional", "NO")
+                            tipo_ajuste_adic_actual = row.get("Tipo_Ajuste_Adicional", "")
+                            ajuste_cant_adic_actual = row.get("Ajuste_Cantidad_Adicional", "")
+                            canje_codigo_adic_actual = row.get("Canje_Articulo_Adicional", "")
+                            if row_pos in borradores_val:
+                                borrador = borradores_val[row_pos]
+                                val_actual = borrador["val"]
+                                (
+                                    tipo_ajuste_actual,
+                                    ajuste_cant_actual,
+                                    canje_codigo_actual,
+                                    _,
+                                    requiere_ajuste_adic_actual,
+                                    tipo_ajuste_adic_actual,
+                                    ajuste_cant_adic_actual,
+                                    canje_codigo_adic_actual,
+                                    _,
+                                ) = borrador["ajuste"]
                         
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            val = st.selectbox(
-                                "¿Validada?",
-                                options=["", "SI", "NO"],
-                                index=(["", "SI", "NO"].index(val_actual) if val_actual in ["SI", "NO"] else 0),
-                                key=f"val_{row_pos}"
-                            )
+                            st.write(f"**{art} ({loc}) - Diferencia: {dif} - Costo: {format_currency_ar(costo)}**")
+                            st.write(f"*{just if just else '(sin justificación)'}*")
                         
-                        # Habilitar ajuste solo si Justif_Validada es "SI"
-                        if val == "SI":
-                            with col2:
-                                tipo_ajuste = st.selectbox(
-                                    "Tipo de Ajuste",
-                                    options=["", "Ajuste", "Canje", "Sin Ajuste"],
-                                    index=(["", "Ajuste", "Canje", "Sin Ajuste"].index(tipo_ajuste_actual) if tipo_ajuste_actual in ["Ajuste", "Canje", "Sin Ajuste"] else 0),
-                                    key=f"tipo_ajuste_{row_pos}"
+                            col1, col2 = st.columns(2)
+                            with col1:
+                                val = st.selectbox(
+                                    "¿Validada?",
+                                    options=["", "SI", "NO"],
+                                    index=(["", "SI", "NO"].index(val_actual) if val_actual in ["SI", "NO"] else 0),
+                                    key=f"val_{row_pos}"
                                 )
+                        
+                            # Habilitar ajuste solo si Justif_Validada es "SI"
+                            if val == "SI":
+                                with col2:
+                                    tipo_ajuste = st.selectbox(
+                                        "Tipo de Ajuste",
+                                        options=["", "Ajuste", "Canje", "Sin Ajuste"],
+                                        index=(["", "Ajuste", "Canje", "Sin Ajuste"].index(tipo_ajuste_actual) if tipo_ajuste_actual in ["Ajuste", "Canje", "Sin Ajuste"] else 0),
+                                        key=f"tipo_ajuste_{row_pos}"
+                                    )
                             
-                            # Mostrar campo numérico solo si elige "Ajuste" o "Canje"
-                            if tipo_ajuste in ("Ajuste", "Canje"):
-                                ajuste_cant = st.number_input(
-                                    f"Cantidad a {tipo_ajuste.lower()} (neg. faltante, pos. sobrante)",
-                                    value=float(ajuste_cant_actual) if ajuste_cant_actual else 0.0,
-                                    step=1.0,
-                                    key=f"ajuste_cant_{row_pos}"
-                                )
-                            else:
-                                ajuste_cant = 0.0
-                                tipo_ajuste = "Sin Ajuste" if tipo_ajuste == "" else tipo_ajuste
-
-                            canje_info = None
-                            canje_codigo = ""
-                            if tipo_ajuste == "Canje":
-                                canje_codigo = st.text_input(
-                                    "Código de artículo para canje",
-                                    value=str(canje_codigo_actual) if canje_codigo_actual is not None else "",
-                                    key=f"canje_codigo_{row_pos}",
-                                    placeholder="Ingresá código de artículo",
-                                )
-
-                                canje_info = buscar_articulo_en_base(id_sel, canje_codigo)
-                                if canje_codigo.strip() and canje_info:
-                                    st.success("Artículo encontrado en la base del Excel importado")
-                                    colc1, colc2, colc3, colc4 = st.columns(4)
-                                    colc1.write(f"**Artículo:** {canje_info['codigo']}")
-                                    colc2.write(f"**Descripción:** {canje_info['descripcion']}")
-                                    colc3.write(f"**Costo Rep.:** {format_currency_ar(canje_info['costo'])}")
-                                    colc4.write(f"**Stock base:** {canje_info['stock']:.2f}")
-                                    st.write(f"**Cantidad a ajustar artículo original:** {format_number_ar(ajuste_cant)}")
-                                    st.write(f"**Cantidad a ajustar artículo de canje:** {format_number_ar(-ajuste_cant)}")
-                                elif canje_codigo.strip():
-                                    st.error("Código no encontrado en la base completa del Excel importado.")
-                                canjes_invalidos.append(row_pos)
-
-                            requiere_adicional = st.selectbox(
-                                "¿Requiere ajustes adicionales?",
-                                options=["NO", "SI"],
-                                index=(1 if str(requiere_ajuste_adic_actual).upper() == "SI" else 0),
-                                key=f"requiere_adicional_{row_pos}",
-                            )
-
-                            tipo_ajuste_adic = ""
-                            ajuste_cant_adic = 0.0
-                            canje_codigo_adic = ""
-                            canje_info_adic = None
-
-                            if requiere_adicional == "SI":
-                                tipo_ajuste_adic = st.selectbox(
-                                    "Tipo de ajuste adicional",
-                                    options=["", "Ajuste", "Canje", "Sin Ajuste"],
-                                    index=( ["", "Ajuste", "Canje", "Sin Ajuste"].index(tipo_ajuste_adic_actual) if tipo_ajuste_adic_actual in ["", "Ajuste", "Canje", "Sin Ajuste"] else 0),
-                                    key=f"tipo_ajuste_adic_{row_pos}",
-                                )
-
-                                if tipo_ajuste_adic in ("Ajuste", "Canje"):
-                                    ajuste_cant_adic = st.number_input(
-                                        f"Cantidad de ajuste adicional ({tipo_ajuste_adic.lower()})",
-                                        value=float(ajuste_cant_adic_actual) if ajuste_cant_adic_actual else 0.0,
+                                # Mostrar campo numérico solo si elige "Ajuste" o "Canje"
+                                if tipo_ajuste in ("Ajuste", "Canje"):
+                                    ajuste_cant = st.number_input(
+                                        f"Cantidad a {tipo_ajuste.lower()} (neg. faltante, pos. sobrante)",
+                                        value=float(ajuste_cant_actual) if ajuste_cant_actual else 0.0,
                                         step=1.0,
-                                        key=f"ajuste_cant_adic_{row_pos}",
+                                        key=f"ajuste_cant_{row_pos}"
                                     )
                                 else:
-                                    tipo_ajuste_adic = "Sin Ajuste" if tipo_ajuste_adic == "" else tipo_ajuste_adic
-
-                                if tipo_ajuste_adic == "Canje":
-                                    canje_codigo_adic = st.text_input(
-                                        "Código de artículo para canje adicional",
-                                        value=str(canje_codigo_adic_actual) if canje_codigo_adic_actual is not None else "",
-                                        key=f"canje_codigo_adic_{row_pos}",
+                                    ajuste_cant = 0.0
+                                    tipo_ajuste = "Sin Ajuste" if tipo_ajuste == "" else tipo_ajuste
+
+                                canje_info = None
+                                canje_codigo = ""
+                                if tipo_ajuste == "Canje":
+                                    canje_codigo = st.text_input(
+                                        "Código de artículo para canje",
+                                        value=str(canje_codigo_actual) if canje_codigo_actual is not None else "",
+                                        key=f"canje_codigo_{row_pos}",
                                         placeholder="Ingresá código de artículo",
                                     )
 
-                                    canje_info_adic = buscar_articulo_en_base(id_sel, canje_codigo_adic)
-                                    if canje_codigo_adic.strip() and canje_info_adic:
-                                        st.success("Artículo adicional encontrado en la base del Excel importado")
-                                        colad1, colad2, colad3, colad4 = st.columns(4)
-                                        colad1.write(f"**Artículo:** {canje_info_adic['codigo']}")
-                                        colad2.write(f"**Descripción:** {canje_info_adic['descripcion']}")
-                                        colad3.write(f"**Costo Rep.:** {format_currency_ar(canje_info_adic['costo'])}")
-                                        colad4.write(f"**Stock base:** {canje_info_adic['stock']:.2f}")
-                                        st.write(f"**Cantidad adicional artículo original:** {format_number_ar(ajuste_cant_adic)}")
-                                        st.write(f"**Cantidad adicional artículo de canje:** {format_number_ar(-ajuste_cant_adic)}")
-                                    elif canje_codigo_adic.strip():
-                                        st.error("Código adicional no encontrado en la base completa del Excel importado.")
+                                    canje_info = buscar_articulo_en_base(id_sel, canje_codigo)
+                                    if canje_codigo.strip() and canje_info:
+                                        st.success("Artículo encontrado en la base del Excel importado")
+                                        colc1, colc2, colc3, colc4 = st.columns(4)
+                                        colc1.write(f"**Artículo:** {canje_info['codigo']}")
+                                        colc2.write(f"**Descripción:** {canje_info['descripcion']}")
+                                        colc3.write(f"**Costo Rep.:** {format_currency_ar(canje_info['costo'])}")
+                                        colc4.write(f"**Stock base:** {canje_info['stock']:.2f}")
+                                        st.write(f"**Cantidad a ajustar artículo original:** {format_number_ar(ajuste_cant)}")
+                                        st.write(f"**Cantidad a ajustar artículo de canje:** {format_number_ar(-ajuste_cant)}")
+                                    elif canje_codigo.strip():
+                                        st.error("Código no encontrado en la base completa del Excel importado.")
+                                    if not canje_info:
                                         canjes_invalidos.append(row_pos)
-                        else:
-                            tipo_ajuste = ""
-                            ajuste_cant = 0.0
-                            canje_codigo = ""
-                            canje_info = None
-                            requiere_adicional = "NO"
-                            tipo_ajuste_adic = ""
-                            ajuste_cant_adic = 0.0
-                            canje_codigo_adic = ""
-                            canje_info_adic = None
+
+                                requiere_adicional = st.selectbox(
+                                    "¿Requiere ajustes adicionales?",
+                                    options=["NO", "SI"],
+                                    index=(1 if str(requiere_ajuste_adic_actual).upper() == "SI" else 0),
+                                    key=f"requiere_adicional_{row_pos}",
+                                )
+
+                                tipo_ajuste_adic = ""
+                                ajuste_cant_adic = 0.0
+                                canje_codigo_adic = ""
+                                canje_info_adic = None
+
+                                if requiere_adicional == "SI":
+                                    tipo_ajuste_adic = st.selectbox(
+                                        "Tipo de ajuste adicional",
+                                        options=["", "Ajuste", "Canje", "Sin Ajuste"],
+                                        index=( ["", "Ajuste", "Canje", "Sin Ajuste"].index(tipo_ajuste_adic_actual) if tipo_ajuste_adic_actual in ["", "Ajuste", "Canje", "Sin Ajuste"] else 0),
+                                        key=f"tipo_ajuste_adic_{row_pos}",
+                                    )
+
+                                    if tipo_ajuste_adic in ("Ajuste", "Canje"):
+                                        ajuste_cant_adic = st.number_input(
+                                            f"Cantidad de ajuste adicional ({tipo_ajuste_adic.lower()})",
+                                            value=float(ajuste_cant_adic_actual) if ajuste_cant_adic_actual else 0.0,
+                                            step=1.0,
+                                            key=f"ajuste_cant_adic_{row_pos}",
+                                        )
+                                    else:
+                                        tipo_ajuste_adic = "Sin Ajuste" if tipo_ajuste_adic == "" else tipo_ajuste_adic
+
+                                    if tipo_ajuste_adic == "Canje":
+                                        canje_codigo_adic = st.text_input(
+                                            "Código de artículo para canje adicional",
+                                            value=str(canje_codigo_adic_actual) if canje_codigo_adic_actual is not None else "",
+                                            key=f"canje_codigo_adic_{row_pos}",
+                                            placeholder="Ingresá código de artículo",
+                                        )
+
+                                        canje_info_adic = buscar_articulo_en_base(id_sel, canje_codigo_adic)
+                                        if canje_codigo_adic.strip() and canje_info_adic:
+                                            st.success("Artículo adicional encontrado en la base del Excel importado")
+                                            colad1, colad2, colad3, colad4 = st.columns(4)
+                                            colad1.write(f"**Artículo:** {canje_info_adic['codigo']}")
+                                            colad2.write(f"**Descripción:** {canje_info_adic['descripcion']}")
+                                            colad3.write(f"**Costo Rep.:** {format_currency_ar(canje_info_adic['costo'])}")
+                                            colad4.write(f"**Stock base:** {canje_info_adic['stock']:.2f}")
+                                            st.write(f"**Cantidad adicional artículo original:** {format_number_ar(ajuste_cant_adic)}")
+                                            st.write(f"**Cantidad adicional artículo de canje:** {format_number_ar(-ajuste_cant_adic)}")
+                                        elif canje_codigo_adic.strip():
+                                            st.error("Código adicional no encontrado en la base completa del Excel importado.")
+                                        if not canje_info_adic:
+                                            canjes_invalidos.append(row_pos)
+                            else:
+                                tipo_ajuste = ""
+                                ajuste_cant = 0.0
+                                canje_codigo = ""
+                                canje_info = None
+                                requiere_adicional = "NO"
+                                tipo_ajuste_adic = ""
+                                ajuste_cant_adic = 0.0
+                                canje_codigo_adic = ""
+                                canje_info_adic = None
                         
-                        validaciones_dict[row_pos] = val
-                        ajustes_dict[row_pos] = (
-                            tipo_ajuste,
-                            ajuste_cant,
-                            canje_codigo,
-                            canje_info,
-                            requiere_adicional,
-                            tipo_ajuste_adic,
-                            ajuste_cant_adic,
-                            canje_codigo_adic,
-                            canje_info_adic,
-                        )
-                        st.divider()
-                    
-                    if st.button("💾 Guardar validación y ajustes"):
-                        if canjes_invalidos:
-                            st.error("Hay canjes con código inválido. Corregí los códigos antes de guardar.")
-                            st.stop()
-
-                        df_det2 = prepare_editable_detalle_columns(df_det.copy())
-                        for row_pos, val in validaciones_dict.items():
-                            mask_row = df_det2["__row_pos__"] == row_pos
-                            df_det2.loc[mask_row, "Justif_Validada"] = normalize_cell_value(val)
-                            df_det2.loc[mask_row, "Validador"] = usuario_actual
-                            df_det2.loc[mask_row, "Fecha_Validacion"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-                            if row_pos in ajustes_dict:
-                                (
-                                    tipo,
-                                    cantidad,
+                            borradores_val[row_pos] = {
+                                "val": val,
+                                "ajuste": (
+                                    tipo_ajuste,
+                                    ajuste_cant,
                                     canje_codigo,
                                     canje_info,
                                     requiere_adicional,
@@ -2383,63 +3168,49 @@ elif modulo_activo == "justificaciones":
                                     ajuste_cant_adic,
                                     canje_codigo_adic,
                                     canje_info_adic,
-                                ) = ajustes_dict[row_pos]
-                                df_det2.loc[mask_row, "Tipo_Ajuste"] = normalize_cell_value(tipo)
-                                df_det2.loc[mask_row, "Ajuste_Cantidad"] = normalize_cell_value(cantidad)
-                                if tipo == "Canje" and canje_info:
-                                    df_det2.loc[mask_row, "Canje_Articulo"] = normalize_cell_value(canje_info["codigo"])
-                                    df_det2.loc[mask_row, "Canje_Descripcion"] = normalize_cell_value(canje_info["descripcion"])
-                                    df_det2.loc[mask_row, "Canje_Costo_Rep"] = normalize_cell_value(canje_info["costo"])
-                                    df_det2.loc[mask_row, "Canje_Stock_Base"] = normalize_cell_value(canje_info["stock"])
-                                    df_det2.loc[mask_row, "Canje_Locacion"] = normalize_cell_value(canje_info["locacion"])
-                                    df_det2.loc[mask_row, "Canje_Ajuste_Cantidad"] = normalize_cell_value(-float(cantidad))
-                                else:
-                                    df_det2.loc[mask_row, "Canje_Articulo"] = ""
-                                    df_det2.loc[mask_row, "Canje_Descripcion"] = ""
-                                    df_det2.loc[mask_row, "Canje_Costo_Rep"] = ""
-                                    df_det2.loc[mask_row, "Canje_Stock_Base"] = ""
-                                    df_det2.loc[mask_row, "Canje_Locacion"] = ""
-                                    df_det2.loc[mask_row, "Canje_Ajuste_Cantidad"] = ""
-
-                                df_det2.loc[mask_row, "Requiere_Ajuste_Adicional"] = normalize_cell_value(requiere_adicional)
-                                df_det2.loc[mask_row, "Tipo_Ajuste_Adicional"] = normalize_cell_value(tipo_ajuste_adic)
-                                df_det2.loc[mask_row, "Ajuste_Cantidad_Adicional"] = normalize_cell_value(ajuste_cant_adic)
-
-                                if requiere_adicional == "SI" and tipo_ajuste_adic == "Canje" and canje_info_adic:
-                                    df_det2.loc[mask_row, "Canje_Articulo_Adicional"] = normalize_cell_value(canje_info_adic["codigo"])
-                                    df_det2.loc[mask_row, "Canje_Descripcion_Adicional"] = normalize_cell_value(canje_info_adic["descripcion"])
-                                    df_det2.loc[mask_row, "Canje_Costo_Rep_Adicional"] = normalize_cell_value(canje_info_adic["costo"])
-                                    df_det2.loc[mask_row, "Canje_Stock_Base_Adicional"] = normalize_cell_value(canje_info_adic["stock"])
-                                    df_det2.loc[mask_row, "Canje_Locacion_Adicional"] = normalize_cell_value(canje_info_adic["locacion"])
-                                    df_det2.loc[mask_row, "Canje_Ajuste_Cantidad_Adicional"] = normalize_cell_value(-float(ajuste_cant_adic))
-                                else:
-                                    df_det2.loc[mask_row, "Canje_Articulo_Adicional"] = ""
-                                    df_det2.loc[mask_row, "Canje_Descripcion_Adicional"] = ""
-                                    df_det2.loc[mask_row, "Canje_Costo_Rep_Adicional"] = ""
-                                    df_det2.loc[mask_row, "Canje_Stock_Base_Adicional"] = ""
-                                    df_det2.loc[mask_row, "Canje_Locacion_Adicional"] = ""
-                                    df_det2.loc[mask_row, "Canje_Ajuste_Cantidad_Adicional"] = ""
-                        df_det2 = df_det2.drop(columns=["__row_pos__"], errors="ignore")
-                        
-                        ok = guardar_detalle_modificado(id_sel, df_det2)
-                        if ok:
-                            st.success("✅ Guardado")
-                            # Opción de descargar
+                                ),
+                                "invalido": row_pos in canjes_invalidos,
+                            }
                             st.divider()
-                            st.write("### 📥 Descargar validaciones y ajustes:")
-                            cols_export = [C_ART, C_LOC, C_STOCK, "Conteo_Fisico", "Diferencia", "Justificacion", "Justif_Validada", "Tipo_Ajuste", "Ajuste_Cantidad", "Canje_Articulo", "Canje_Descripcion", "Canje_Locacion", "Canje_Costo_Rep", "Canje_Stock_Base", "Canje_Ajuste_Cantidad", "Requiere_Ajuste_Adicional", "Tipo_Ajuste_Adicional", "Ajuste_Cantidad_Adicional", "Canje_Articulo_Adicional", "Canje_Descripcion_Adicional", "Canje_Locacion_Adicional", "Canje_Costo_Rep_Adicional", "Canje_Stock_Base_Adicional", "Canje_Ajuste_Cantidad_Adicional", C_COSTO]
-                            cols_export = [c for c in cols_export if c in df_det2.columns]
-                            df_export = df_det2[cols_export].copy()
-                            xlsx_data = export_dataframe_to_excel(df_export, sheet_name="Validaciones", title=f"Validaciones y Ajustes - {id_sel}")
-                            st.download_button(
-                                "⬇️ Descargar Validaciones Excel",
-                                data=xlsx_data,
-                                file_name=f"Validaciones_{id_sel}.xlsx",
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+                        validaciones_dict = {r: b["val"] for r, b in borradores_val.items()}
+                        ajustes_dict = {r: b["ajuste"] for r, b in borradores_val.items()}
+                        canjes_invalidos = [r for r, b in borradores_val.items() if b["invalido"]]
+                    
+                        if st.button("💾 Guardar validación y ajustes"):
+                            if canjes_invalidos:
+                                st.error("Hay canjes sin código o con código inválido. Corregí los códigos antes de guardar.")
+                                st.stop()
+
+                            df_updates = construir_actualizaciones_validacion(
+                                validaciones_dict,
+                                ajustes_dict,
+                                usuario_actual,
+                                datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
                             )
-                        else:
-                            st.error("Error al guardar validaciones y ajustes. Revisá Audit_Log.")
-                        st.rerun()
+                            df_det2 = aplicar_actualizaciones_detalle(prepare_editable_detalle_columns(df_det), df_updates)
+                            df_det2 = df_det2.drop(columns=["__row_pos__"], errors="ignore")
+                        
+                            ok = guardar_detalle_modificado(id_sel, df_det2)
+                            if ok:
+                                st.session_state.pop(f"val_borrador_{id_sel}", None)
+                                st.success("✅ Guardado")
+                                # Opción de descargar
+                                st.divider()
+                                st.write("### 📥 Descargar validaciones y ajustes:")
+                                cols_export = [C_ART, C_LOC, C_STOCK, "Conteo_Fisico", "Diferencia", "Justificacion", "Justif_Validada", "Tipo_Ajuste", "Ajuste_Cantidad", "Canje_Articulo", "Canje_Descripcion", "Canje_Locacion", "Canje_Costo_Rep", "Canje_Stock_Base", "Canje_Ajuste_Cantidad", "Requiere_Ajuste_Adicional", "Tipo_Ajuste_Adicional", "Ajuste_Cantidad_Adicional", "Canje_Articulo_Adicional", "Canje_Descripcion_Adicional", "Canje_Locacion_Adicional", "Canje_Costo_Rep_Adicional", "Canje_Stock_Base_Adicional", "Canje_Ajuste_Cantidad_Adicional", C_COSTO]
+                                cols_export = [c for c in cols_export if c in df_det2.columns]
+                                df_export = df_det2[cols_export].copy()
+                                xlsx_data = export_dataframe_to_excel(df_export, sheet_name="Validaciones", title=f"Validaciones y Ajustes - {id_sel}")
+                                st.download_button(
+                                    "⬇️ Descargar Validaciones Excel",
+                                    data=xlsx_data,
+                                    file_name=f"Validaciones_{id_sel}.xlsx",
+                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                                )
+                            else:
+                                st.error("Error al guardar validaciones y ajustes. Revisá Audit_Log.")
+                            st.rerun()
 
 # ----------------------------
 # MÓDULO 4
@@ -2521,87 +3292,10 @@ elif modulo_activo == "cierre":
                 st.divider()
                 st.write("### 📥 Descargar reporte:")
 
-                def build_report_xlsx():
-                    from openpyxl import Workbook
-                    from openpyxl.utils.dataframe import dataframe_to_rows
-                    from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-
-                    buffer = io.BytesIO()
-                    wb = Workbook()
-                    ws = wb.active
-                    ws.title = "Resultado"
-
-                    title_font = Font(size=14, bold=True)
-                    light_red = PatternFill(start_color="FFF2F2", end_color="FFF2F2", fill_type="solid")
-                    bold = Font(bold=True)
-                    center = Alignment(horizontal="center", vertical="center")
-                    thin = Side(border_style="thin", color="000000")
-                    border = Border(left=thin, right=thin, top=thin, bottom=thin)
-
-                    ws.merge_cells("A1:D1")
-                    ws["A1"] = "4. Resultado Inventario Rotativo"
-                    ws["A1"].font = title_font
-                    ws["A1"].alignment = center
-
-                    ws["A3"] = "Resultado:"
-
-                    start_row = 5
-                    ws[f"A{start_row}"] = "Detalle"
-                    ws[f"B{start_row}"] = "Cant"
-                    ws[f"C{start_row}"] = "$"
-                    
-                    rows = [
-                        ("Muestra", resultados["cant_muestra"], resultados["valor_muestra"]),
-                        ("Faltantes", resultados["cant_faltantes"], resultados["valor_faltantes"]),
-                        ("Sobrantes", resultados["cant_sobrantes"], resultados["valor_sobrantes"]),
-                        ("Dif Neta", resultados["cant_dif_neta"], resultados["valor_dif_neta"]),
-                        ("Dif Absoluta", resultados["cant_dif_absoluta"], resultados["valor_dif_absoluta"]),
-                    ]
-
-                    for i, r in enumerate(rows, start=start_row + 1):
-                        ws[f"A{i}"] = r[0]
-                        ws[f"B{i}"] = r[1]
-                        ws[f"C{i}"] = r[2]
-                        # Apply Argentine format: . for thousands, , for decimals
-                        ws[f"C{i}"].number_format = '#,##0.00'
-
-                    ws2 = wb.create_sheet(title="Detalle")
-                    # Detect numeric columns in detail sheet
-                    numeric_cols = {}
-                    for col_idx, col_name in enumerate(df_det.columns, start=1):
-                        try:
-                            numeric_test = pd.to_numeric(df_det[col_name], errors="coerce")
-                            if numeric_test.notna().sum() > 0:
-                                numeric_cols[col_idx] = col_name
-                        except:
-                            pass
-                    
-                    # Write detail sheet with formatting
-                    for r_idx, row in enumerate(dataframe_to_rows(df_det, index=False, header=True), start=1):
-                        for c_idx, value in enumerate(row, start=1):
-                            cell = ws2.cell(row=r_idx, column=c_idx, value=value)
-                            if r_idx == 1:
-                                cell.font = Font(bold=True)
-                            # Apply numeric formatting for numeric columns
-                            if c_idx in numeric_cols:
-                                try:
-                                    num_val = float(value) if value not in (None, "", "NaN", "nan") else None
-                                    if num_val is not None and str(num_val) not in ("nan", "inf", "-inf"):
-                                        cell.value = num_val
-                                        cell.number_format = '#,##0.00'
-                                except:
-                                    pass
-
-                    wb.save(buffer)
-                    buffer.seek(0)
-                    return buffer
-
-                xlsx_data = build_report_xlsx()
-                st.download_button(
-                    "⬇️ Descargar XLSX",
-                    data=xlsx_data,
-                    file_name=f"Reporte_{id_sel}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                render_descarga_diferida(
+                    "reporte XLSX", "reporte", id_sel, checksum_detalle(df_det),
+                    lambda: build_report_xlsx(df_det, resultados),
+                    f"Reporte_{id_sel}.xlsx", key=f"cierre_report_{id_sel}",
                 )
 
                 st.divider()
@@ -2655,11 +3349,28 @@ elif modulo_activo == "historial":
                 "ID_Inventario", "Fecha", "Cierre_Fecha", "Concesionaria", "Sucursal",
                 "Auditor", "Cierre_Usuario", "Lineas", "Muestra Q", "Valor Muestra",
                 "Faltantes Q", "Sobrantes Q", "Dif Neta Q", "Dif Absoluta Q",
-                "Valor Dif Absoluta", "Exactitud",
+                "Valor Dif Absoluta", "Exactitud", "Snapshot",
             ]
             cols_resumen = [c for c in cols_resumen if c in df_filtrado.columns]
             render_dataframe(df_filtrado[cols_resumen], use_container_width=True, hide_index=True)
 
+            sin_snapshot = df_resumen.loc[df_resumen.get("Snapshot", pd.Series(dtype=str)) == "No", "ID_Inventario"].astype(str).tolist()
+            if rol_actual == ROLE_ADMIN and sin_snapshot:
+                st.caption(f"{len(sin_snapshot)} inventario(s) cerrados sin snapshot de cierre se recalculan en cada carga.")
+                if st.button("📌 Materializar cierres faltantes", key="historial_materializar"):
+                    n, omitidos = materializar_cierres(sin_snapshot, usuario_actual)
+                    st.session_state["historial_aviso_cierres"] = (n, omitidos)
+                    st.rerun()
+            aviso_cierres = st.session_state.pop("historial_aviso_cierres", None)
+            if aviso_cierres:
+                n, omitidos = aviso_cierres
+                st.success(f"✅ {n} cierre(s) materializado(s)")
+                if omitidos:
+                    st.warning(f"Sin detalle, no se materializaron: {', '.join(omitidos)}")
+
+            if not df_filtrado.empty:
+                render_exportacion_masiva(df_filtrado[cols_resumen], df_cerrados)
+
             if df_filtrado.empty:
                 st.info("No hay inventarios cerrados para los filtros seleccionados.")
             else:
@@ -2668,7 +3379,25 @@ elif modulo_activo == "historial":
                 id_sel = st.selectbox("Consultar inventario cerrado", id_options, key="historial_id")
                 df_det = cargar_detalle(id_sel)
                 fila_hist = df_resumen[df_resumen["ID_Inventario"].astype(str) == str(id_sel)]
-                resultados = calcular_resultados_inventario(df_det) if not df_det.empty else {}
+                fila_cierre = df_cerrados[df_cerrados["ID_Inventario"].astype(str) == str(id_sel)]
+                snapshot = resultados_desde_cierre(fila_cierre.iloc[0]) if not fila_cierre.empty else None
+                version_det = checksum_detalle(df_det)
+                if snapshot is not None:
+                    # Closed inventories read their materialized results; detail only feeds canjes and downloads.
+                    resultados = dict(snapshot, canjes=calcular_resultados_inventario(df_det).get("canjes", []) if not df_det.empty else [])
+                    if version_det != str(fila_cierre.iloc[0].get("Cierre_Checksum", "")):
+                        st.warning("El detalle actual no coincide con el checksum registrado al cierre.")
+                else:
+                    resultados = calcular_resultados_inventario(df_det) if not df_det.empty else {}
+
+                if rol_actual == ROLE_ADMIN:
+                    if st.button("♻️ Recalcular cierre", key=f"historial_recalcular_{id_sel}", help="Recalcula y vuelve a guardar el snapshot de cierre desde el detalle actual."):
+                        n, omitidos = materializar_cierres([id_sel], usuario_actual)
+                        if n:
+                            st.success("✅ Snapshot de cierre recalculado")
+                            st.rerun()
+                        elif omitidos:
+                            st.warning("El inventario no tiene detalle: no se puede recalcular el snapshot de cierre.")
 
                 if not fila_hist.empty:
                     meta = fila_hist.iloc[0]
@@ -2696,35 +3425,27 @@ elif modulo_activo == "historial":
                         render_dataframe(pd.DataFrame(resultados["canjes"]), use_container_width=True, hide_index=True)
 
                     st.write("### Detalle completo")
-                    render_dataframe(df_det, use_container_width=True, hide_index=True)
+                    render_dataframe(render_filtros_paginacion(df_det, key=f"hist_det_{id_sel}"), use_container_width=True, hide_index=True)
 
                     st.write("### Descargas")
                     dl1, dl2 = st.columns(2)
                     with dl1:
-                        xlsx_data = build_report_xlsx(df_det, resultados)
-                        st.download_button(
-                            "Descargar reporte XLSX",
-                            data=xlsx_data,
-                            file_name=f"Reporte_{id_sel}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            key=f"hist_report_{id_sel}",
+                        render_descarga_diferida(
+                            "reporte XLSX", "reporte", id_sel, version_det,
+                            lambda: build_report_xlsx(df_det, resultados),
+                            f"Reporte_{id_sel}.xlsx", key=f"hist_report_{id_sel}",
                         )
                     with dl2:
-                        detalle_data = export_dataframe_to_excel(df_det, sheet_name="Detalle", title=f"Detalle Inventario {id_sel}")
-                        st.download_button(
-                            "Descargar detalle XLSX",
-                            data=detalle_data,
-                            file_name=f"Detalle_{id_sel}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            key=f"hist_detail_{id_sel}",
+                        render_descarga_diferida(
+                            "detalle XLSX", "detalle", id_sel, version_det,
+                            lambda: export_dataframe_to_excel(df_det, sheet_name="Detalle", title=f"Detalle Inventario {id_sel}"),
+                            f"Detalle_{id_sel}.xlsx", key=f"hist_detail_{id_sel}",
                         )
 
-                df_audit = read_gspread_worksheet(SHEET_AUDIT)
-                if not df_audit.empty and "ID_Inventario" in df_audit.columns:
-                    audit_inv = df_audit[df_audit["ID_Inventario"].astype(str) == str(id_sel)].copy()
-                    if not audit_inv.empty:
-                        st.write("### Movimientos registrados")
-                        render_dataframe(audit_inv.sort_values("Timestamp", ascending=False), use_container_width=True, hide_index=True)
+                audit_inv = leer_audit_log(id_inv=id_sel)
+                if not audit_inv.empty:
+                    st.write("### Movimientos registrados")
+                    render_dataframe(audit_inv, use_container_width=True, hide_index=True)
 
 # ----------------------------
 # MODULO 6
@@ -2732,6 +3453,11 @@ elif modulo_activo == "historial":
 elif modulo_activo == "dashboards":
     st.subheader("Dashboards")
 
+    if rol_actual == ROLE_ADMIN:
+        if st.button("🔄 Reconstruir KPIs", key="reconstruir_kpis"):
+            reconstruir_kpis_dashboard(usuario=usuario_actual)
+            st.success("KPIs reconstruidos desde Historial y Detalle.")
+
     kpis = calcular_dashboard_kpis()
 
     fila1 = st.columns(4)
@@ -2768,6 +3494,31 @@ elif modulo_activo == "dashboards":
     else:
         st.info("Todavía no hay datos suficientes para mostrar ranking de sucursales.")
 
+    st.divider()
+    st.write("### 📈 Tendencias de inventarios cerrados")
+    col_dim, col_freq, col_ventana = st.columns(3)
+    dimension_tendencia = col_dim.radio("Agrupar por", ["Sucursal", "Concesionaria"], horizontal=True, key="tendencia_dimension")
+    frecuencia_tendencia = col_freq.radio("Período", list(TENDENCIA_FRECUENCIAS), horizontal=True, key="tendencia_frecuencia")
+    ventana_tendencia = col_ventana.slider("Media móvil (períodos)", min_value=1, max_value=12, value=3, key="tendencia_ventana")
+    tendencias = tendencias_kpis(leer_kpis(), dimension_tendencia, TENDENCIA_FRECUENCIAS[frecuencia_tendencia], ventana_tendencia)
+    if tendencias:
+        opciones_tendencia = list(tendencias["Exactitud"].columns)
+        # Keyed by dimension and options: a new grouping or a newly closed sucursal starts fully selected
+        version_opciones = hashlib.sha1("|".join(map(str, opciones_tendencia)).encode("utf-8")).hexdigest()[:8]
+        seleccion = st.multiselect(
+            dimension_tendencia,
+            opciones_tendencia,
+            default=opciones_tendencia,
+            key=f"tendencia_seleccion_{dimension_tendencia}_{version_opciones}",
+        )
+        for titulo, clave in [("Exactitud (%)", "Exactitud"), ("Valuación auditada", "Valuacion"), ("Valor diferencia absoluta", "Valor_Dif_Absoluta")]:
+            st.write(f"**{titulo}**")
+            tabs_serie = st.tabs(["Media móvil", "Por período"])
+            tabs_serie[0].line_chart(tendencias[f"{clave}_Movil"][seleccion])
+            tabs_serie[1].line_chart(tendencias[clave][seleccion])
+    else:
+        st.info("Todavía no hay inventarios cerrados para mostrar tendencias.")
+
     st.divider()
     st.write("### 📦 Resumen por Inventario")
     if not kpis["detalle_resumen"].empty:
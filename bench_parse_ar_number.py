@@ -0,0 +1,58 @@
+"""
+Benchmark de parse_ar_number: ruta rápida (dtype numérico / kernels Arrow) vs. la cadena de .str.replace anterior.
+
+Uso: python bench_parse_ar_number.py [filas]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from calculos_inventario import parse_ar_number
+
+
+def parse_anterior(series: pd.Series) -> pd.Series:
+    """Previous approach: text conversion and five string passes over every value."""
+    s = series.astype(str).str.strip()
+    s = s.str.replace("$", "", regex=False).str.replace("ARS", "", regex=False).str.strip()
+    has_comma = s.str.contains(",", regex=False)
+    s = s.where(~has_comma, s.str.replace(".", "", regex=False).str.replace(",", ".", regex=False))
+    return pd.to_numeric(s, errors="coerce")
+
+
+def generar(filas: int, seed: int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    costo = np.round(rng.uniform(100, 90000, filas), 2)
+    stock = rng.integers(0, 50, filas)
+    texto_ar = pd.Series(costo).map(lambda v: f"{v:,.2f}".replace(",", "_").replace(".", ",").replace("_", "."))
+    return {
+        "float64": pd.Series(costo),
+        "int64": pd.Series(stock),
+        "texto plano": pd.Series(stock.astype(str), dtype=object),
+        "texto AR": texto_ar.astype(object),
+        "mixto": pd.Series(np.where(rng.random(filas) < 0.5, costo.astype(object), texto_ar.to_numpy(dtype=object)), dtype=object),
+    }
+
+
+def medir(fn, *args, repeticiones: int = 3) -> float:
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        fn(*args)
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos)
+
+
+def main():
+    filas = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(f"{'entrada':>12} {'filas':>9} {'actual (s)':>11} {'anterior (s)':>13} {'x':>8}")
+    for nombre, serie in generar(filas).items():
+        pd.testing.assert_series_equal(parse_ar_number(serie), parse_anterior(serie), check_exact=False, rtol=1e-15)
+        actual = medir(parse_ar_number, serie)
+        anterior = medir(parse_anterior, serie, repeticiones=1)
+        print(f"{nombre:>12} {filas:>9} {actual:>11.3f} {anterior:>13.3f} {anterior / actual:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
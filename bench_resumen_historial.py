@@ -0,0 +1,76 @@
+"""
+Benchmark del resumen de Historial: una lectura de detalle agrupada vs. una carga por inventario.
+
+Uso: python bench_resumen_historial.py [filas_por_inventario]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from calculos_inventario import (
+    C_ART,
+    C_COSTO,
+    C_LOC,
+    C_STOCK,
+    calcular_resultados_inventario,
+    resumir_historial,
+)
+
+
+def generar(n_inventarios: int, filas: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    ids = np.repeat([f"INV-2026{i:05d}" for i in range(n_inventarios)], filas)
+    stock = rng.integers(0, 20, ids.size)
+    ajuste = rng.choice([0, 0, 0, -1, 1, -2], ids.size)
+    df_det = pd.DataFrame({
+        "ID_Inventario": ids,
+        C_LOC: [f"L-{i % 40:02d}" for i in range(ids.size)],
+        C_ART: rng.integers(100000, 999999, ids.size).astype(str),
+        C_STOCK: stock,
+        C_COSTO: np.round(rng.uniform(100, 90000, ids.size), 2),
+        "Diferencia": ajuste,
+        "Tipo_Ajuste": np.where(ajuste != 0, "Ajuste", ""),
+        "Ajuste_Cantidad": ajuste,
+    })
+    df_hist = pd.DataFrame({
+        "ID_Inventario": [f"INV-2026{i:05d}" for i in range(n_inventarios)],
+        "Fecha": "2026-01-01 10:00",
+        "Cierre_Fecha": [f"2026-02-{1 + i % 28:02d} 10:00" for i in range(n_inventarios)],
+        "Sucursal": "Ax Jujuy",
+        "Estado": "Cerrado",
+    })
+    return df_hist, df_det
+
+
+def por_inventario(df_hist: pd.DataFrame, df_det: pd.DataFrame) -> list:
+    """Previous approach: filter the whole detail and recompute once per closed inventory."""
+    resumen = []
+    for id_inv in df_hist["ID_Inventario"].astype(str):
+        detalle = df_det[df_det["ID_Inventario"].astype(str) == id_inv].copy()
+        resumen.append(calcular_resultados_inventario(detalle).get("grado", 0))
+    return resumen
+
+
+def medir(fn, *args, repeticiones: int = 3) -> float:
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        fn(*args)
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos)
+
+
+def main():
+    filas = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"{'inventarios':>11} {'filas detalle':>13} {'agrupado (s)':>13} {'por inventario (s)':>19} {'ms/inv agrupado':>16}")
+    for n in [25, 50, 100, 200, 400]:
+        df_hist, df_det = generar(n, filas)
+        agrupado = medir(resumir_historial, df_hist, df_det)
+        anterior = medir(por_inventario, df_hist, df_det, repeticiones=1)
+        print(f"{n:>11} {len(df_det):>13} {agrupado:>13.3f} {anterior:>19.3f} {agrupado / n * 1000:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
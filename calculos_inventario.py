@@ -0,0 +1,1221 @@
+"""
+Cálculos de resultados de inventario (sin dependencias de Streamlit)
+"""
+import hashlib
+import json
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Columnas esperadas del Excel
+C_ART = "Artículo"
+C_LOC = "Locación"
+C_DESC = "Descripción"
+C_STOCK = "Stock"
+C_COSTO = "Cto.Rep."
+
+ESCALA_GRADO = [(0.00, 100), (0.10, 94), (0.80, 82), (1.60, 65), (2.40, 35), (3.30, 0)]
+
+CANJE_MOVIMIENTO_COLUMNAS = [
+    "Origen",
+    "Tipo Movimiento",
+    "Artículo",
+    "Descripción",
+    "Locación",
+    "Stock Base",
+    "Cantidad",
+    "Costo Unitario",
+    "Valor Total",
+]
+
+_AR_NUMERO = r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$"
+_AR_ENTERO = r"^[+-]?\d+$"
+
+def parse_ar_number(series: pd.Series) -> pd.Series:
+    """Parse numbers that may use Argentine formatting (1.234,56).
+
+    int and float64 columns are returned as they are. Text is cleaned with Arrow string kernels and
+    plain decimal literals are cast in C; only the few values outside that grammar ("inf", "1e5 x")
+    still go through pd.to_numeric. The result dtype follows pd.to_numeric (int64 only when every
+    value is an integer).
+    """
+    if isinstance(series.dtype, np.dtype) and (series.dtype.kind in "iu" or series.dtype == np.float64):
+        return series.copy()
+
+    texto = pc.utf8_trim_whitespace(pa.array(series.astype(str), type=pa.string(), from_pandas=True))
+    texto = pc.utf8_trim_whitespace(pc.replace_substring(pc.replace_substring(texto, "$", ""), "ARS", ""))
+    sin_miles = pc.replace_substring(pc.replace_substring(texto, ".", ""), ",", ".")
+    texto = pc.if_else(pc.match_substring(texto, ","), sin_miles, texto)
+
+    valido = pc.fill_null(pc.match_substring_regex(texto, _AR_NUMERO), False)
+    enteros = pc.fill_null(pc.match_substring_regex(texto, _AR_ENTERO), False)
+    if pc.all(enteros, min_count=0).as_py():
+        try:
+            return pd.Series(pc.cast(texto, pa.int64()).to_numpy(), index=series.index, name=series.name)
+        except pa.ArrowInvalid:
+            return pd.Series(pd.to_numeric(texto.to_pandas(), errors="coerce").to_numpy(), index=series.index, name=series.name)
+
+    numeros = np.full(len(texto), np.nan)
+    mascara = valido.to_numpy(zero_copy_only=False)
+    numeros[mascara] = pc.cast(pc.filter(texto, valido), pa.float64()).to_numpy()
+    resto = ~mascara & pc.fill_null(pc.not_equal(texto, ""), False).to_numpy(zero_copy_only=False)
+    if resto.any():
+        numeros[resto] = pd.to_numeric(pc.filter(texto, pa.array(resto)).to_pandas(), errors="coerce").astype(float).to_numpy()
+    return pd.Series(numeros, index=series.index, name=series.name)
+
+def format_ar_series(valores, decimals: int = 2, prefix: str = "") -> pd.Series:
+    """Vectorized Argentine formatting (1.234,56) of numeric values, nulls as "".
+
+    Same text as f"{x:,.{decimals}f}" with swapped separators for every value. Scaled values within a
+    float ulp of a rounding tie, or too large for exact int64 math, take that exact per-value path.
+    """
+    serie = valores if isinstance(valores, pd.Series) else pd.Series(valores)
+    x = pd.to_numeric(serie, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    escalado = np.abs(x) * 10.0 ** decimals
+    with np.errstate(invalid="ignore"):
+        tolerancia = np.maximum(1e-9, 8 * np.spacing(escalado))
+        empate = np.abs(escalado - np.floor(escalado) - 0.5) <= tolerancia
+        rapido = np.isfinite(escalado) & (escalado < 2.0 ** 52) & ~empate
+    nulo = np.isnan(x)
+    lento = ~rapido & ~nulo
+
+    unidades = np.round(np.where(rapido, escalado, 0)).astype(np.int64)
+    enteros = pd.Series(unidades // 10 ** decimals, index=serie.index).astype(str).str.replace(r"\B(?=(\d{3})+$)", ".", regex=True)
+    if decimals > 0:
+        enteros = enteros + "," + pd.Series(unidades % 10 ** decimals, index=serie.index).astype(str).str.zfill(decimals)
+    texto = pd.Series(np.where(np.signbit(x), "-", ""), index=serie.index) + enteros
+
+    texto = texto.astype(object)
+    if lento.any():
+        texto[lento] = [f"{v:,.{decimals}f}".replace(",", "_").replace(".", ",").replace("_", ".") for v in x[lento]]
+    if prefix:
+        texto = prefix + texto
+    texto[nulo] = ""
+    return texto
+
+def normalize_article_code(value) -> str:
+    if pd.isna(value):
+        return ""
+    code = str(value).strip()
+    if not code:
+        return ""
+    if code.endswith(".0"):
+        base = code[:-2]
+        if base.isdigit():
+            return base
+    return code
+
+def normalize_article_codes(values) -> pd.Series:
+    """Vectorized normalize_article_code over a whole column (index preserved)."""
+    serie = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+    codigos = serie.astype(object).where(serie.notna(), "").astype(str).str.strip()
+    base = codigos.str[:-2]
+    entero = codigos.str.endswith(".0") & base.str.isdigit()
+    return codigos.where(~entero, base)
+
+def grado_por_escala(pct_absoluto: np.ndarray, escala=ESCALA_GRADO) -> np.ndarray:
+    """Grado of the highest escala threshold reached by each % absoluto (0 below the first one)."""
+    escala_sorted = sorted(escala, key=lambda x: x[0])
+    umbrales = np.array([th for th, _ in escala_sorted], dtype=float)
+    grados = np.array([0] + [g for _, g in escala_sorted])
+    return grados[np.searchsorted(umbrales, np.asarray(pct_absoluto, dtype=float), side="right")]
+
+def _columna(df: pd.DataFrame, col: str, default) -> pd.Series:
+    """Column as object Series, or a constant Series when the column is missing (like row.get)."""
+    if col in df.columns:
+        return df[col].astype(object)
+    return pd.Series([default] * len(df), index=df.index, dtype=object)
+
+def _columna_o(df: pd.DataFrame, col: str, respaldo: pd.Series) -> pd.Series:
+    return df[col].astype(object) if col in df.columns else respaldo
+
+def _numerico(valores: pd.Series) -> pd.Series:
+    return pd.to_numeric(valores, errors="coerce")
+
+def construir_movimientos_canje(df_det: pd.DataFrame, conservar: list[str] | None = None) -> pd.DataFrame:
+    """Canje movement table: an original and a canje row per Principal/Adicional canje, in detail order.
+
+    `conservar` detail columns (e.g. ID_Inventario) are copied, first, onto both movement rows.
+    """
+    conservar = [c for c in (conservar or []) if c in df_det.columns]
+    if df_det.empty:
+        return pd.DataFrame(columns=conservar + CANJE_MOVIMIENTO_COLUMNAS)
+
+    df = df_det.reset_index(drop=True)
+    orden = pd.Series(np.arange(len(df)), index=df.index)
+    articulo = _columna(df, C_ART, "")
+    descripcion = _columna(df, C_DESC, "")
+    locacion = _columna(df, C_LOC, "")
+    stock = parse_ar_number(_columna(df, C_STOCK, 0)).fillna(0)
+    costo_raw = _columna(df, C_COSTO, 0)
+    costo = _numerico(costo_raw)
+
+    partes = []
+    for suffix, origen, paso in [("", "Principal", 0), ("_Adicional", "Adicional", 2)]:
+        mask = _columna(df, f"Tipo_Ajuste{suffix}", "").astype(str) == "Canje"
+        if not mask.any():
+            continue
+
+        ajuste_raw = _columna(df, f"Ajuste_Cantidad{suffix}", 0)
+        ajuste = _numerico(ajuste_raw)
+        original = pd.DataFrame({
+            "Origen": origen,
+            "Tipo Movimiento": "Artículo original",
+            "Artículo": articulo,
+            "Descripción": descripcion,
+            "Locación": locacion,
+            "Stock Base": stock,
+            "Cantidad": ajuste,
+            "Costo Unitario": costo,
+            "Valor Total": ajuste * costo,
+            "_orden": orden,
+            "_paso": paso,
+            **{c: df[c] for c in conservar},
+        })[mask]
+
+        canje_art = _columna(df, f"Canje_Articulo{suffix}", "")
+        art_vacio = ~canje_art.to_numpy(dtype=object).astype(bool)
+        costo_canje = _numerico(_columna_o(df, f"Canje_Costo_Rep{suffix}", costo_raw))
+        ajuste_canje = _numerico(_columna_o(df, f"Canje_Ajuste_Cantidad{suffix}", ajuste_raw))
+        canje = pd.DataFrame({
+            "Origen": origen,
+            "Tipo Movimiento": "Artículo de canje",
+            "Artículo": canje_art.where(~art_vacio, articulo),
+            "Descripción": _columna(df, f"Canje_Descripcion{suffix}", ""),
+            "Locación": _columna_o(df, f"Canje_Locacion{suffix}", locacion),
+            "Stock Base": _numerico(_columna(df, f"Canje_Stock_Base{suffix}", 0)),
+            "Cantidad": ajuste_canje,
+            "Costo Unitario": costo_canje,
+            "Valor Total": ajuste_canje * costo_canje,
+            "_orden": orden,
+            "_paso": paso + 1,
+            **{c: df[c] for c in conservar},
+        })[mask]
+        partes.extend([original, canje])
+
+    if not partes:
+        return pd.DataFrame(columns=conservar + CANJE_MOVIMIENTO_COLUMNAS)
+    movimientos = pd.concat(partes, ignore_index=True).sort_values(["_orden", "_paso"], kind="stable")
+    return movimientos[conservar + CANJE_MOVIMIENTO_COLUMNAS].reset_index(drop=True)
+
+def calcular_resultados_inventario(df_det: pd.DataFrame) -> dict:
+    """Calculate inventory results based on Auditor adjustments.
+    - Muestra Q & $ Ajuste: sum of ALL articles in sample (no filter)
+    - Faltantes/Sobrantes/etc: only rows where Tipo_Ajuste = "Ajuste"
+    - %: always over total muestra valuation
+    """
+    if df_det.empty:
+        return {"canjes": []}
+
+    if C_STOCK not in df_det.columns or C_COSTO not in df_det.columns:
+        return {"canjes": []}
+
+    stock = parse_ar_number(df_det[C_STOCK]).fillna(0).to_numpy(dtype=float)
+    costo = parse_ar_number(df_det[C_COSTO]).fillna(0).to_numpy(dtype=float)
+
+    # MUESTRA: sum of ALL articles (no filter)
+    cant_muestra = int(stock.sum())
+    valor_muestra = (stock * costo).sum()
+    pct_muestra = 100.0
+
+    # Movement set for quantitative calculations using all adjustments (principal + adicionales).
+    ajustes, costos = [], []
+    for suffix in ["", "_Adicional"]:
+        tipo_col = f"Tipo_Ajuste{suffix}"
+        if tipo_col not in df_det.columns:
+            continue
+        mask = (df_det[tipo_col].astype(str) == "Ajuste").to_numpy()
+        if not mask.any():
+            continue
+        cant_col = f"Ajuste_Cantidad{suffix}"
+        cantidad = pd.to_numeric(df_det[cant_col], errors="coerce").fillna(0).to_numpy(dtype=float) if cant_col in df_det.columns else np.zeros(len(df_det))
+        ajustes.append(cantidad[mask])
+        costos.append(costo[mask])
+
+    # If no adjustments, return results with 0 differences
+    if not ajustes:
+        return {
+            "cant_muestra": cant_muestra,
+            "valor_muestra": valor_muestra,
+            "pct_muestra": pct_muestra,
+            "cant_faltantes": 0,
+            "valor_faltantes": 0,
+            "pct_faltantes": 0,
+            "cant_sobrantes": 0,
+            "valor_sobrantes": 0,
+            "pct_sobrantes": 0,
+            "cant_dif_neta": 0,
+            "valor_dif_neta": 0,
+            "pct_dif_neta": 0,
+            "cant_dif_absoluta": 0,
+            "valor_dif_absoluta": 0,
+            "pct_dif_absoluta": 0,
+            "pct_absoluto": 0,
+            "grado": 100,
+            "escala": list(ESCALA_GRADO),
+            "canjes": []
+        }
+
+    ajuste = np.concatenate(ajustes)
+    costo_mov = np.concatenate(costos)
+
+    def pct(valor):
+        return (valor / valor_muestra * 100) if valor_muestra > 0 else 0
+
+    # Faltantes (negative adjustments) / Sobrantes (positive adjustments)
+    mask_falt = ajuste < 0
+    cant_faltantes = int(np.abs(ajuste[mask_falt]).sum())
+    valor_faltantes = (np.abs(ajuste[mask_falt]) * costo_mov[mask_falt]).sum()
+    mask_sobr = ajuste > 0
+    cant_sobrantes = int(ajuste[mask_sobr].sum())
+    valor_sobrantes = (ajuste[mask_sobr] * costo_mov[mask_sobr]).sum()
+
+    # Diferencia neta y absoluta
+    cant_dif_neta = int(ajuste.sum())
+    valor_dif_neta = (ajuste * costo_mov).sum()
+    cant_dif_absoluta = int(np.abs(ajuste).sum())
+    valor_dif_absoluta = (np.abs(ajuste) * costo_mov).sum()
+
+    # Escala de grado basada en % absoluto
+    pct_absoluto = pct(valor_dif_absoluta)
+    escala_sorted = sorted(ESCALA_GRADO, key=lambda x: x[0])
+    grado = int(grado_por_escala(np.array([pct_absoluto]))[0])
+
+    return {
+        "cant_muestra": cant_muestra,
+        "valor_muestra": valor_muestra,
+        "pct_muestra": pct_muestra,
+        "cant_faltantes": cant_faltantes,
+        "valor_faltantes": valor_faltantes,
+        "pct_faltantes": pct(valor_faltantes),
+        "cant_sobrantes": cant_sobrantes,
+        "valor_sobrantes": valor_sobrantes,
+        "pct_sobrantes": pct(valor_sobrantes),
+        "cant_dif_neta": cant_dif_neta,
+        "valor_dif_neta": valor_dif_neta,
+        "pct_dif_neta": pct(valor_dif_neta),
+        "cant_dif_absoluta": cant_dif_absoluta,
+        "valor_dif_absoluta": valor_dif_absoluta,
+        "pct_dif_absoluta": pct(valor_dif_absoluta),
+        "pct_absoluto": pct_absoluto,
+        "grado": grado,
+        "escala": escala_sorted,
+        "canjes": construir_movimientos_canje(df_det).to_dict("records"),
+    }
+
+RESULTADOS_COLUMNAS = [
+    "cant_muestra",
+    "valor_muestra",
+    "pct_muestra",
+    "cant_faltantes",
+    "valor_faltantes",
+    "pct_faltantes",
+    "cant_sobrantes",
+    "valor_sobrantes",
+    "pct_sobrantes",
+    "cant_dif_neta",
+    "valor_dif_neta",
+    "pct_dif_neta",
+    "cant_dif_absoluta",
+    "valor_dif_absoluta",
+    "pct_dif_absoluta",
+    "pct_absoluto",
+    "grado",
+]
+
+def calcular_resultados_por_inventario(df_det: pd.DataFrame, id_col: str = "ID_Inventario") -> pd.DataFrame:
+    """Results of every inventory in `df_det` at once, one row per `id_col` value.
+
+    Same metrics as calcular_resultados_inventario (without canjes), computed with one groupby over
+    the whole detail. Inventories without adjustments get zero differences and grado 100.
+    """
+    if df_det.empty or id_col not in df_det.columns or C_STOCK not in df_det.columns or C_COSTO not in df_det.columns:
+        return pd.DataFrame(columns=RESULTADOS_COLUMNAS, index=pd.Index([], name=id_col))
+
+    ids = df_det[id_col].to_numpy()
+    stock = parse_ar_number(df_det[C_STOCK]).fillna(0).to_numpy(dtype=float)
+    costo = parse_ar_number(df_det[C_COSTO]).fillna(0).to_numpy(dtype=float)
+    muestra = pd.DataFrame({id_col: ids, "stock": stock, "valor": stock * costo}).groupby(id_col).sum()
+
+    movimientos = []
+    for suffix in ["", "_Adicional"]:
+        tipo_col = f"Tipo_Ajuste{suffix}"
+        if tipo_col not in df_det.columns:
+            continue
+        mask = (df_det[tipo_col].astype(str) == "Ajuste").to_numpy()
+        cant_col = f"Ajuste_Cantidad{suffix}"
+        cantidad = pd.to_numeric(df_det[cant_col], errors="coerce").fillna(0).to_numpy(dtype=float) if cant_col in df_det.columns else np.zeros(len(df_det))
+        movimientos.append(pd.DataFrame({id_col: ids[mask], "ajuste": cantidad[mask], "costo": costo[mask]}))
+
+    mov = pd.concat(movimientos, ignore_index=True) if movimientos else pd.DataFrame(columns=[id_col, "ajuste", "costo"])
+    ajuste = mov["ajuste"].to_numpy(dtype=float)
+    falt = np.where(ajuste < 0, -ajuste, 0.0)
+    sobr = np.where(ajuste > 0, ajuste, 0.0)
+    sumas = pd.DataFrame({
+        id_col: mov[id_col].to_numpy(),
+        "cant_faltantes": falt,
+        "valor_faltantes": falt * mov["costo"].to_numpy(dtype=float),
+        "cant_sobrantes": sobr,
+        "valor_sobrantes": sobr * mov["costo"].to_numpy(dtype=float),
+        "cant_dif_neta": ajuste,
+        "valor_dif_neta": ajuste * mov["costo"].to_numpy(dtype=float),
+        "cant_dif_absoluta": np.abs(ajuste),
+        "valor_dif_absoluta": np.abs(ajuste) * mov["costo"].to_numpy(dtype=float),
+    }).groupby(id_col).sum()
+
+    res = pd.DataFrame(index=muestra.index)
+    res["cant_muestra"] = np.trunc(muestra["stock"]).astype(int)
+    res["valor_muestra"] = muestra["valor"]
+    res["pct_muestra"] = 100.0
+    sumas = sumas.reindex(res.index).fillna(0.0)
+    valor_muestra = res["valor_muestra"].to_numpy(dtype=float)
+    divisor = np.where(valor_muestra > 0, valor_muestra, np.nan)
+    for base in ["faltantes", "sobrantes", "dif_neta", "dif_absoluta"]:
+        res[f"cant_{base}"] = np.trunc(sumas[f"cant_{base}"]).astype(int)
+        res[f"valor_{base}"] = sumas[f"valor_{base}"]
+        res[f"pct_{base}"] = np.nan_to_num(sumas[f"valor_{base}"].to_numpy(dtype=float) / divisor * 100, nan=0.0)
+    res["pct_absoluto"] = res["pct_dif_absoluta"]
+    res["grado"] = grado_por_escala(res["pct_absoluto"].to_numpy())
+    return res[RESULTADOS_COLUMNAS]
+
+# Resultado -> columna materializada en Historial al cerrar
+CIERRE_COLUMNAS = {
+    "cant_muestra": "Cierre_Muestra_Q",
+    "valor_muestra": "Cierre_Valor_Muestra",
+    "cant_faltantes": "Cierre_Faltantes_Q",
+    "valor_faltantes": "Cierre_Valor_Faltantes",
+    "pct_faltantes": "Cierre_Pct_Faltantes",
+    "cant_sobrantes": "Cierre_Sobrantes_Q",
+    "valor_sobrantes": "Cierre_Valor_Sobrantes",
+    "pct_sobrantes": "Cierre_Pct_Sobrantes",
+    "cant_dif_neta": "Cierre_Dif_Neta_Q",
+    "valor_dif_neta": "Cierre_Valor_Dif_Neta",
+    "pct_dif_neta": "Cierre_Pct_Dif_Neta",
+    "cant_dif_absoluta": "Cierre_Dif_Absoluta_Q",
+    "valor_dif_absoluta": "Cierre_Valor_Dif_Absoluta",
+    "pct_dif_absoluta": "Cierre_Pct_Dif_Absoluta",
+    "grado": "Cierre_Exactitud",
+}
+
+def checksum_detalle(df_det: pd.DataFrame) -> str:
+    """SHA-256 of an inventory detail, stable across storage round-trips.
+
+    Columns are taken in name order and fully empty columns are ignored (they appear when other
+    inventories add columns to the shared sheet). Values are compared as text with nulls as "" and
+    integral floats without the ".0" suffix, so 4 and 4.0 hash the same.
+    """
+    if df_det is None or df_det.empty:
+        return hashlib.sha256(b"").hexdigest()
+
+    df = df_det.drop(columns=["__row_pos__"], errors="ignore")
+    df = df.astype(object).where(df.notna(), "").astype(str)
+    df = df.apply(lambda col: col.str.strip().str.replace(r"^(-?\d+)\.0+$", r"\1", regex=True))
+    df = df.loc[:, (df != "").any(axis=0)]
+    df = df[sorted(df.columns)]
+
+    digest = hashlib.sha256("\x1f".join(df.columns).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def materializar_cierre(df_det: pd.DataFrame, resultados: dict | None = None) -> dict:
+    """Cierre_* values (results, line count and detail checksum) stored in Historial at close.
+
+    Returns {} without detail rows: a zero-valued snapshot would hide that the results are unknown.
+    """
+    if df_det is None or df_det.empty:
+        return {}
+    if resultados is None:
+        resultados = calcular_resultados_inventario(df_det)
+    cierre = {"Cierre_Lineas": len(df_det)}
+    cierre.update({col: resultados.get(clave, 0) for clave, col in CIERRE_COLUMNAS.items()})
+    cierre["Cierre_Checksum"] = checksum_detalle(df_det)
+    return cierre
+
+def resultados_desde_cierre(fila) -> dict | None:
+    """Results dict rebuilt from a Historial row's Cierre_* snapshot, or None when it is incomplete."""
+    if not str(fila.get("Cierre_Checksum", "") or "").strip():
+        return None
+    valores = pd.to_numeric(pd.Series({clave: fila.get(col, np.nan) for clave, col in CIERRE_COLUMNAS.items()}), errors="coerce")
+    if valores.isna().any():
+        return None
+
+    resultados = {clave: float(valor) for clave, valor in valores.items()}
+    for clave in [c for c in CIERRE_COLUMNAS if c.startswith("cant_")] + ["grado"]:
+        resultados[clave] = int(resultados[clave])
+    resultados["pct_muestra"] = 100.0
+    resultados["pct_absoluto"] = resultados["pct_dif_absoluta"]
+    resultados["escala"] = sorted(ESCALA_GRADO, key=lambda x: x[0])
+    return resultados
+
+RESUMEN_HISTORIAL_METRICAS = {
+    "Muestra Q": "cant_muestra",
+    "Valor Muestra": "valor_muestra",
+    "Faltantes Q": "cant_faltantes",
+    "Sobrantes Q": "cant_sobrantes",
+    "Dif Neta Q": "cant_dif_neta",
+    "Dif Absoluta Q": "cant_dif_absoluta",
+    "Valor Dif Absoluta": "valor_dif_absoluta",
+    "Exactitud": "grado",
+}
+
+def _metricas_cierre(df_hist: pd.DataFrame) -> pd.DataFrame:
+    return pd.DataFrame({
+        clave: pd.to_numeric(df_hist[col], errors="coerce") if col in df_hist.columns else np.nan
+        for clave, col in CIERRE_COLUMNAS.items()
+    }, index=df_hist.index)
+
+def filas_con_snapshot(df_hist: pd.DataFrame) -> pd.Series:
+    """Vectorized resultados_desde_cierre(fila) is not None over Historial rows."""
+    if df_hist.empty or "Cierre_Checksum" not in df_hist.columns:
+        return pd.Series(False, index=df_hist.index)
+    checksum = df_hist["Cierre_Checksum"].fillna("").astype(str).str.strip()
+    return (checksum != "") & _metricas_cierre(df_hist).notna().all(axis=1)
+
+def resumir_historial(df_hist_cerrados: pd.DataFrame, df_det: pd.DataFrame | None) -> pd.DataFrame:
+    """History summary of closed inventories, one row each, newest close first.
+
+    Inventories with a closing snapshot take their metrics from the Cierre_* columns. The rest are
+    computed from `df_det` (the whole detail sheet, read once) with a single grouped pass, so the
+    cost grows with total detail rows rather than inventories x rows.
+    """
+    if df_hist_cerrados is None or df_hist_cerrados.empty:
+        return pd.DataFrame()
+
+    hist = df_hist_cerrados.reset_index(drop=True)
+    vacio = pd.Series([""] * len(hist), index=hist.index, dtype=object)
+    ids = hist["ID_Inventario"].astype(str) if "ID_Inventario" in hist.columns else vacio
+
+    snapshot = _metricas_cierre(hist)
+    checksum = hist["Cierre_Checksum"].fillna("").astype(str).str.strip() if "Cierre_Checksum" in hist.columns else vacio
+    con_snapshot = filas_con_snapshot(hist)
+
+    calculado = pd.DataFrame(np.nan, index=hist.index, columns=list(CIERRE_COLUMNAS))
+    lineas = pd.to_numeric(hist["Cierre_Lineas"], errors="coerce") if "Cierre_Lineas" in hist.columns else pd.Series(np.nan, index=hist.index)
+    lineas = lineas.where(con_snapshot)
+    pendientes = ids[~con_snapshot]
+    if not pendientes.empty and df_det is not None and not df_det.empty and "ID_Inventario" in df_det.columns:
+        claves = df_det["ID_Inventario"].astype(str)
+        df_sel = df_det[claves.isin(set(pendientes))].assign(ID_Inventario=claves)
+        resultados = calcular_resultados_por_inventario(df_sel)
+        calculado.loc[~con_snapshot] = resultados.reindex(pendientes.to_numpy())[list(CIERRE_COLUMNAS)].to_numpy()
+        lineas = lineas.fillna(pendientes.map(df_sel.groupby("ID_Inventario").size()))
+
+    metricas = snapshot.where(con_snapshot, calculado)
+    respaldo = snapshot.fillna(0)
+    resumen = pd.DataFrame({
+        "ID_Inventario": ids,
+        "Fecha": hist.get("Fecha", vacio),
+        "Cierre_Fecha": hist.get("Cierre_Fecha", vacio),
+        "Concesionaria": hist.get("Concesionaria", vacio),
+        "Sucursal": hist.get("Sucursal", vacio),
+        "Auditor": hist.get("Auditor", vacio),
+        "Cierre_Usuario": hist.get("Cierre_Usuario", vacio),
+        "Lineas": lineas.fillna(0).astype(int),
+    })
+    for columna, clave in RESUMEN_HISTORIAL_METRICAS.items():
+        valores = metricas[clave].fillna(respaldo[clave])
+        resumen[columna] = valores.astype(int) if clave.startswith("cant_") or clave == "grado" else valores.astype(float)
+    resumen["Snapshot"] = np.where(checksum != "", "Sí", "No")
+
+    if "Cierre_Fecha" in resumen.columns:
+        resumen = resumen.sort_values("Cierre_Fecha", ascending=False)
+    return resumen
+
+# KPIs de dashboards: una fila por inventario más acumulados por nivel
+KPI_NIVEL_INVENTARIO = "inventario"
+KPI_ADITIVOS = [
+    "Inventarios",
+    "Abiertos",
+    "Cerrados",
+    "Con_Detalle",
+    "Lineas",
+    "Lineas_Diferencia",
+    "Valuacion",
+    "Valor_Dif_Absoluta",
+    "Suma_Exactitud",
+]
+KPI_COLUMNAS = ["Nivel", "Clave", "ID_Inventario", "Concesionaria", "Sucursal", "Mes", "Estado", "Exactitud", *KPI_ADITIVOS]
+
+def _mes(fecha) -> str:
+    fecha = pd.to_datetime(pd.Series([fecha]), errors="coerce").iloc[0]
+    return "" if pd.isna(fecha) else fecha.strftime("%Y-%m")
+
+def kpi_inventario(fila_hist, df_det: pd.DataFrame, resultados: dict | None = None) -> dict:
+    """Inventory-level KPI row from its Historial row and detail.
+
+    Closed inventories with a snapshot use Cierre_Exactitud; otherwise grado is computed from detail.
+    Only closed inventories are bucketed by month (of Cierre_Fecha).
+    """
+    estado = str(fila_hist.get("Estado", "") or "").strip().lower()
+    lineas = len(df_det)
+    if lineas:
+        stock = parse_ar_number(df_det[C_STOCK]).fillna(0) if C_STOCK in df_det.columns else pd.Series(0.0, index=df_det.index)
+        costo = parse_ar_number(df_det[C_COSTO]).fillna(0) if C_COSTO in df_det.columns else pd.Series(0.0, index=df_det.index)
+        diferencia = parse_ar_number(df_det["Diferencia"]).fillna(0) if "Diferencia" in df_det.columns else pd.Series(0.0, index=df_det.index)
+        valuacion = float((stock * costo).sum())
+        lineas_dif = int((diferencia != 0).sum())
+    else:
+        valuacion, lineas_dif = 0.0, 0
+
+    snapshot = resultados_desde_cierre(fila_hist) if estado == "cerrado" else None
+    if snapshot is None:
+        snapshot = resultados if resultados is not None else (calcular_resultados_inventario(df_det) if lineas else {})
+    exactitud = float(snapshot.get("grado", 0)) if lineas else 0.0
+
+    return {
+        "Nivel": KPI_NIVEL_INVENTARIO,
+        "Clave": str(fila_hist.get("ID_Inventario", "")),
+        "ID_Inventario": str(fila_hist.get("ID_Inventario", "")),
+        "Concesionaria": str(fila_hist.get("Concesionaria", "") or ""),
+        "Sucursal": str(fila_hist.get("Sucursal", "") or ""),
+        "Mes": _mes(fila_hist.get("Cierre_Fecha", "")) if estado == "cerrado" else "",
+        "Estado": estado,
+        "Exactitud": exactitud,
+        "Inventarios": 1,
+        "Abiertos": int(estado == "abierto"),
+        "Cerrados": int(estado == "cerrado"),
+        "Con_Detalle": int(lineas > 0),
+        "Lineas": lineas,
+        "Lineas_Diferencia": lineas_dif,
+        "Valuacion": valuacion,
+        "Valor_Dif_Absoluta": float(snapshot.get("valor_dif_absoluta", 0) or 0) if lineas else 0.0,
+        "Suma_Exactitud": exactitud,
+    }
+
+def _claves_acumuladas(fila: dict) -> list[tuple]:
+    claves = [
+        ("global", "Total", {}),
+        ("sucursal", fila["Sucursal"], {"Sucursal": fila["Sucursal"]}),
+        ("concesionaria", fila["Concesionaria"], {"Concesionaria": fila["Concesionaria"]}),
+    ]
+    if fila["Estado"] == "cerrado" and fila["Mes"]:
+        claves.append((
+            "mes",
+            f"{fila['Mes']}|{fila['Concesionaria']}|{fila['Sucursal']}",
+            {"Mes": fila["Mes"], "Concesionaria": fila["Concesionaria"], "Sucursal": fila["Sucursal"]},
+        ))
+    return claves
+
+def actualizar_kpis(df_kpi: pd.DataFrame, nueva: dict) -> pd.DataFrame:
+    """Upsert one inventory KPI row and apply the old->new delta to every affected rollup row."""
+    df_kpi = pd.DataFrame(columns=KPI_COLUMNAS) if df_kpi is None or df_kpi.empty else df_kpi.reindex(columns=KPI_COLUMNAS)
+    df_kpi[KPI_ADITIVOS] = df_kpi[KPI_ADITIVOS].apply(pd.to_numeric, errors="coerce").fillna(0)
+    clave = (df_kpi["Nivel"].astype(str) + "\x1f" + df_kpi["Clave"].astype(str)).tolist()
+    posiciones = {k: i for i, k in enumerate(clave)}
+    filas = df_kpi.to_dict("records")
+
+    def sumar(nivel, clave_nivel, campos, fila, signo):
+        clave_fila = f"{nivel}\x1f{clave_nivel}"
+        if clave_fila not in posiciones:
+            posiciones[clave_fila] = len(filas)
+            filas.append({**{c: "" for c in KPI_COLUMNAS}, **{c: 0 for c in KPI_ADITIVOS}, "Nivel": nivel, "Clave": clave_nivel, **campos})
+        destino = filas[posiciones[clave_fila]]
+        for col in KPI_ADITIVOS:
+            destino[col] = destino[col] + signo * fila[col]
+
+    clave_inv = f"{KPI_NIVEL_INVENTARIO}\x1f{nueva['Clave']}"
+    if clave_inv in posiciones:
+        anterior = filas[posiciones[clave_inv]]
+        for nivel, clave_nivel, campos in _claves_acumuladas(anterior):
+            sumar(nivel, clave_nivel, campos, anterior, -1)
+        filas[posiciones[clave_inv]] = dict(nueva)
+    else:
+        posiciones[clave_inv] = len(filas)
+        filas.append(dict(nueva))
+    for nivel, clave_nivel, campos in _claves_acumuladas(nueva):
+        sumar(nivel, clave_nivel, campos, nueva, 1)
+
+    df = pd.DataFrame(filas, columns=KPI_COLUMNAS)
+    vacias = (df["Nivel"] != KPI_NIVEL_INVENTARIO) & (df["Inventarios"] <= 0)
+    return df.loc[~vacias].reset_index(drop=True)
+
+def reconstruir_kpis(df_hist: pd.DataFrame, df_det: pd.DataFrame) -> pd.DataFrame:
+    """Full rebuild of the KPI table from Historial and the whole detail (one grouped pass)."""
+    if df_hist is None or df_hist.empty or "ID_Inventario" not in df_hist.columns:
+        return pd.DataFrame(columns=KPI_COLUMNAS)
+
+    hist = df_hist.drop_duplicates("ID_Inventario", keep="last").reset_index(drop=True)
+    ids = hist["ID_Inventario"].astype(str)
+    vacio = pd.Series([""] * len(hist), index=hist.index, dtype=object)
+    estado = hist.get("Estado", vacio).fillna("").astype(str).str.strip().str.lower()
+
+    if df_det is not None and not df_det.empty and "ID_Inventario" in df_det.columns:
+        claves = df_det["ID_Inventario"].astype(str)
+        stock = parse_ar_number(df_det[C_STOCK]).fillna(0) if C_STOCK in df_det.columns else 0.0
+        costo = parse_ar_number(df_det[C_COSTO]).fillna(0) if C_COSTO in df_det.columns else 0.0
+        diferencia = parse_ar_number(df_det["Diferencia"]).fillna(0) if "Diferencia" in df_det.columns else pd.Series(0.0, index=df_det.index)
+        por_id = pd.DataFrame({"Lineas": 1, "Lineas_Diferencia": (diferencia != 0).astype(int), "Valuacion": stock * costo}, index=df_det.index).groupby(claves).sum()
+        resultados = calcular_resultados_por_inventario(df_det.assign(ID_Inventario=claves))
+    else:
+        por_id = pd.DataFrame(columns=["Lineas", "Lineas_Diferencia", "Valuacion"])
+        resultados = pd.DataFrame(columns=RESULTADOS_COLUMNAS)
+
+    por_id = por_id.reindex(ids).fillna(0).set_index(hist.index)
+    con_detalle = por_id["Lineas"] > 0
+    exactitud = resultados["grado"].reindex(ids).astype(float).set_axis(hist.index)
+    dif_abs = resultados["valor_dif_absoluta"].reindex(ids).astype(float).set_axis(hist.index)
+    con_snapshot = (estado == "cerrado") & filas_con_snapshot(hist)
+    snapshot = _metricas_cierre(hist)
+    exactitud = snapshot["grado"].where(con_snapshot, exactitud).where(con_detalle, 0.0).fillna(0.0)
+    dif_abs = snapshot["valor_dif_absoluta"].where(con_snapshot, dif_abs).where(con_detalle, 0.0).fillna(0.0)
+    fechas = pd.to_datetime(hist.get("Cierre_Fecha", vacio), errors="coerce")
+
+    inventarios = pd.DataFrame({
+        "Nivel": KPI_NIVEL_INVENTARIO,
+        "Clave": ids,
+        "ID_Inventario": ids,
+        "Concesionaria": hist.get("Concesionaria", vacio).fillna("").astype(str),
+        "Sucursal": hist.get("Sucursal", vacio).fillna("").astype(str),
+        "Mes": fechas.dt.strftime("%Y-%m").where((estado == "cerrado") & fechas.notna(), ""),
+        "Estado": estado,
+        "Exactitud": exactitud,
+        "Inventarios": 1,
+        "Abiertos": (estado == "abierto").astype(int),
+        "Cerrados": (estado == "cerrado").astype(int),
+        "Con_Detalle": con_detalle.astype(int),
+        "Lineas": por_id["Lineas"].astype(int),
+        "Lineas_Diferencia": por_id["Lineas_Diferencia"].astype(int),
+        "Valuacion": por_id["Valuacion"].astype(float),
+        "Valor_Dif_Absoluta": dif_abs,
+        "Suma_Exactitud": exactitud,
+    })
+
+    partes = [inventarios]
+    for nivel, columnas, filtro in [
+        ("global", [], None),
+        ("sucursal", ["Sucursal"], None),
+        ("concesionaria", ["Concesionaria"], None),
+        ("mes", ["Mes", "Concesionaria", "Sucursal"], (inventarios["Estado"] == "cerrado") & (inventarios["Mes"] != "")),
+    ]:
+        base = inventarios if filtro is None else inventarios[filtro]
+        if base.empty:
+            continue
+        if columnas:
+            acumulado = base.groupby(columnas, sort=True)[KPI_ADITIVOS].sum().reset_index()
+            acumulado["Clave"] = acumulado[columnas].astype(str).agg("|".join, axis=1)
+        else:
+            acumulado = base[KPI_ADITIVOS].sum().to_frame().T
+            acumulado["Clave"] = "Total"
+        acumulado["Nivel"] = nivel
+        partes.append(acumulado)
+    return pd.concat(partes, ignore_index=True).reindex(columns=KPI_COLUMNAS).fillna({c: "" for c in ["ID_Inventario", "Concesionaria", "Sucursal", "Mes", "Estado", "Exactitud"]})
+
+TENDENCIA_FRECUENCIAS = {"Mensual": "MS", "Trimestral": "QS"}
+
+def tendencias_kpis(df_kpi: pd.DataFrame, dimension: str = "Sucursal", frecuencia: str = "MS", ventana: int = 3) -> dict:
+    """Time series of closed inventories per `dimension` (Sucursal or Concesionaria), from the "mes" KPI rows.
+
+    Returns wide frames (index: period start, columns: dimension values) for Exactitud, Valuacion and
+    Valor_Dif_Absoluta, plus their rolling means over `ventana` periods (keys with "_Movil"). Periods
+    with no closes are kept as gaps so the rolling window spans calendar time. Exactitud is the
+    inventory-weighted mean: summed accuracy over inventories with detail, also for the rolling version.
+    Valuacion and Valor_Dif_Absoluta means skip the gap periods instead of counting them as zero.
+    """
+    mes = df_kpi[df_kpi["Nivel"] == "mes"] if df_kpi is not None and not df_kpi.empty else pd.DataFrame()
+    if mes.empty:
+        return {}
+
+    sumas_cols = ["Inventarios", "Con_Detalle", "Valuacion", "Valor_Dif_Absoluta", "Suma_Exactitud"]
+    mes = mes.assign(
+        Periodo=pd.to_datetime(mes["Mes"], format="%Y-%m", errors="coerce"),
+        **{dimension: mes[dimension].fillna("").astype(str).replace("", f"Sin {dimension.lower()}")},
+        **{col: pd.to_numeric(mes[col], errors="coerce").fillna(0) for col in sumas_cols},
+    ).dropna(subset=["Periodo"])
+    if mes.empty:
+        return {}
+
+    sumas = mes.groupby([pd.Grouper(key="Periodo", freq=frecuencia), dimension])[sumas_cols].sum().unstack(dimension, fill_value=0)
+    periodos = pd.date_range(sumas.index.min(), sumas.index.max(), freq=frecuencia, name="Periodo")
+    sumas = sumas.reindex(periodos, fill_value=0)
+    moviles = sumas.rolling(ventana, min_periods=1).sum()
+
+    con_detalle = sumas["Con_Detalle"].where(sumas["Con_Detalle"] > 0)
+    series = {
+        "Exactitud": sumas["Suma_Exactitud"] / con_detalle,
+        "Exactitud_Movil": moviles["Suma_Exactitud"] / moviles["Con_Detalle"].where(moviles["Con_Detalle"] > 0),
+    }
+    for col in ["Valuacion", "Valor_Dif_Absoluta"]:
+        series[col] = sumas[col].where(sumas["Inventarios"] > 0)
+        series[f"{col}_Movil"] = series[col].rolling(ventana, min_periods=1).mean()
+    return {clave: serie.rename_axis(columns=dimension) for clave, serie in series.items()}
+
+# Conteo físico (cambios editados y paquetes sin conexión)
+def normalize_cell_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (pd.Series, pd.Index, np.ndarray, list, tuple)):
+        if len(value) == 0:
+            return ""
+        if len(value) == 1:
+            return normalize_cell_value(value[0])
+        return json.dumps([normalize_cell_value(v) for v in value], ensure_ascii=False)
+    try:
+        return "" if pd.isna(value) else value
+    except Exception:
+        return value
+
+def calcular_cambios_conteo(df_original: pd.DataFrame, df_editado: pd.DataFrame, columna: str = "Conteo_Fisico") -> dict:
+    """Return {row_id: nuevo_valor} for the cells of `columna` edited in the data editor.
+
+    Both frames must share the same index (the stable row ID of the inventory detail).
+    """
+    if df_original is None or df_editado is None or columna not in df_editado.columns:
+        return {}
+
+    antes = df_original[columna].reindex(df_editado.index) if columna in df_original.columns else pd.Series("", index=df_editado.index)
+    despues = df_editado[columna]
+
+    texto_antes = antes.fillna("").astype(str).str.strip()
+    texto_despues = despues.fillna("").astype(str).str.strip()
+    num_antes = parse_ar_number(texto_antes)
+    num_despues = parse_ar_number(texto_despues)
+
+    cambiados = (texto_antes != texto_despues) & ~(num_antes == num_despues)
+    return {row_id: normalize_cell_value(value) for row_id, value in despues[cambiados].items()}
+
+def validar_paquete_conteo(id_inv: str, meta: dict, df_pkg: pd.DataFrame, df_det: pd.DataFrame, cerrado: bool = False) -> dict:
+    """Compare an offline package against the current server detail.
+
+    Returns {"cambios": {fila: valor}, "conflictos": DataFrame, "errores": [str]}. A row is in
+    conflict when the server count changed since the export and differs from the offline count.
+    Packages for another inventory, for a closed one or exported from a sample with a different
+    number of rows are rejected as a whole, since rows are keyed by position.
+    """
+    def rechazar(motivo: str) -> dict:
+        return {"cambios": {}, "conflictos": pd.DataFrame(), "errores": [motivo]}
+
+    errores = []
+    if str(meta.get("ID_Inventario", "")) != str(id_inv):
+        return rechazar(f"El paquete corresponde al inventario {meta.get('ID_Inventario', '')}, no a {id_inv}.")
+    if cerrado:
+        return rechazar(f"El inventario {id_inv} está cerrado: el paquete no se puede aplicar.")
+
+    df_srv = df_det.reset_index(drop=True)
+    filas_exportadas = pd.to_numeric(pd.Series([meta.get("Filas", len(df_srv))]), errors="coerce").iloc[0]
+    if filas_exportadas != len(df_srv):
+        return rechazar(f"El paquete se exportó con {meta.get('Filas', '')} fila(s) y el inventario tiene {len(df_srv)}: exportá un paquete nuevo.")
+    filas = pd.to_numeric(df_pkg["Fila"], errors="coerce")
+    fuera_rango = filas.isna() | (filas < 0) | (filas >= len(df_srv))
+    if fuera_rango.any():
+        errores.append(f"{int(fuera_rango.sum())} fila(s) del paquete no existen en el inventario.")
+    df_pkg = df_pkg.loc[~fuera_rango].copy()
+    df_pkg.index = filas[~fuera_rango].astype(int)
+    if df_pkg.index.duplicated().any():
+        errores.append("El paquete contiene filas duplicadas.")
+        df_pkg = df_pkg.loc[~df_pkg.index.duplicated(keep="last")]
+
+    srv = df_srv.loc[df_pkg.index]
+    distinta = (
+        normalize_article_codes(df_pkg[C_ART]) != normalize_article_codes(srv[C_ART])
+    ) | (df_pkg[C_LOC].fillna("").astype(str).str.strip() != srv[C_LOC].fillna("").astype(str).str.strip())
+    if distinta.any():
+        errores.append(f"{int(distinta.sum())} fila(s) no coinciden en Artículo/Locación con el servidor.")
+        df_pkg = df_pkg.loc[~distinta]
+        srv = srv.loc[df_pkg.index]
+
+    conteo_txt = df_pkg["Conteo_Fisico"].fillna("").astype(str).str.strip()
+    conteo_num = parse_ar_number(conteo_txt)
+    invalidos = (conteo_txt != "") & (conteo_num.isna() | (conteo_num < 0))
+    if invalidos.any():
+        errores.append(f"{int(invalidos.sum())} conteo(s) no son números válidos (≥ 0).")
+        df_pkg = df_pkg.loc[~invalidos]
+        srv = srv.loc[df_pkg.index]
+
+    srv_conteo = srv["Conteo_Fisico"] if "Conteo_Fisico" in srv.columns else pd.Series("", index=srv.index)
+    exportado = df_pkg[["Conteo_Exportado"]].rename(columns={"Conteo_Exportado": "Conteo_Fisico"})
+    servidor = pd.DataFrame({"Conteo_Fisico": srv_conteo})
+    cambios_offline = calcular_cambios_conteo(exportado, df_pkg[["Conteo_Fisico"]])
+    cambios_servidor = calcular_cambios_conteo(exportado, servidor)
+    contra_servidor = calcular_cambios_conteo(servidor, df_pkg[["Conteo_Fisico"]])
+
+    cambios = {fila: valor for fila, valor in cambios_offline.items() if fila in contra_servidor}
+    en_conflicto = [fila for fila in cambios if fila in cambios_servidor]
+    conflictos = pd.DataFrame({
+        "Fila": en_conflicto,
+        C_ART: srv.loc[en_conflicto, C_ART].tolist(),
+        C_LOC: srv.loc[en_conflicto, C_LOC].tolist(),
+        "Conteo_Exportado": df_pkg.loc[en_conflicto, "Conteo_Exportado"].tolist(),
+        "Conteo_Servidor": srv_conteo.loc[en_conflicto].tolist(),
+        "Conteo_Offline": [cambios[f] for f in en_conflicto],
+    })
+    return {"cambios": cambios, "conflictos": conflictos, "errores": errores}
+
+# Justificaciones (actualizaciones en bloque del detalle)
+CANJE_INFO_COLUMNAS = {
+    "codigo": "Canje_Articulo",
+    "descripcion": "Canje_Descripcion",
+    "costo": "Canje_Costo_Rep",
+    "stock": "Canje_Stock_Base",
+    "locacion": "Canje_Locacion",
+}
+
+def aplicar_actualizaciones_detalle(df: pd.DataFrame, df_updates: pd.DataFrame | dict, key_col: str = "__row_pos__") -> pd.DataFrame:
+    """Apply updates keyed by `key_col` values onto `df` with one positional assignment.
+
+    `df_updates` is an update frame indexed by key or a {key: {columna: valor}} mapping. Values go
+    through normalize_cell_value; missing columns are created empty and NaN/None cells (or columns
+    absent from a key's mapping) leave the current value untouched. Unknown keys are ignored.
+    """
+    df = df.copy()
+    if isinstance(df_updates, dict):
+        # Built as object so integer values are not upcast to float by the NaN gaps
+        columnas = list(dict.fromkeys(col for valores in df_updates.values() for col in valores))
+        df_updates = pd.DataFrame(
+            [[valores.get(col, np.nan) for col in columnas] for valores in df_updates.values()],
+            index=list(df_updates.keys()),
+            columns=columnas,
+            dtype=object,
+        )
+    if df_updates is None or df_updates.empty:
+        return df
+
+    for col in df_updates.columns:
+        if col not in df.columns:
+            df[col] = ""
+        df[col] = df[col].astype("object")
+
+    filas = pd.Index(df[key_col]).get_indexer(df_updates.index)
+    encontradas = filas >= 0
+    updates = df_updates.loc[encontradas]
+    filas = filas[encontradas]
+    cols = [df.columns.get_loc(c) for c in updates.columns]
+
+    actuales = df.iloc[filas, cols].to_numpy(dtype=object)
+    nuevos = updates.to_numpy(dtype=object, copy=True)
+    presentes = updates.notna().to_numpy()
+    nuevos[presentes] = [normalize_cell_value(v) for v in nuevos[presentes]]
+    df.iloc[filas, cols] = np.where(presentes, nuevos, actuales)
+    return df
+
+def _columnas_canje(canje_info: dict | None, cantidad, suffix: str = "") -> dict:
+    if canje_info:
+        valores = {f"{col}{suffix}": normalize_cell_value(canje_info[campo]) for campo, col in CANJE_INFO_COLUMNAS.items()}
+        valores[f"Canje_Ajuste_Cantidad{suffix}"] = normalize_cell_value(-float(cantidad))
+        return valores
+    return {f"{col}{suffix}": "" for col in [*CANJE_INFO_COLUMNAS.values(), "Canje_Ajuste_Cantidad"]}
+
+def construir_actualizaciones_validacion(validaciones: dict, ajustes: dict, validador: str, fecha: str) -> pd.DataFrame:
+    """Build the Justificaciones "Validar y ajustar" update frame (one row per __row_pos__)."""
+    registros = {}
+    for row_pos, val in validaciones.items():
+        registro = {
+            "Justif_Validada": normalize_cell_value(val),
+            "Validador": validador,
+            "Fecha_Validacion": fecha,
+        }
+        if row_pos in ajustes:
+            (
+                tipo,
+                cantidad,
+                _canje_codigo,
+                canje_info,
+                requiere_adicional,
+                tipo_ajuste_adic,
+                ajuste_cant_adic,
+                _canje_codigo_adic,
+                canje_info_adic,
+            ) = ajustes[row_pos]
+            registro["Tipo_Ajuste"] = normalize_cell_value(tipo)
+            registro["Ajuste_Cantidad"] = normalize_cell_value(cantidad)
+            registro.update(_columnas_canje(canje_info if tipo == "Canje" else None, cantidad))
+            registro["Requiere_Ajuste_Adicional"] = normalize_cell_value(requiere_adicional)
+            registro["Tipo_Ajuste_Adicional"] = normalize_cell_value(tipo_ajuste_adic)
+            registro["Ajuste_Cantidad_Adicional"] = normalize_cell_value(ajuste_cant_adic)
+            es_canje_adic = requiere_adicional == "SI" and tipo_ajuste_adic == "Canje"
+            registro.update(_columnas_canje(canje_info_adic if es_canje_adic else None, ajuste_cant_adic, suffix="_Adicional"))
+        registros[row_pos] = registro
+    return pd.DataFrame.from_dict(registros, orient="index")
+
+# Sugerencias de clasificación (Justificaciones)
+REGLA_RELOCACION = "Error de locación"
+REGLA_CANJE = "Canje"
+
+def _emparejar_opuestos(df: pd.DataFrame, claves: list[str], distinto: str) -> pd.DataFrame:
+    """Hash-join faltantes against sobrantes on `claves`, greedily keeping one partner per row.
+
+    Pairs whose `distinto` column is equal on both sides are dropped; closest magnitudes win.
+    """
+    neg = df[df["dif"] < 0]
+    pos = df[df["dif"] > 0]
+    pares = neg.merge(pos, on=claves, suffixes=("", "_par"))
+    pares = pares[pares[distinto] != pares[f"{distinto}_par"]]
+    if pares.empty:
+        return pares
+    pares = pares.assign(gap=(pares["dif"] + pares["dif_par"]).abs())
+    pares = pares.sort_values(["gap", "__row_pos__", "__row_pos___par"], kind="stable")
+    return pares.drop_duplicates("__row_pos__").drop_duplicates("__row_pos___par")
+
+def _sugerencias_lado(pares: pd.DataFrame, lado: str, regla: str, tipo, cantidad, canje, justificacion) -> pd.DataFrame:
+    sufijo = "" if lado == "faltante" else "_par"
+    otro = "_par" if lado == "faltante" else ""
+    return pd.DataFrame({
+        "__row_pos__": pares[f"__row_pos__{sufijo}"].to_numpy(),
+        "Regla": regla,
+        C_ART: pares[f"art{sufijo}"].to_numpy(),
+        C_LOC: pares[f"loc{sufijo}"].to_numpy(),
+        "Diferencia": pares[f"dif{sufijo}"].to_numpy(),
+        "Tipo_Ajuste": np.asarray(tipo, dtype=object),
+        "Ajuste_Cantidad": np.asarray(cantidad, dtype=float),
+        "Canje_Articulo": np.asarray(canje, dtype=object),
+        "Justificacion_Sugerida": np.asarray(justificacion, dtype=object),
+        "Pareja": pares[f"__row_pos__{otro}"].to_numpy(),
+    })
+
+def sugerir_clasificaciones(df_dif: pd.DataFrame) -> pd.DataFrame:
+    """Propose Tipo_Ajuste, canje partners and justifications for a frame of differences.
+
+    Rules, applied in order and each row used at most once:
+    - Error de locación: the same article shows opposite differences at two Locaciones. The
+      compensated quantity needs no adjustment; any remainder is suggested as an Ajuste.
+    - Canje: two different articles show equal and opposite differences. The faltante row gets
+      a Canje against the sobrante article, which is left Sin Ajuste as the counterpart.
+
+    Returns one row per suggestion indexed by __row_pos__.
+    """
+    columnas = ["Regla", C_ART, C_LOC, "Diferencia", "Tipo_Ajuste", "Ajuste_Cantidad", "Canje_Articulo", "Justificacion_Sugerida", "Pareja"]
+    if df_dif is None or df_dif.empty or C_ART not in df_dif.columns:
+        return pd.DataFrame(columns=columnas, index=pd.Index([], name="__row_pos__"))
+
+    df = pd.DataFrame({
+        "__row_pos__": df_dif["__row_pos__"].to_numpy() if "__row_pos__" in df_dif.columns else np.arange(len(df_dif)),
+        "art": df_dif[C_ART].astype(object).where(df_dif[C_ART].notna(), "").astype(str).to_numpy(),
+        "codigo": normalize_article_codes(df_dif[C_ART]).to_numpy(),
+        "loc": df_dif.get(C_LOC, pd.Series("", index=df_dif.index)).fillna("").astype(str).to_numpy(),
+        "dif": pd.to_numeric(df_dif.get("Diferencia", 0), errors="coerce").fillna(0).to_numpy(dtype=float),
+    })
+    df = df[(df["dif"] != 0) & (df["codigo"] != "")]
+    partes = []
+
+    reloc = _emparejar_opuestos(df, ["codigo"], "loc")
+    if not reloc.empty:
+        movido = np.minimum(reloc["dif"].abs(), reloc["dif_par"].abs())
+        for lado, resto, loc_otro in [
+            ("faltante", reloc["dif"] + movido, reloc["loc_par"]),
+            ("sobrante", reloc["dif_par"] - movido, reloc["loc"]),
+        ]:
+            partes.append(_sugerencias_lado(
+                reloc,
+                lado,
+                REGLA_RELOCACION,
+                np.where(resto == 0, "Sin Ajuste", "Ajuste"),
+                resto,
+                "",
+                ("Error de locación: compensa " + format_ar_series(movido) + " con " + loc_otro).to_numpy(),
+            ))
+        usados = np.concatenate([reloc["__row_pos__"].to_numpy(), reloc["__row_pos___par"].to_numpy()])
+        df = df[~df["__row_pos__"].isin(usados)]
+
+    # Ranking within each magnitude turns the join into one-to-one pairs instead of a
+    # faltantes x sobrantes cross product when many rows share the same quantity.
+    df = df.assign(magnitud=df["dif"].abs().round(4))
+    df = df.assign(rango=df.groupby([df["magnitud"], df["dif"] > 0]).cumcount())
+    canjes = _emparejar_opuestos(df, ["magnitud", "rango"], "codigo")
+    if not canjes.empty:
+        partes.append(_sugerencias_lado(
+            canjes, "faltante", REGLA_CANJE, "Canje", canjes["dif"],
+            canjes["codigo_par"].to_numpy(),
+            ("Canje con artículo " + canjes["art_par"]).to_numpy(),
+        ))
+        partes.append(_sugerencias_lado(
+            canjes, "sobrante", REGLA_CANJE, "Sin Ajuste", 0.0, "",
+            ("Contrapartida de canje con artículo " + canjes["art"]).to_numpy(),
+        ))
+
+    if not partes:
+        return pd.DataFrame(columns=columnas, index=pd.Index([], name="__row_pos__"))
+    return pd.concat(partes, ignore_index=True).set_index("__row_pos__").sort_index()[columnas]
+
+# Candidatos de canje (Justificaciones)
+def _tokens_descripcion(valores) -> list[frozenset]:
+    return [frozenset(re.findall(r"\w{2,}", str(v).lower())) if pd.notna(v) else frozenset() for v in valores]
+
+def emparejar_candidatos_canje(df_dif: pd.DataFrame, indice_base: pd.DataFrame, por_faltante: int = 3, ventana: int = 25) -> pd.DataFrame:
+    """Rank canje partners for every faltante in one pass.
+
+    Candidates are the sobrantes of the same inventory plus base articles with stock and no
+    difference of their own. Candidates are sorted by cost, and each faltante only scores the
+    `ventana` nearest costs on each side (np.searchsorted). The score mixes cost proximity and
+    description token similarity, with a bonus for sobrantes that exactly offset the faltante.
+    """
+    columnas = [
+        C_ART, C_DESC, "Diferencia", C_COSTO, "Candidato", "Candidato_Descripcion", "Candidato_Costo",
+        "Origen", "Disponible", "Similitud", "Puntaje", "Rango",
+        "Tipo_Ajuste", "Ajuste_Cantidad", "Canje_Articulo", "Justificacion_Sugerida",
+    ]
+    vacio = pd.DataFrame(columns=columnas, index=pd.Index([], name="__row_pos__"))
+    if df_dif is None or df_dif.empty or C_ART not in df_dif.columns:
+        return vacio
+
+    sin_dato = pd.Series("", index=df_dif.index)
+    det = pd.DataFrame({
+        "__row_pos__": df_dif["__row_pos__"].to_numpy() if "__row_pos__" in df_dif.columns else np.arange(len(df_dif)),
+        "art": df_dif[C_ART].astype(object).where(df_dif[C_ART].notna(), "").astype(str).to_numpy(),
+        "codigo": normalize_article_codes(df_dif[C_ART]).to_numpy(),
+        "descripcion": df_dif.get(C_DESC, sin_dato).to_numpy(),
+        "costo": parse_ar_number(df_dif.get(C_COSTO, sin_dato)).fillna(0).to_numpy(dtype=float),
+        "dif": pd.to_numeric(df_dif.get("Diferencia", 0), errors="coerce").fillna(0).to_numpy(dtype=float),
+    })
+    det = det[det["codigo"] != ""]
+    faltantes = det[det["dif"] < 0].reset_index(drop=True)
+    if faltantes.empty:
+        return vacio
+
+    sobrantes = det[det["dif"] > 0]
+    candidatos = pd.DataFrame({
+        "codigo": sobrantes["codigo"].to_numpy(),
+        "descripcion": sobrantes["descripcion"].to_numpy(),
+        "costo": sobrantes["costo"].to_numpy(),
+        "disponible": sobrantes["dif"].to_numpy(),
+        "origen": "Detalle",
+    })
+    if indice_base is not None and not indice_base.empty:
+        base = indice_base[(indice_base["stock"] > 0) & ~indice_base.index.isin(det["codigo"])]
+        candidatos = pd.concat([candidatos, pd.DataFrame({
+            "codigo": base.index.to_numpy(),
+            "descripcion": base["descripcion"].to_numpy(),
+            "costo": base["costo"].to_numpy(dtype=float),
+            "disponible": base["stock"].to_numpy(dtype=float),
+            "origen": "Base",
+        })], ignore_index=True)
+    if candidatos.empty:
+        return vacio
+
+    candidatos = candidatos.sort_values("costo", kind="stable").reset_index(drop=True)
+    costos = candidatos["costo"].to_numpy(dtype=float)
+    n = len(candidatos)
+
+    inicio = np.searchsorted(costos, faltantes["costo"].to_numpy(dtype=float))
+    columnas_ventana = inicio[:, None] + np.arange(-ventana, ventana)[None, :]
+    f_idx = np.repeat(np.arange(len(faltantes)), columnas_ventana.shape[1])
+    c_idx = np.clip(columnas_ventana, 0, n - 1).ravel()
+    unicos = np.unique(f_idx.astype(np.int64) * n + c_idx)
+    f_idx, c_idx = unicos // n, unicos % n
+    distinto = faltantes["codigo"].to_numpy()[f_idx] != candidatos["codigo"].to_numpy()[c_idx]
+    f_idx, c_idx = f_idx[distinto], c_idx[distinto]
+    if f_idx.size == 0:
+        return vacio
+
+    costo_f = faltantes["costo"].to_numpy(dtype=float)[f_idx]
+    costo_c = costos[c_idx]
+    escala = np.maximum(np.maximum(np.abs(costo_f), np.abs(costo_c)), 1e-9)
+    cercania = 1.0 - np.minimum(np.abs(costo_f - costo_c) / escala, 1.0)
+
+    tokens_f = _tokens_descripcion(faltantes["descripcion"])
+    tokens_c = _tokens_descripcion(candidatos["descripcion"])
+    similitud = np.fromiter(
+        (len(tokens_f[i] & tokens_c[j]) / len(tokens_f[i] | tokens_c[j]) if tokens_f[i] or tokens_c[j] else 0.0 for i, j in zip(f_idx, c_idx)),
+        dtype=float,
+        count=f_idx.size,
+    )
+
+    faltante = -faltantes["dif"].to_numpy(dtype=float)[f_idx]
+    disponible = candidatos["disponible"].to_numpy(dtype=float)[c_idx]
+    origen = candidatos["origen"].to_numpy()[c_idx]
+    compensa = (origen == "Detalle") & np.isclose(disponible, faltante)
+    puntaje = 0.5 * cercania + 0.5 * similitud + 0.25 * compensa
+
+    pares = pd.DataFrame({"f": f_idx, "c": c_idx, "puntaje": puntaje, "similitud": similitud, "disponible": disponible, "faltante": faltante})
+    pares = pares.sort_values(["f", "puntaje", "c"], ascending=[True, False, True], kind="stable")
+    pares["rango"] = pares.groupby("f").cumcount() + 1
+    pares = pares[pares["rango"] <= por_faltante]
+
+    f = faltantes.iloc[pares["f"].to_numpy()]
+    c = candidatos.iloc[pares["c"].to_numpy()]
+    codigo_c = c["codigo"].to_numpy()
+    return pd.DataFrame({
+        "__row_pos__": f["__row_pos__"].to_numpy(),
+        C_ART: f["art"].to_numpy(),
+        C_DESC: f["descripcion"].to_numpy(),
+        "Diferencia": f["dif"].to_numpy(),
+        C_COSTO: f["costo"].to_numpy(),
+        "Candidato": codigo_c,
+        "Candidato_Descripcion": c["descripcion"].to_numpy(),
+        "Candidato_Costo": c["costo"].to_numpy(),
+        "Origen": c["origen"].to_numpy(),
+        "Disponible": pares["disponible"].to_numpy(),
+        "Similitud": pares["similitud"].round(2).to_numpy(),
+        "Puntaje": pares["puntaje"].round(3).to_numpy(),
+        "Rango": pares["rango"].to_numpy(),
+        "Tipo_Ajuste": "Canje",
+        "Ajuste_Cantidad": -np.minimum(pares["faltante"].to_numpy(), pares["disponible"].to_numpy()),
+        "Canje_Articulo": codigo_c,
+        "Justificacion_Sugerida": "Canje con artículo " + pd.Series(codigo_c, dtype=object),
+    }).set_index("__row_pos__")[columnas]
+
+# Lecturas de escáner (Conteo)
+SCAN_COLUMNAS = [C_ART, C_LOC, "Cantidad"]
+
+def parsear_lecturas_escaner(texto: str) -> pd.DataFrame:
+    """Parse keyboard-wedge scans, one per line: `CODIGO`, `CODIGO;CANT` or `CODIGO;LOCACION;CANT`.
+
+    `;` and tab are the field separators (`,` is accepted only when neither appears, since it is
+    also the decimal separator). Missing quantities count as 1.
+    """
+    registros = []
+    for linea in str(texto or "").splitlines():
+        linea = linea.strip()
+        if not linea:
+            continue
+        sep = ";" if ";" in linea else ("\t" if "\t" in linea else ",")
+        partes = [p.strip() for p in linea.split(sep)]
+        if len(partes) == 1:
+            registros.append((partes[0], "", "1"))
+        elif len(partes) == 2:
+            registros.append((partes[0], "", partes[1]))
+        else:
+            registros.append((partes[0], partes[1], partes[2]))
+    return pd.DataFrame(registros, columns=SCAN_COLUMNAS)
+
+def agregar_lecturas(df_lecturas: pd.DataFrame) -> tuple[dict, list[str]]:
+    """Aggregate scan events in a hash map keyed by (normalized article code, Locación)."""
+    agregadas: dict[tuple[str, str], float] = {}
+    errores = []
+    cantidades = parse_ar_number(df_lecturas["Cantidad"].replace("", "1"))
+    for (art, loc, _), cant in zip(df_lecturas[SCAN_COLUMNAS].itertuples(index=False, name=None), cantidades):
+        codigo = normalize_article_code(art)
+        if not codigo:
+            continue
+        if pd.isna(cant):
+            errores.append(f"Cantidad inválida para {codigo}")
+            continue
+        clave = (codigo, str(loc or "").strip())
+        agregadas[clave] = agregadas.get(clave, 0.0) + float(cant)
+    return agregadas, errores
+
+def aplicar_lecturas_a_muestra(df_det: pd.DataFrame, agregadas: dict, sumar: bool = True) -> dict:
+    """Map aggregated scans onto inventory rows (by row position) in one pass.
+
+    Scans without Locación apply to the article only when it has a single location in the sample.
+    Returns {"cambios": {fila: conteo}, "no_encontrados": [...], "ambiguos": [...]}.
+    """
+    df_det = df_det.reset_index(drop=True)
+    codigos = normalize_article_codes(df_det[C_ART])
+    locs = df_det[C_LOC].fillna("").astype(str).str.strip()
+
+    por_clave: dict[tuple[str, str], list[int]] = {}
+    por_codigo: dict[str, list[int]] = {}
+    for fila, (codigo, loc) in enumerate(zip(codigos, locs)):
+        por_clave.setdefault((codigo, loc), []).append(fila)
+        por_codigo.setdefault(codigo, []).append(fila)
+
+    conteo_actual = parse_ar_number(df_det["Conteo_Fisico"]).fillna(0) if "Conteo_Fisico" in df_det.columns else pd.Series(0.0, index=df_det.index)
+
+    cambios: dict[int, float] = {}
+    no_encontrados, ambiguos = [], []
+    for (codigo, loc), cantidad in agregadas.items():
+        filas = por_clave.get((codigo, loc)) if loc else por_codigo.get(codigo)
+        if not filas:
+            no_encontrados.append(f"{codigo} ({loc})" if loc else codigo)
+            continue
+        if len(filas) > 1:
+            ambiguos.append(f"{codigo} ({loc})" if loc else codigo)
+            continue
+        fila = filas[0]
+        base = cambios.get(fila, float(conteo_actual.iloc[fila]) if sumar else 0.0)
+        cambios[fila] = base + cantidad
+
+    cambios = {fila: int(v) if float(v).is_integer() else v for fila, v in cambios.items()}
+    return {"cambios": cambios, "no_encontrados": no_encontrados, "ambiguos": ambiguos}
@@ -0,0 +1,368 @@
+"""
+Construcción de reportes y exportaciones Excel (sin dependencias de Streamlit)
+
+build_report_xlsx arma el reporte de resultado de un inventario (hoja Resultado + Detalle) y
+export_dataframe_to_excel exporta cualquier tabla con formato de números argentino. Ambos escriben
+con workbooks write-only de openpyxl. exportar_reportes_zip genera en lote los reportes de varios
+inventarios en un pool de procesos y exportar_analitico vuelca Historial, Detalle y canjes tipados
+en Parquet o CSV.
+"""
+import io
+import multiprocessing
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.utils import get_column_letter
+
+from calculos_inventario import (
+    C_ART,
+    C_COSTO,
+    C_STOCK,
+    CIERRE_COLUMNAS,
+    calcular_resultados_inventario,
+    construir_movimientos_canje,
+    normalize_article_codes,
+    parse_ar_number,
+    resultados_desde_cierre,
+)
+
+EXCEL_FORMATO_NUMERO = "#,##0.00"
+
+def _registrar_estilos_excel(wb) -> None:
+    """Named styles shared by every streamed data sheet of `wb`."""
+    izquierda = Alignment(horizontal="left", vertical="center")
+    for estilo in [
+        NamedStyle("Datos Título", font=Font(size=12, bold=True), alignment=Alignment(horizontal="center", vertical="center")),
+        NamedStyle("Datos Encabezado", font=Font(bold=True), alignment=izquierda),
+        NamedStyle("Datos Texto", font=DEFAULT_FONT, alignment=izquierda),
+        NamedStyle("Datos Número", font=DEFAULT_FONT, alignment=izquierda, number_format=EXCEL_FORMATO_NUMERO),
+        NamedStyle("Detalle Encabezado", font=Font(bold=True)),
+        NamedStyle("Detalle Número", font=DEFAULT_FONT, number_format=EXCEL_FORMATO_NUMERO),
+    ]:
+        if estilo.name not in wb.named_styles:
+            wb.add_named_style(estilo)
+
+def _columnas_excel(df: pd.DataFrame) -> list[tuple[list, list]]:
+    """Per column, the values as written to Excel and which of them are numbers.
+
+    Cells that parse as finite numbers are written as floats (and get the number format); everything
+    else keeps its value, with nulls left blank. Done column-wise instead of float() per cell.
+    """
+    columnas = []
+    for _, serie in df.items():
+        valores = serie.astype(object).where(serie.notna(), None)
+        es_numero = pd.Series(False, index=serie.index)
+        if pd.api.types.is_numeric_dtype(serie) or pd.api.types.is_object_dtype(serie) or pd.api.types.is_string_dtype(serie):
+            numeros = pd.to_numeric(serie, errors="coerce").astype(float)
+            es_numero = pd.Series(np.isfinite(numeros.to_numpy()), index=serie.index)
+            if es_numero.any():
+                valores = valores.where(~es_numero, numeros.astype(object))
+        columnas.append((valores.tolist(), es_numero.tolist()))
+    return columnas
+
+def _anchos_columnas_excel(df: pd.DataFrame, columnas: list[tuple[list, list]], title: str | None) -> list[int]:
+    """Column widths as the per-cell autofit did it (max str length + 2, capped at 50), vectorized."""
+    anchos = []
+    for (nombre, serie), (valores, _) in zip(df.items(), columnas):
+        textos = pd.Series(valores, index=serie.index, dtype=object).where(serie.notna(), serie.astype(object))
+        largo = textos.map(str).str.len().max() if len(textos) else 0
+        anchos.append(max(int(largo), len(str(nombre))))
+    if title:
+        # The merged title spans A1:Z1 and leaves row 2 blank: empty cells counted as "None".
+        anchos = [max(ancho, 4) for ancho in anchos] + [4] * max(0, 26 - len(anchos))
+        anchos[0] = max(anchos[0], len(title))
+    return [min(ancho + 2, 50) for ancho in anchos]
+
+def _escribir_filas_excel(ws, df: pd.DataFrame, columnas: list[tuple[list, list]], estilo_encabezado: str, estilo_texto: str | None, estilo_numero: str):
+    def celda(valor, estilo):
+        # Style first: assigning a date afterwards keeps its date number format.
+        cell = WriteOnlyCell(ws)
+        cell.style = estilo
+        cell.value = valor
+        return cell
+
+    ws.append([celda(nombre, estilo_encabezado) for nombre in df.columns])
+    valores = [valores for valores, _ in columnas]
+    numeros = [es_numero for _, es_numero in columnas]
+    for fila, fila_numeros in zip(zip(*valores), zip(*numeros)):
+        ws.append([
+            celda(valor, estilo_numero) if es_numero
+            else (celda(valor, estilo_texto) if estilo_texto and valor is not None else valor)
+            for valor, es_numero in zip(fila, fila_numeros)
+        ])
+
+def export_dataframe_to_excel(df: pd.DataFrame, sheet_name: str = "Datos", title: str = None) -> io.BytesIO:
+    """Export DataFrame to Excel with Argentine number formatting (. for thousands, , for decimals)
+
+    Uses a write-only (streaming) workbook: widths are computed from the DataFrame before writing and
+    cells share named styles, so large exports are not bound by per-cell Python work.
+    """
+    buffer = io.BytesIO()
+    wb = Workbook(write_only=True)
+    _registrar_estilos_excel(wb)
+    ws = wb.create_sheet(sheet_name[:31])  # Excel sheet name limit is 31 chars
+
+    columnas = _columnas_excel(df)
+    for col_idx, ancho in enumerate(_anchos_columnas_excel(df, columnas, title), start=1):
+        ws.column_dimensions[get_column_letter(col_idx)].width = ancho
+
+    if title:
+        ws.merged_cells.add("A1:Z1")
+        titulo = WriteOnlyCell(ws, value=title)
+        titulo.style = "Datos Título"
+        ws.append([titulo])
+        ws.append([])
+
+    _escribir_filas_excel(ws, df, columnas, "Datos Encabezado", "Datos Texto", "Datos Número")
+
+    wb.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+def build_report_xlsx(df_det: pd.DataFrame, resultados: dict) -> io.BytesIO:
+    """Result workbook of one inventory: "Resultado" (calcular_resultados_inventario output) and "Detalle"."""
+    buffer = io.BytesIO()
+    wb = Workbook(write_only=True)
+    _registrar_estilos_excel(wb)
+    ws = wb.create_sheet("Resultado")
+
+    title_font = Font(size=14, bold=True)
+    light_red = PatternFill(start_color="FFF2F2", end_color="FFF2F2", fill_type="solid")
+    bold = Font(bold=True)
+    center = Alignment(horizontal="center", vertical="center")
+    thin = Side(border_style="thin", color="000000")
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+
+    def celda(valor, font=None, alignment=None, border=None, fill=None, number_format=None):
+        cell = WriteOnlyCell(ws, value=valor)
+        if font:
+            cell.font = font
+        if alignment:
+            cell.alignment = alignment
+        if border:
+            cell.border = border
+        if fill:
+            cell.fill = fill
+        if number_format:
+            cell.number_format = number_format
+        return cell
+
+    start_row = 5
+    ws.merged_cells.add("A1:D1")
+    ws.merged_cells.add(f"F{start_row + 1}:G{start_row + 1}")
+    ws.append([celda("4. Resultado Inventario Rotativo", font=title_font, alignment=center)])
+    ws.append([])
+    ws.append(["Resultado:"])
+    ws.append([])
+    ws.append([celda(titulo, font=bold, alignment=center, border=border) for titulo in ["Detalle", "Cant", "$", "%"]])
+
+    rows = [
+        ("Muestra", resultados["cant_muestra"], resultados["valor_muestra"], resultados["pct_muestra"] / 100),
+        ("Faltantes", resultados["cant_faltantes"], resultados["valor_faltantes"], resultados["pct_faltantes"] / 100),
+        ("Sobrantes", resultados["cant_sobrantes"], resultados["valor_sobrantes"], resultados["pct_sobrantes"] / 100),
+        ("Dif Neta", resultados["cant_dif_neta"], resultados["valor_dif_neta"], resultados["pct_dif_neta"] / 100),
+        ("Dif Absoluta", resultados["cant_dif_absoluta"], resultados["valor_dif_absoluta"], resultados["pct_dif_absoluta"] / 100),
+    ]
+    for i, r in enumerate(rows, start=start_row + 1):
+        fill = light_red if i in (start_row + 3, start_row + 4) else None
+        fila = [
+            celda(r[0], border=border),
+            celda(r[1], alignment=center, border=border, fill=fill),
+            celda(r[2], border=border, fill=fill, number_format=EXCEL_FORMATO_NUMERO),
+            celda(r[3], border=border, fill=fill, number_format="0.00%"),
+        ]
+        if i == start_row + 1:
+            fila += [None, celda(f"{resultados['grado']}%", font=Font(size=12, bold=True), alignment=center)]
+        ws.append(fila)
+
+    ws.append([])
+    ws.append([None, celda("Dif. Abs. desde", font=bold), celda("Grado de cumplim.", font=bold)])
+    for th, g in resultados.get("escala", []):
+        ws.append([None, celda(f"{th:.2f}%", alignment=center), celda(f"{g}%", alignment=center)])
+
+    ws2 = wb.create_sheet("Detalle")
+    _escribir_filas_excel(ws2, df_det, _columnas_excel(df_det), "Detalle Encabezado", None, "Detalle Número")
+
+    wb.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+def reporte_inventario(id_inv: str, df_det: pd.DataFrame, fila_cierre: dict | None = None) -> tuple[str, bytes | None]:
+    """Report bytes of one inventory, as Historial shows it: closing snapshot when present, canjes from detail.
+
+    Returns (id_inv, None) when there is neither detail nor snapshot to report. Top-level so it can
+    run in a worker process.
+    """
+    resultados = calcular_resultados_inventario(df_det) if not df_det.empty else {}
+    snapshot = resultados_desde_cierre(fila_cierre) if fila_cierre is not None else None
+    if snapshot is not None:
+        resultados = dict(snapshot, canjes=resultados.get("canjes", []))
+    if not resultados or "cant_muestra" not in resultados:
+        return id_inv, None
+    return id_inv, build_report_xlsx(df_det, resultados).getvalue()
+
+def exportar_reportes_zip(trabajos, destino, total: int, resumen: pd.DataFrame | None = None, max_workers: int = 1, en_vuelo: int | None = None, progreso=None) -> list[str]:
+    """Write Reporte_<ID>.xlsx for every (id_inv, df_det, fila_cierre) of `trabajos` into a ZIP at `destino`.
+
+    With max_workers > 1 reports are built in a process pool. At most `en_vuelo` reports are pending at a
+    time (2 per worker by default) and each one is written to the archive as soon as it finishes, so
+    `trabajos` can be a generator and memory holds only those few details and workbooks. `progreso(hechos,
+    total)` is called after every inventory. `resumen`, if given, is added as Resumen.xlsx. Returns the
+    IDs skipped for having nothing to report.
+    """
+    omitidos = []
+    hechos = 0
+
+    def escribir(id_inv, contenido):
+        nonlocal hechos
+        if contenido is None:
+            omitidos.append(id_inv)
+        else:
+            zf.writestr(f"Reporte_{id_inv}.xlsx", contenido)
+        hechos += 1
+        if progreso:
+            progreso(hechos, total)
+
+    with zipfile.ZipFile(destino, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        if resumen is not None and not resumen.empty:
+            zf.writestr("Resumen.xlsx", export_dataframe_to_excel(resumen, sheet_name="Resumen", title="Resumen de inventarios cerrados").getvalue())
+
+        if max_workers <= 1:
+            for trabajo in trabajos:
+                escribir(*reporte_inventario(*trabajo))
+            return omitidos
+
+        en_vuelo = en_vuelo or 2 * max_workers
+        # spawn: the caller may be a multi-threaded server, where forking is unsafe.
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            pendientes = set()
+            for trabajo in trabajos:
+                if len(pendientes) >= en_vuelo:
+                    listos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+                    for futuro in listos:
+                        escribir(*futuro.result())
+                pendientes.add(pool.submit(reporte_inventario, *trabajo))
+            while pendientes:
+                listos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+                for futuro in listos:
+                    escribir(*futuro.result())
+    return omitidos
+
+ANALITICO_FORMATOS = ("parquet", "csv")
+ANALITICO_FECHAS = ["Fecha", "Cierre_Fecha", "Fecha_Validacion"]
+ANALITICO_NUMEROS = [
+    C_STOCK,
+    C_COSTO,
+    "Conteo_Fisico",
+    "Diferencia",
+    "Cierre_Lineas",
+    *CIERRE_COLUMNAS.values(),
+    *[f"{col}{sufijo}" for col in ["Ajuste_Cantidad", "Canje_Costo_Rep", "Canje_Ajuste_Cantidad", "Canje_Stock_Base"] for sufijo in ["", "_Adicional"]],
+    "Stock Base",
+    "Cantidad",
+    "Costo Unitario",
+    "Valor Total",
+]
+ANALITICO_IDENTIFICADORES = ["ID_Inventario", C_ART, "Canje_Articulo", "Canje_Articulo_Adicional"]
+
+def tipar_columnas(df: pd.DataFrame) -> pd.DataFrame:
+    """Analytic dtypes for a sheet: known numeric columns as Float64 (AR formats parsed), dates as datetime, the rest as string.
+
+    Identifier columns are always text, even when every code looks numeric: float artifacts
+    ("12345.0") are dropped and leading zeros kept.
+    """
+    tipado = {}
+    for col, serie in df.items():
+        if col in ANALITICO_IDENTIFICADORES:
+            tipado[col] = normalize_article_codes(serie).astype("string").where(serie.notna())
+        elif col in ANALITICO_NUMEROS:
+            tipado[col] = parse_ar_number(serie.where(serie.notna(), "")).astype("Float64")
+        elif col in ANALITICO_FECHAS:
+            tipado[col] = pd.to_datetime(serie.where(serie.astype(str).str.strip() != ""), errors="coerce")
+        else:
+            tipado[col] = serie.astype("string")
+    return pd.DataFrame(tipado, index=df.index)
+
+class _EscritorTabla:
+    """Appends DataFrame blocks to one Parquet (row group per block) or CSV stream."""
+
+    def __init__(self, destino, formato: str):
+        self.destino = destino
+        self.formato = formato
+        self.parquet = None
+        self.columnas = None
+        self.filas = 0
+
+    def escribir(self, df: pd.DataFrame):
+        if self.columnas is None:
+            self.columnas = list(df.columns)
+        df = df.reindex(columns=self.columnas)
+        if self.formato == "parquet":
+            tabla = pa.Table.from_pandas(df, preserve_index=False)
+            if self.parquet is None:
+                self.parquet = pq.ParquetWriter(self.destino, tabla.schema, compression="snappy")
+            self.parquet.write_table(tabla.cast(self.parquet.schema))
+        else:
+            texto = df.to_csv(index=False, header=self.filas == 0, date_format="%Y-%m-%d %H:%M:%S")
+            self.destino.write(texto.encode("utf-8"))
+        self.filas += len(df)
+
+    def cerrar(self, vacio: pd.DataFrame):
+        """Finish the stream; `vacio` (typed, no rows) gives the header/schema when nothing was written."""
+        if self.columnas is None:
+            self.escribir(vacio)
+        if self.parquet is not None:
+            self.parquet.close()
+
+def exportar_analitico(df_hist: pd.DataFrame, df_det: pd.DataFrame, ids_inv: list[str], destino, formato: str = "parquet", filas_por_bloque: int = 100_000) -> dict:
+    """ZIP at `destino` with historial, detalle and canjes tables of `ids_inv`, typed, as Parquet or CSV.
+
+    Detalle is typed and written in blocks of `filas_por_bloque` rows (one Parquet row group each) and the
+    canje movements of each block go out with it, so memory beyond the input frames stays bounded.
+    Returns the row count written per table.
+    """
+    if formato not in ANALITICO_FORMATOS:
+        raise ValueError(f"Formato no soportado: {formato}")
+    ids = set(map(str, ids_inv))
+    hist = df_hist[df_hist["ID_Inventario"].astype(str).isin(ids)] if not df_hist.empty else df_hist
+    det = df_det[df_det["ID_Inventario"].astype(str).isin(ids)] if not df_det.empty and "ID_Inventario" in df_det.columns else pd.DataFrame(columns=["ID_Inventario"])
+    # Columns no selected inventory uses (they come from other inventories of the shared sheet).
+    det = det.loc[:, det.notna().any() | (det.columns == "ID_Inventario")]
+
+    vacio_canjes = tipar_columnas(construir_movimientos_canje(det.iloc[0:0], conservar=["ID_Inventario"]))
+    filas = {}
+    with zipfile.ZipFile(destino, "w", compression=zipfile.ZIP_DEFLATED) as zf, tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024) as archivo_canjes:
+        with zf.open(f"historial.{formato}", "w") as archivo:
+            historial = _EscritorTabla(archivo, formato)
+            historial.cerrar(tipar_columnas(hist.reset_index(drop=True)))
+            filas["historial"] = historial.filas
+
+        # A ZIP takes one open entry at a time: canjes are spooled and copied in after detalle.
+        canjes = _EscritorTabla(archivo_canjes, formato)
+        with zf.open(f"detalle.{formato}", "w", force_zip64=True) as archivo_det:
+            detalle = _EscritorTabla(archivo_det, formato)
+            for inicio in range(0, len(det), filas_por_bloque):
+                bloque = det.iloc[inicio:inicio + filas_por_bloque]
+                detalle.escribir(tipar_columnas(bloque))
+                movimientos = construir_movimientos_canje(bloque, conservar=["ID_Inventario"])
+                if not movimientos.empty:
+                    canjes.escribir(tipar_columnas(movimientos).reindex(columns=vacio_canjes.columns))
+            detalle.cerrar(tipar_columnas(det))
+            filas["detalle"] = detalle.filas
+        canjes.cerrar(vacio_canjes)
+        filas["canjes"] = canjes.filas
+
+        archivo_canjes.seek(0)
+        with zf.open(f"canjes.{formato}", "w", force_zip64=True) as archivo:
+            shutil.copyfileobj(archivo_canjes, archivo)
+    return filas
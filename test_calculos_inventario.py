@@ -0,0 +1,841 @@
+import json
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from calculos_inventario import (
+    C_ART,
+    C_COSTO,
+    C_DESC,
+    C_LOC,
+    C_STOCK,
+    KPI_ADITIVOS,
+    RESULTADOS_COLUMNAS,
+    actualizar_kpis,
+    agregar_lecturas,
+    aplicar_actualizaciones_detalle,
+    aplicar_lecturas_a_muestra,
+    calcular_resultados_inventario,
+    calcular_resultados_por_inventario,
+    checksum_detalle,
+    construir_actualizaciones_validacion,
+    emparejar_candidatos_canje,
+    format_ar_series,
+    grado_por_escala,
+    kpi_inventario,
+    materializar_cierre,
+    normalize_article_code,
+    normalize_article_codes,
+    parse_ar_number,
+    parsear_lecturas_escaner,
+    reconstruir_kpis,
+    resultados_desde_cierre,
+    resumir_historial,
+    sugerir_clasificaciones,
+    tendencias_kpis,
+    validar_paquete_conteo,
+)
+
+
+# Copia de la versión anterior (fila por fila) de app.py, usada como referencia de paridad.
+def calcular_resultados_inventario_legacy(df_det: pd.DataFrame) -> dict:
+    """Calculate inventory results based on Auditor adjustments.
+    - Muestra Q & $ Ajuste: sum of ALL articles in sample (no filter)
+    - Faltantes/Sobrantes/etc: only rows where Tipo_Ajuste = "Ajuste"
+    - %: always over total muestra valuation
+    """
+    if df_det.empty:
+        return {"canjes": []}
+    
+    df_all = df_det.copy()
+    stock_col = C_STOCK if C_STOCK in df_all.columns else None
+    costo_col = C_COSTO if C_COSTO in df_all.columns else None
+    
+    if not stock_col or not costo_col:
+        return {"canjes": []}
+    
+    df_all["_stock"] = parse_ar_number(df_all[stock_col]).fillna(0)
+    df_all["_costo"] = parse_ar_number(df_all[costo_col]).fillna(0)
+    
+    # MUESTRA: sum of ALL articles (no filter)
+    cant_muestra = int(df_all["_stock"].sum())
+    valor_muestra = (df_all["_stock"] * df_all["_costo"]).sum()
+    pct_muestra = 100.0
+    
+    # Build movement set for quantitative calculations using all adjustments (principal + adicionales).
+    movimientos = []
+
+    if "Tipo_Ajuste" in df_all.columns:
+        df_principal = df_all[df_all["Tipo_Ajuste"].astype(str) == "Ajuste"].copy()
+        if not df_principal.empty:
+            ajuste_source = df_principal["Ajuste_Cantidad"] if "Ajuste_Cantidad" in df_principal.columns else pd.Series(0, index=df_principal.index)
+            df_principal["_ajuste"] = pd.to_numeric(ajuste_source, errors="coerce").fillna(0)
+            movimientos.append(df_principal[["_ajuste", "_costo"]])
+
+    if "Tipo_Ajuste_Adicional" in df_all.columns:
+        df_adicional = df_all[df_all["Tipo_Ajuste_Adicional"].astype(str) == "Ajuste"].copy()
+        if not df_adicional.empty:
+            ajuste_add_source = df_adicional["Ajuste_Cantidad_Adicional"] if "Ajuste_Cantidad_Adicional" in df_adicional.columns else pd.Series(0, index=df_adicional.index)
+            df_adicional["_ajuste"] = pd.to_numeric(ajuste_add_source, errors="coerce").fillna(0)
+            movimientos.append(df_adicional[["_ajuste", "_costo"]])
+
+    df_r = pd.concat(movimientos, ignore_index=True) if movimientos else pd.DataFrame(columns=["_ajuste", "_costo"])
+    
+    # If no adjustments, return results with 0 differences
+    if df_r.empty:
+        return {
+            "cant_muestra": cant_muestra,
+            "valor_muestra": valor_muestra,
+            "pct_muestra": pct_muestra,
+            "cant_faltantes": 0,
+            "valor_faltantes": 0,
+            "pct_faltantes": 0,
+            "cant_sobrantes": 0,
+            "valor_sobrantes": 0,
+            "pct_sobrantes": 0,
+            "cant_dif_neta": 0,
+            "valor_dif_neta": 0,
+            "pct_dif_neta": 0,
+            "cant_dif_absoluta": 0,
+            "valor_dif_absoluta": 0,
+            "pct_dif_absoluta": 0,
+            "pct_absoluto": 0,
+            "grado": 100,
+            "escala": [(0.00, 100), (0.10, 94), (0.80, 82), (1.60, 65), (2.40, 35), (3.30, 0)],
+            "canjes": []
+        }
+
+    # Faltantes (negative adjustments)
+    mask_falt = df_r["_ajuste"] < 0
+    cant_faltantes = int((df_r.loc[mask_falt, "_ajuste"].abs()).sum())
+    valor_faltantes = (df_r.loc[mask_falt, "_ajuste"].abs() * df_r.loc[mask_falt, "_costo"]).sum()
+    pct_faltantes = (valor_faltantes / valor_muestra * 100) if valor_muestra > 0 else 0
+    
+    # Sobrantes (positive adjustments)
+    mask_sobr = df_r["_ajuste"] > 0
+    cant_sobrantes = int(df_r.loc[mask_sobr, "_ajuste"].sum())
+    valor_sobrantes = (df_r.loc[mask_sobr, "_ajuste"] * df_r.loc[mask_sobr, "_costo"]).sum()
+    pct_sobrantes = (valor_sobrantes / valor_muestra * 100) if valor_muestra > 0 else 0
+    
+    # Diferencia neta y absoluta
+    cant_dif_neta = int(df_r["_ajuste"].sum())
+    valor_dif_neta = (df_r["_ajuste"] * df_r["_costo"]).sum()
+    pct_dif_neta = (valor_dif_neta / valor_muestra * 100) if valor_muestra > 0 else 0
+    
+    cant_dif_absoluta = int(df_r["_ajuste"].abs().sum())
+    valor_dif_absoluta = (df_r["_ajuste"].abs() * df_r["_costo"]).sum()
+    pct_dif_absoluta = (valor_dif_absoluta / valor_muestra * 100) if valor_muestra > 0 else 0
+    
+    # Escala de grado basada en % absoluto
+    pct_absoluto = pct_dif_absoluta
+    escala = [(0.00, 100), (0.10, 94), (0.80, 82), (1.60, 65), (2.40, 35), (3.30, 0)]
+    escala_sorted = sorted(escala, key=lambda x: x[0])
+    grado = 0
+    for th, g in escala_sorted:
+        if pct_absoluto >= th:
+            grado = g
+    
+    # Collect canjes (separate from adjustments)
+    canjes_list = []
+
+    def append_canje_movements(row, suffix: str = "", origen: str = "Principal"):
+        tipo_col = f"Tipo_Ajuste{suffix}" if suffix else "Tipo_Ajuste"
+        if str(row.get(tipo_col, "")) != "Canje":
+            return
+
+        ajuste_col = f"Ajuste_Cantidad{suffix}" if suffix else "Ajuste_Cantidad"
+        canje_ajuste_col = f"Canje_Ajuste_Cantidad{suffix}" if suffix else "Canje_Ajuste_Cantidad"
+        canje_art_col = f"Canje_Articulo{suffix}" if suffix else "Canje_Articulo"
+        canje_desc_col = f"Canje_Descripcion{suffix}" if suffix else "Canje_Descripcion"
+        canje_loc_col = f"Canje_Locacion{suffix}" if suffix else "Canje_Locacion"
+        canje_stock_col = f"Canje_Stock_Base{suffix}" if suffix else "Canje_Stock_Base"
+        canje_costo_col = f"Canje_Costo_Rep{suffix}" if suffix else "Canje_Costo_Rep"
+
+        costo_original = pd.to_numeric(row.get(C_COSTO, 0), errors="coerce")
+        ajuste_original = pd.to_numeric(row.get(ajuste_col, 0), errors="coerce")
+        canjes_list.append({
+            "Origen": origen,
+            "Tipo Movimiento": "Artículo original",
+            "Artículo": row.get(C_ART, ""),
+            "Descripción": row.get(C_DESC, ""),
+            "Locación": row.get(C_LOC, ""),
+            "Stock Base": parse_ar_number(pd.Series([row.get(C_STOCK, 0)])).fillna(0).iloc[0],
+            "Cantidad": ajuste_original,
+            "Costo Unitario": costo_original,
+            "Valor Total": ajuste_original * costo_original
+        })
+
+        costo_canje = pd.to_numeric(row.get(canje_costo_col, row.get(C_COSTO, 0)), errors="coerce")
+        ajuste_canje = pd.to_numeric(row.get(canje_ajuste_col, row.get(ajuste_col, 0)), errors="coerce")
+        canjes_list.append({
+            "Origen": origen,
+            "Tipo Movimiento": "Artículo de canje",
+            "Artículo": row.get(canje_art_col, "") or row.get(C_ART, ""),
+            "Descripción": row.get(canje_desc_col, ""),
+            "Locación": row.get(canje_loc_col, row.get(C_LOC, "")),
+            "Stock Base": pd.to_numeric(row.get(canje_stock_col, 0), errors="coerce"),
+            "Cantidad": ajuste_canje,
+            "Costo Unitario": costo_canje,
+            "Valor Total": ajuste_canje * costo_canje
+        })
+
+    if not df_det.empty:
+        for _, row in df_det.iterrows():
+            append_canje_movements(row, suffix="", origen="Principal")
+            append_canje_movements(row, suffix="_Adicional", origen="Adicional")
+    
+    return {
+        "cant_muestra": cant_muestra,
+        "valor_muestra": valor_muestra,
+        "pct_muestra": pct_muestra,
+        "cant_faltantes": cant_faltantes,
+        "valor_faltantes": valor_faltantes,
+        "pct_faltantes": pct_faltantes,
+        "cant_sobrantes": cant_sobrantes,
+        "valor_sobrantes": valor_sobrantes,
+        "pct_sobrantes": pct_sobrantes,
+        "cant_dif_neta": cant_dif_neta,
+        "valor_dif_neta": valor_dif_neta,
+        "pct_dif_neta": pct_dif_neta,
+        "cant_dif_absoluta": cant_dif_absoluta,
+        "valor_dif_absoluta": valor_dif_absoluta,
+        "pct_dif_absoluta": pct_dif_absoluta,
+        "pct_absoluto": pct_absoluto,
+        "grado": grado,
+        "escala": escala_sorted,
+        "canjes": canjes_list
+    }
+
+
+def _detalle_base():
+    return pd.DataFrame({
+        "ID_Inventario": ["INV-1"] * 6,
+        C_LOC: ["A-01", "A-02", "B-01", "B-02", "C-01", "C-02"],
+        C_ART: ["1000", "1001.0", "PH1860KB1000", "2000", "3000", "4000"],
+        C_DESC: ["FILTRO", "BUJIA", "CALCO LAT", None, "PASTILLA", "DISCO"],
+        C_STOCK: ["4", "3", "1.234,5", 1, "", "2"],
+        C_COSTO: ["10000", "1.500,50", 50000, "30000", "7,5", "$ 2.000"],
+        "Diferencia": [-3, -2, 7, 1, 0, -1],
+        "Tipo_Ajuste": ["Ajuste", "Canje", "Sin Ajuste", "Canje", "", "Ajuste"],
+        "Ajuste_Cantidad": [-3, "-2", 0, "1", "", "x"],
+        "Canje_Articulo": ["", "5000", "", "", "", ""],
+        "Canje_Descripcion": ["", "AMORTIGUADOR", "", "", "", ""],
+        "Canje_Costo_Rep": ["", 1200.5, "", "", "", ""],
+        "Canje_Stock_Base": ["", "9", "", None, "", ""],
+        "Canje_Locacion": ["", "L-01", "", "L-09", "", ""],
+        "Canje_Ajuste_Cantidad": ["", 2, "", "-1", "", ""],
+        "Tipo_Ajuste_Adicional": ["", "Ajuste", "", "Canje", "Ajuste", ""],
+        "Ajuste_Cantidad_Adicional": ["", 1, "", "2", -4, ""],
+        "Canje_Articulo_Adicional": ["", "", "", "6000", "", ""],
+        "Canje_Costo_Rep_Adicional": ["", "", "", "99", "", ""],
+        "Canje_Ajuste_Cantidad_Adicional": ["", "", "", "-2", "", ""],
+    })
+
+
+def _fixtures():
+    base = _detalle_base()
+    sin_ajustes = base.assign(Tipo_Ajuste="", Tipo_Ajuste_Adicional="")
+    solo_canjes = base.assign(Tipo_Ajuste=["Canje", "Canje", "", "", "", ""], Tipo_Ajuste_Adicional="")
+    sin_columnas_canje = base.drop(columns=[c for c in base.columns if c.startswith("Canje_")])
+    sin_adicional = base.drop(columns=[c for c in base.columns if "Adicional" in c])
+    sin_cantidades = base.drop(columns=["Ajuste_Cantidad", "Ajuste_Cantidad_Adicional"])
+    filas_pares = np.broadcast_to((base.index.to_numpy() % 2 == 0)[:, None], base.shape)
+    con_nulos = base.astype(object).where(filas_pares, np.nan)
+    con_nulos[C_STOCK] = base[C_STOCK]
+    con_nulos[C_COSTO] = base[C_COSTO]
+    grande = pd.concat([base] * 50, ignore_index=True)
+    return {
+        "base": base,
+        "sin_ajustes": sin_ajustes,
+        "solo_canjes": solo_canjes,
+        "sin_columnas_canje": sin_columnas_canje,
+        "sin_adicional": sin_adicional,
+        "sin_cantidades": sin_cantidades,
+        "con_nulos": con_nulos,
+        "indice_no_correlativo": base.set_axis([10, 3, 7, 7, 1, 0]),
+        "grande": grande,
+        "sin_costo": base.drop(columns=[C_COSTO]),
+        "vacio": base.iloc[0:0],
+    }
+
+
+def _iguales(a, b):
+    if isinstance(a, float) or isinstance(b, float):
+        if pd.isna(a) and pd.isna(b):
+            return True
+        return math.isclose(float(a), float(b), rel_tol=1e-12, abs_tol=1e-9)
+    return a == b
+
+
+@pytest.mark.parametrize("nombre", list(_fixtures()))
+def test_paridad_con_version_fila_por_fila(nombre):
+    df_det = _fixtures()[nombre]
+    esperado = calcular_resultados_inventario_legacy(df_det.copy())
+    obtenido = calcular_resultados_inventario(df_det.copy())
+
+    assert obtenido.keys() == esperado.keys()
+    for clave in esperado:
+        if clave == "canjes":
+            continue
+        if clave == "escala":
+            assert list(obtenido[clave]) == list(esperado[clave])
+        else:
+            assert _iguales(obtenido[clave], esperado[clave]), clave
+
+    canjes_esperados = pd.DataFrame(esperado["canjes"])
+    canjes_obtenidos = pd.DataFrame(obtenido["canjes"])
+    assert len(canjes_obtenidos) == len(canjes_esperados)
+    if not canjes_esperados.empty:
+        pd.testing.assert_frame_equal(
+            canjes_obtenidos.astype(object).where(canjes_obtenidos.notna(), None),
+            canjes_esperados.astype(object).where(canjes_esperados.notna(), None),
+            check_dtype=False,
+        )
+
+
+def test_canjes_se_listan_en_orden_de_detalle():
+    resultados = calcular_resultados_inventario(_detalle_base())
+    movimientos = [(c["Origen"], c["Tipo Movimiento"], c["Artículo"]) for c in resultados["canjes"]]
+    assert movimientos == [
+        ("Principal", "Artículo original", "1001.0"),
+        ("Principal", "Artículo de canje", "5000"),
+        ("Principal", "Artículo original", "2000"),
+        ("Principal", "Artículo de canje", "2000"),
+        ("Adicional", "Artículo original", "2000"),
+        ("Adicional", "Artículo de canje", "6000"),
+    ]
+
+
+def _detalle_varios_inventarios():
+    base = _detalle_base()
+    fixtures = _fixtures()
+    partes = []
+    for i, nombre in enumerate(["base", "sin_ajustes", "solo_canjes", "con_nulos", "sin_cantidades"]):
+        df = fixtures[nombre].copy()
+        df["ID_Inventario"] = f"INV-{i}"
+        partes.append(df)
+    mucha_diferencia = base.assign(ID_Inventario="INV-9", Tipo_Ajuste="Ajuste", Ajuste_Cantidad=-1000)
+    return pd.concat(partes + [mucha_diferencia], ignore_index=True).sample(frac=1, random_state=7)
+
+
+def test_resultados_agrupados_coinciden_por_inventario():
+    df_det = _detalle_varios_inventarios()
+    agrupado = calcular_resultados_por_inventario(df_det)
+
+    assert list(agrupado.columns) == RESULTADOS_COLUMNAS
+    assert sorted(agrupado.index) == sorted(df_det["ID_Inventario"].unique())
+    for id_inv, grupo in df_det.groupby("ID_Inventario"):
+        esperado = calcular_resultados_inventario(grupo)
+        for clave in RESULTADOS_COLUMNAS:
+            assert _iguales(agrupado.loc[id_inv, clave], esperado[clave]), (id_inv, clave)
+
+
+def test_resultados_agrupados_sin_columnas_de_costo():
+    df_det = _detalle_varios_inventarios().drop(columns=[C_COSTO])
+    assert calcular_resultados_por_inventario(df_det).empty
+
+
+@pytest.mark.parametrize(
+    "pct, grado",
+    [(0.0, 100), (0.05, 100), (0.10, 94), (0.79, 94), (0.80, 82), (1.60, 65), (2.39, 65), (2.40, 35), (3.30, 0), (50.0, 0), (-1.0, 0)],
+)
+def test_grado_por_escala(pct, grado):
+    assert grado_por_escala(np.array([pct]))[0] == grado
+
+
+def test_checksum_estable_ante_ida_y_vuelta_del_almacenamiento():
+    df_det = _detalle_base()
+    guardado = pd.DataFrame(df_det.astype(object).where(df_det.notna(), "").to_dict("records"))
+    guardado["Diferencia"] = guardado["Diferencia"].astype(float)
+    guardado["Columna_De_Otro_Inventario"] = np.nan
+    guardado = guardado[list(reversed(guardado.columns))]
+
+    assert checksum_detalle(guardado) == checksum_detalle(df_det)
+
+
+def test_checksum_detecta_cambios_de_detalle():
+    df_det = _detalle_base()
+    modificado = df_det.copy()
+    modificado.loc[0, "Ajuste_Cantidad"] = -2
+
+    assert checksum_detalle(modificado) != checksum_detalle(df_det)
+    assert checksum_detalle(df_det.iloc[::-1]) != checksum_detalle(df_det)
+
+
+def test_snapshot_de_cierre_reconstruye_resultados():
+    df_det = _detalle_base()
+    resultados = calcular_resultados_inventario(df_det)
+    fila = pd.Series(materializar_cierre(df_det))
+
+    assert fila["Cierre_Lineas"] == len(df_det)
+    snapshot = resultados_desde_cierre(fila)
+    for clave in RESULTADOS_COLUMNAS:
+        assert _iguales(snapshot[clave], resultados[clave]), clave
+    assert resultados_desde_cierre(fila.drop("Cierre_Checksum")) is None
+
+
+def test_materializar_cierre_sin_detalle_no_genera_snapshot():
+    assert materializar_cierre(pd.DataFrame()) == {}
+    assert materializar_cierre(pd.DataFrame(columns=[C_ART, C_STOCK, C_COSTO])) == {}
+
+
+def test_resumen_historial_combina_snapshot_y_detalle():
+    df_det = _detalle_varios_inventarios()
+    ids = sorted(df_det["ID_Inventario"].unique())
+    df_hist = pd.DataFrame({"ID_Inventario": ids + ["INV-SIN-DETALLE"], "Cierre_Fecha": [f"2026-01-0{i + 1}" for i in range(len(ids) + 1)]})
+    snapshot = materializar_cierre(df_det[df_det["ID_Inventario"] == ids[0]])
+    for col, valor in snapshot.items():
+        df_hist.loc[0, col] = valor
+
+    resumen = resumir_historial(df_hist, df_det).set_index("ID_Inventario")
+
+    assert resumen.index[0] == "INV-SIN-DETALLE"
+    assert resumen.loc["INV-SIN-DETALLE", "Lineas"] == 0
+    assert resumen.loc[ids[0], "Snapshot"] == "Sí"
+    for id_inv in ids:
+        grupo = df_det[df_det["ID_Inventario"] == id_inv]
+        esperado = calcular_resultados_inventario(grupo)
+        assert resumen.loc[id_inv, "Lineas"] == len(grupo)
+        assert resumen.loc[id_inv, "Exactitud"] == esperado["grado"]
+        assert _iguales(resumen.loc[id_inv, "Valor Dif Absoluta"], esperado["valor_dif_absoluta"])
+
+
+def _historial_kpis(ids):
+    return pd.DataFrame({
+        "ID_Inventario": ids,
+        "Concesionaria": "Autolux",
+        "Sucursal": ["Ax Jujuy" if i % 2 else "Ax Salta" for i in range(len(ids))],
+        "Estado": ["Cerrado" if i == 0 else "Abierto" for i in range(len(ids))],
+        "Cierre_Fecha": ["2026-03-05 10:00" if i == 0 else "" for i in range(len(ids))],
+    })
+
+
+def _ordenar_kpis(df):
+    return df.assign(_k=df["Nivel"] + "|" + df["Clave"]).sort_values("_k").reset_index(drop=True)
+
+
+def test_kpis_reconstruidos_suman_por_nivel():
+    df_det = _detalle_varios_inventarios()
+    ids = sorted(df_det["ID_Inventario"].unique())
+    df_kpi = reconstruir_kpis(_historial_kpis(ids + ["INV-SIN-DETALLE"]), df_det).set_index(["Nivel", "Clave"])
+
+    total = df_kpi.loc[("global", "Total")]
+    assert total["Inventarios"] == len(ids) + 1
+    assert total["Con_Detalle"] == len(ids)
+    assert total["Lineas"] == len(df_det)
+    assert total["Cerrados"] == 1
+    assert df_kpi.loc[("mes", "2026-03|Autolux|Ax Salta"), "Inventarios"] == 1
+    for id_inv in ids:
+        esperado = calcular_resultados_inventario(df_det[df_det["ID_Inventario"] == id_inv])
+        assert df_kpi.loc[("inventario", id_inv), "Exactitud"] == esperado["grado"]
+    suma = df_kpi.loc["sucursal", KPI_ADITIVOS].astype(float).sum()
+    assert np.allclose(suma.to_numpy(), total[KPI_ADITIVOS].astype(float).to_numpy())
+
+
+def test_kpis_incrementales_coinciden_con_reconstruccion():
+    df_det = _detalle_varios_inventarios()
+    ids = sorted(df_det["ID_Inventario"].unique())
+    df_hist = _historial_kpis(ids)
+    df_kpi = reconstruir_kpis(df_hist, df_det)
+
+    # Cambia un conteo y cierra otro inventario (con snapshot), aplicando solo los deltas.
+    df_det = df_det.copy()
+    df_det.loc[df_det.index[df_det["ID_Inventario"] == ids[1]][0], "Diferencia"] = 5
+    df_hist.loc[2, ["Estado", "Cierre_Fecha"]] = ["Cerrado", "2026-04-01 09:00"]
+    for col, valor in materializar_cierre(df_det[df_det["ID_Inventario"] == ids[2]]).items():
+        df_hist.loc[2, col] = valor
+    for pos in [1, 2]:
+        df_kpi = actualizar_kpis(df_kpi, kpi_inventario(df_hist.iloc[pos], df_det[df_det["ID_Inventario"] == ids[pos]]))
+
+    incremental = _ordenar_kpis(df_kpi)
+    esperado = _ordenar_kpis(reconstruir_kpis(df_hist, df_det))
+    assert incremental["_k"].tolist() == esperado["_k"].tolist()
+    assert np.allclose(incremental[KPI_ADITIVOS].astype(float), esperado[KPI_ADITIVOS].astype(float))
+
+
+def test_tendencias_mensuales_y_trimestrales():
+    df_kpi = pd.DataFrame({
+        "Nivel": "mes",
+        "Mes": ["2025-01", "2025-01", "2025-04", "2025-06"],
+        "Concesionaria": "Autolux",
+        "Sucursal": ["Ax Jujuy", "Ax Salta", "Ax Jujuy", "Ax Jujuy"],
+        "Inventarios": [1, 2, 1, 1],
+        "Con_Detalle": [1, 2, 1, 0],
+        "Valuacion": [100.0, 200.0, 300.0, 0.0],
+        "Valor_Dif_Absoluta": [1.0, 2.0, 3.0, 0.0],
+        "Suma_Exactitud": [80.0, 190.0, 100.0, 0.0],
+    })
+
+    mensual = tendencias_kpis(df_kpi, "Sucursal", "MS", ventana=3)
+    assert len(mensual["Exactitud"]) == 6
+    assert mensual["Exactitud"].loc["2025-01-01", "Ax Salta"] == 95
+    assert np.isnan(mensual["Exactitud"].loc["2025-02-01", "Ax Jujuy"])
+    assert mensual["Exactitud_Movil"].loc["2025-03-01", "Ax Jujuy"] == 80
+    # Gap periods are skipped by the rolling mean, as in the per-period series
+    assert mensual["Valuacion_Movil"].loc["2025-02-01", "Ax Jujuy"] == 100
+    assert mensual["Valuacion_Movil"].loc["2025-06-01", "Ax Jujuy"] == 150
+    assert np.isnan(mensual["Valor_Dif_Absoluta_Movil"].loc["2025-04-01", "Ax Salta"])
+
+    trimestral = tendencias_kpis(df_kpi, "Concesionaria", "QS", ventana=2)
+    assert trimestral["Exactitud"]["Autolux"].tolist() == [90.0, 100.0]
+    assert trimestral["Valuacion"]["Autolux"].tolist() == [300.0, 300.0]
+    assert tendencias_kpis(df_kpi.iloc[0:0]) == {}
+
+
+def test_parse_ar_number_texto_y_dtypes():
+    serie = pd.Series([" $ 1.234,56 ", "ARS 3", "1.234", "12,5", "", None, "abc", True, "inf", 7, 2.5], index=range(10, 21), name="Cto.Rep.")
+
+    parsed = parse_ar_number(serie)
+
+    assert parsed.index.equals(serie.index) and parsed.name == "Cto.Rep."
+    assert parsed.iloc[[0, 1, 2, 3, 9, 10]].tolist() == [1234.56, 3.0, 1.234, 12.5, 7.0, 2.5]
+    assert parsed.iloc[[4, 5, 6, 7]].isna().all()
+    assert parsed.iloc[8] == np.inf
+    assert parse_ar_number(pd.Series(["5", "$ 6"])).dtype == np.int64
+    assert parse_ar_number(pd.Series(["5", None])).dtype == np.float64
+
+
+def test_parse_ar_number_numerico_sin_conversion():
+    costos = pd.Series([1.5, np.nan, -0.0])
+    stock = pd.Series([3, 4], dtype=np.int64)
+
+    parsed = parse_ar_number(costos)
+    parsed.iloc[0] = 99
+
+    assert costos.iloc[0] == 1.5
+    assert parse_ar_number(stock).dtype == np.int64
+    assert parse_ar_number(pd.Series(pd.array([1, None], dtype="Int64"))).tolist()[0] == 1
+
+
+def test_normalize_article_codes_coincide_con_version_escalar():
+    codigos = pd.Series([None, np.nan, "", "  ", " 123.0 ", ".0", "12a.0", "-5.0", "1.5", 123.0, 7, "ABC-1", "1.0.0", "5.00"], index=range(3, 17), dtype=object)
+
+    normalizados = normalize_article_codes(codigos)
+
+    assert normalizados.index.equals(codigos.index)
+    assert normalizados.tolist() == [normalize_article_code(v) for v in codigos]
+    assert normalizados.tolist()[4:10] == ["123", ".0", "12a.0", "-5.0", "1.5", "123"]
+
+
+def test_normalize_article_codes_snapshots_viejos_y_nuevos():
+    legacy = pd.DataFrame({"ID_Inventario": "INV-1", C_ART: [1000.0, " ABC-1 "]})
+    nuevo = pd.DataFrame({"ID_Inventario": "INV-2", C_ART: normalize_article_codes(pd.Series(["2000.0", "X-9"]))})
+    # Same JSON round-trip as append_gspread_worksheet + read_gspread_worksheet
+    almacenado = pd.concat([legacy, nuevo], ignore_index=True)
+    df_base = pd.DataFrame(json.loads(json.dumps(almacenado.to_dict("records"))))
+
+    assert normalize_article_codes(df_base[C_ART]).tolist() == ["1000", "ABC-1", "2000", "X-9"]
+
+
+@pytest.mark.parametrize("decimals", [0, 2, 3])
+def test_format_ar_series_coincide_con_formato_por_valor(decimals):
+    rng = np.random.default_rng(7)
+    valores = np.concatenate([
+        rng.uniform(-1e7, 1e7, 2000),
+        [0.0, -0.0, -0.001, 0.005, 1.005, 1.115, 2.675, 0.125, 999999.995, 1e20, np.inf, -np.inf],
+    ])
+
+    esperado = [f"{v:,.{decimals}f}".replace(",", "_").replace(".", ",").replace("_", ".") for v in valores]
+
+    assert format_ar_series(valores, decimals).tolist() == esperado
+
+
+def test_format_ar_series_prefijo_y_nulos():
+    serie = pd.Series([1234.5, np.nan, None, -1234567.891], index=[10, 11, 12, 13])
+
+    formateada = format_ar_series(serie, prefix="$ ")
+
+    assert formateada.index.tolist() == [10, 11, 12, 13]
+    assert formateada.tolist() == ["$ 1.234,50", "", "", "$ -1.234.567,89"]
+
+
+def test_parsear_lecturas_escaner_formatos():
+    lecturas = parsear_lecturas_escaner("123.0\n\n 456 ;2,5\n789;L-01;3\nABC\t4\nX1,7\n")
+
+    assert lecturas.values.tolist() == [
+        ["123.0", "", "1"],
+        ["456", "", "2,5"],
+        ["789", "L-01", "3"],
+        ["ABC", "", "4"],
+        ["X1", "", "7"],
+    ]
+    assert parsear_lecturas_escaner(None).empty
+
+
+def test_agregar_lecturas_suma_por_codigo_y_locacion():
+    lecturas = parsear_lecturas_escaner("123.0\n123\n123;L-01;2\n456;x\n;5")
+
+    agregadas, errores = agregar_lecturas(lecturas)
+
+    assert agregadas == {("123", ""): 2.0, ("123", "L-01"): 2.0}
+    assert errores == ["Cantidad inválida para 456"]
+
+
+def test_aplicar_lecturas_suma_reemplaza_y_reporta():
+    df_det = pd.DataFrame({
+        C_ART: ["100", "200", "200", "300"],
+        C_LOC: ["L-01", "L-01", "L-02", "L-03"],
+        "Conteo_Fisico": [4, "", 1, None],
+    }, index=[10, 11, 12, 13])
+    agregadas = {("100", ""): 2.0, ("200", "L-02"): 1.5, ("200", ""): 1.0, ("999", ""): 1.0}
+
+    sumado = aplicar_lecturas_a_muestra(df_det, agregadas, sumar=True)
+    reemplazo = aplicar_lecturas_a_muestra(df_det, agregadas, sumar=False)
+
+    assert sumado["cambios"] == {0: 6, 2: 2.5}
+    assert reemplazo["cambios"] == {0: 2, 2: 1.5}
+    assert sumado["no_encontrados"] == ["999"]
+    assert sumado["ambiguos"] == ["200"]
+
+
+def _paquete(df_det: pd.DataFrame, conteos: list) -> tuple[dict, pd.DataFrame]:
+    df_pkg = df_det[[C_ART, C_LOC]].reset_index(drop=True).copy()
+    df_pkg.insert(0, "Fila", range(len(df_pkg)))
+    df_pkg["Conteo_Exportado"] = df_det["Conteo_Fisico"].tolist()
+    df_pkg["Conteo_Fisico"] = conteos
+    return {"ID_Inventario": "INV-1", "Filas": len(df_pkg)}, df_pkg
+
+
+@pytest.fixture
+def detalle_paquete():
+    return pd.DataFrame({
+        C_ART: ["100", "200", "300"],
+        C_LOC: ["L-01", "L-01", "L-02"],
+        "Conteo_Fisico": ["", 4, ""],
+    })
+
+
+def test_validar_paquete_cambios_y_conflictos(detalle_paquete):
+    meta, df_pkg = _paquete(detalle_paquete, [5, 4, 2])
+    df_srv = detalle_paquete.copy()
+    df_srv.loc[2, "Conteo_Fisico"] = 3
+
+    sync = validar_paquete_conteo("INV-1", meta, df_pkg, df_srv)
+
+    assert sync["cambios"] == {0: 5, 2: 2}
+    assert sync["conflictos"]["Fila"].tolist() == [2]
+    assert sync["conflictos"]["Conteo_Servidor"].tolist() == [3]
+    assert sync["errores"] == []
+
+
+def test_validar_paquete_de_otro_inventario_o_cerrado(detalle_paquete):
+    meta, df_pkg = _paquete(detalle_paquete, [5, 4, 2])
+
+    otro = validar_paquete_conteo("INV-2", meta, df_pkg, detalle_paquete)
+    cerrado = validar_paquete_conteo("INV-1", meta, df_pkg, detalle_paquete, cerrado=True)
+
+    for sync in (otro, cerrado):
+        assert sync["cambios"] == {}
+        assert sync["conflictos"].empty
+        assert len(sync["errores"]) == 1
+    assert "INV-1" in otro["errores"][0]
+    assert "cerrado" in cerrado["errores"][0]
+
+
+def test_validar_paquete_con_otra_cantidad_de_filas(detalle_paquete):
+    meta, df_pkg = _paquete(detalle_paquete, [5, 4, 2])
+    df_srv = pd.concat([detalle_paquete, pd.DataFrame({C_ART: ["400"], C_LOC: ["L-03"], "Conteo_Fisico": [""]})], ignore_index=True)
+
+    sync = validar_paquete_conteo("INV-1", meta, df_pkg, df_srv)
+
+    assert sync["cambios"] == {}
+    assert "3 fila(s)" in sync["errores"][0]
+
+
+def test_validar_paquete_reordenado_o_con_filas_ajenas(detalle_paquete):
+    meta, df_pkg = _paquete(detalle_paquete, [5, 4, 2])
+    # The sheet was sorted offline: rows are matched by Fila, not by position in the file
+    reordenado = df_pkg.iloc[[2, 0, 1]].reset_index(drop=True)
+    assert validar_paquete_conteo("INV-1", meta, reordenado, detalle_paquete)["cambios"] == {0: 5, 2: 2}
+
+    # Server rows swapped since the export: Artículo/Locación no longer match those positions
+    df_srv = detalle_paquete.iloc[[1, 0, 2]].reset_index(drop=True)
+    sync = validar_paquete_conteo("INV-1", meta, df_pkg, df_srv)
+    assert sync["cambios"] == {2: 2}
+    assert sync["errores"] == ["2 fila(s) no coinciden en Artículo/Locación con el servidor."]
+
+    # Rows added offline or duplicated are reported and ignored
+    extra = pd.concat([df_pkg, df_pkg.iloc[[0]].assign(Fila=7), df_pkg.iloc[[2]].assign(Conteo_Fisico=9)], ignore_index=True)
+    sync = validar_paquete_conteo("INV-1", meta, extra, detalle_paquete)
+    assert sync["cambios"] == {0: 5, 2: 9}
+    assert sync["errores"] == ["1 fila(s) del paquete no existen en el inventario.", "El paquete contiene filas duplicadas."]
+
+
+def test_aplicar_actualizaciones_alinea_por_clave_e_ignora_desconocidas():
+    df = pd.DataFrame({
+        "__row_pos__": [0, 1, 2, 3],
+        "Justificacion": ["a", "b", "c", "d"],
+        "Tipo_Ajuste": ["", "Ajuste", "", ""],
+    }, index=[40, 41, 42, 43])
+    # Keys in a different order than df, one unknown key and a column df does not have yet
+    df_updates = pd.DataFrame({
+        "Justificacion": ["nueva 3", "nueva 1", "fantasma"],
+        "Validador": ["ana", None, "ana"],
+    }, index=[3, 1, 99])
+
+    resultado = aplicar_actualizaciones_detalle(df, df_updates)
+
+    assert resultado.index.tolist() == [40, 41, 42, 43]
+    assert resultado["Justificacion"].tolist() == ["a", "nueva 1", "c", "nueva 3"]
+    assert resultado["Validador"].tolist() == ["", "", "", "ana"]
+    assert resultado["Tipo_Ajuste"].tolist() == ["", "Ajuste", "", ""]
+    assert df["Justificacion"].tolist() == ["a", "b", "c", "d"]
+
+
+def test_aplicar_actualizaciones_desde_mapeo_normaliza_valores():
+    df = pd.DataFrame({"__row_pos__": [0, 1, 2], "Justificacion": ["a", "b", "c"], "Ajuste_Cantidad": ["", "", 5]})
+
+    resultado = aplicar_actualizaciones_detalle(df, {
+        2: {"Justificacion": "", "Ajuste_Cantidad": np.int64(-3)},
+        0: {"Canje_Articulo": ["123"], "Justificacion": None},
+        7: {"Justificacion": "fantasma"},
+    })
+
+    assert resultado["Justificacion"].tolist() == ["a", "b", ""]
+    assert resultado["Ajuste_Cantidad"].tolist() == ["", "", -3]
+    assert type(resultado.loc[2, "Ajuste_Cantidad"]) is int
+    assert resultado["Canje_Articulo"].tolist() == ["123", "", ""]
+
+
+def test_aplicar_actualizaciones_vacias_devuelve_copia():
+    df = pd.DataFrame({"__row_pos__": [0], "Justificacion": ["a"]})
+
+    for vacias in (None, pd.DataFrame(), {}):
+        resultado = aplicar_actualizaciones_detalle(df, vacias)
+        assert resultado.equals(df) and resultado is not df
+
+
+def test_construir_actualizaciones_validacion_con_y_sin_ajuste():
+    canje = {"codigo": "200", "descripcion": "FILTRO", "costo": np.float64(10.5), "stock": np.int64(3), "locacion": "L-02"}
+    ajustes = {
+        5: ("Canje", -2, "200", canje, "SI", "Ajuste", 1, "", None),
+        7: ("Ajuste", 1, "", canje, "NO", "", "", "", None),
+    }
+
+    df_updates = construir_actualizaciones_validacion({5: "SI", 7: "SI", 9: "NO"}, ajustes, "ana", "2026-01-02")
+
+    assert df_updates.index.tolist() == [5, 7, 9]
+    assert df_updates["Validador"].tolist() == ["ana"] * 3
+    fila = df_updates.loc[5]
+    assert (fila["Canje_Articulo"], fila["Canje_Costo_Rep"], fila["Canje_Stock_Base"], fila["Canje_Ajuste_Cantidad"]) == ("200", 10.5, 3, 2.0)
+    assert fila["Canje_Articulo_Adicional"] == ""
+    # Canje info is only written for Tipo_Ajuste == "Canje"
+    assert df_updates.loc[7, "Canje_Articulo"] == ""
+    # Rows without ajuste only carry the validation columns
+    assert df_updates.loc[9, ["Tipo_Ajuste", "Canje_Articulo"]].isna().all()
+
+    df = pd.DataFrame({"__row_pos__": [9, 7, 5], "Tipo_Ajuste": ["Ajuste", "", ""], "Justif_Validada": ["", "", ""]})
+    resultado = aplicar_actualizaciones_detalle(df, df_updates)
+    assert resultado["Justif_Validada"].tolist() == ["NO", "SI", "SI"]
+    assert resultado["Tipo_Ajuste"].tolist() == ["Ajuste", "Ajuste", "Canje"]
+
+
+def test_sugerir_clasificaciones_error_de_locacion_y_canje():
+    df_dif = pd.DataFrame({
+        "__row_pos__": [10, 11, 12, 13, 14],
+        C_ART: ["100", "100.0", "200", "300", "400"],
+        C_LOC: ["L-01", "L-02", "L-01", "L-01", "L-09"],
+        "Diferencia": [-3, 2, -4, 4, 1],
+    })
+
+    sugerencias = sugerir_clasificaciones(df_dif)
+
+    assert sugerencias.index.tolist() == [10, 11, 12, 13]
+    # Same article at two Locaciones: 2 units are compensated, the faltante keeps a -1 Ajuste
+    assert sugerencias.loc[10, ["Regla", "Tipo_Ajuste", "Ajuste_Cantidad", "Pareja"]].tolist() == ["Error de locación", "Ajuste", -1.0, 11]
+    assert sugerencias.loc[11, ["Tipo_Ajuste", "Ajuste_Cantidad", "Pareja"]].tolist() == ["Sin Ajuste", 0.0, 10]
+    assert sugerencias.loc[10, "Justificacion_Sugerida"] == "Error de locación: compensa 2,00 con L-02"
+    # Different articles with equal and opposite differences become a canje pair
+    assert sugerencias.loc[12, ["Regla", "Tipo_Ajuste", "Ajuste_Cantidad", "Canje_Articulo", "Pareja"]].tolist() == ["Canje", "Canje", -4.0, "300", 13]
+    assert sugerencias.loc[13, ["Tipo_Ajuste", "Ajuste_Cantidad", "Canje_Articulo"]].tolist() == ["Sin Ajuste", 0.0, ""]
+
+
+def test_sugerir_clasificaciones_filas_sin_pareja():
+    df_dif = pd.DataFrame({
+        "__row_pos__": [0, 1, 2, 3, 4],
+        C_ART: ["100", "100", "200", "300", ""],
+        C_LOC: ["L-01", "L-01", "L-01", "L-01", "L-01"],
+        "Diferencia": [-2, 2, -1, 3, 1],
+    })
+
+    sugerencias = sugerir_clasificaciones(df_dif)
+
+    # Same article and Locación is not a location error; -2/+2 and -1/+3 are not canje pairs
+    # (rows 0 and 1 share the article code), and a blank article is never suggested.
+    assert sugerencias.empty
+    assert sugerencias.index.name == "__row_pos__"
+
+
+def test_sugerir_clasificaciones_entrada_vacia():
+    for df_dif in (None, pd.DataFrame(), pd.DataFrame({C_ART: [], "Diferencia": []})):
+        sugerencias = sugerir_clasificaciones(df_dif)
+        assert sugerencias.empty
+        assert "Tipo_Ajuste" in sugerencias.columns
+
+
+def _indice_base(filas: dict) -> pd.DataFrame:
+    indice = pd.DataFrame.from_dict(filas, orient="index", columns=["descripcion", "costo", "stock", "locacion"])
+    return indice.rename_axis("codigo").sort_index()
+
+
+@pytest.fixture
+def diferencias_canje():
+    return pd.DataFrame({
+        "__row_pos__": [0, 1, 2],
+        C_ART: ["100", "200", "300"],
+        C_DESC: ["FILTRO ACEITE", "FILTRO ACEITE MOTOR", "PASTILLA FRENO"],
+        C_COSTO: [1000.0, 1000.0, 5000.0],
+        "Diferencia": [-2, 2, 1],
+    })
+
+
+def test_emparejar_candidatos_ordena_y_limita_por_faltante(diferencias_canje):
+    indice = _indice_base({
+        "200": ["FILTRO ACEITE MOTOR", 1000.0, 9.0, "L-01"],
+        "500": ["FILTRO ACEITE", 1100.0, 3.0, "L-02"],
+        "600": ["FILTRO ACEITE", 1000.0, 0.0, "L-03"],
+    })
+
+    candidatos = emparejar_candidatos_canje(diferencias_canje, indice)
+
+    # Only row 0 is a faltante. 200 is offered once (from the detail), 600 has no stock.
+    assert candidatos.index.tolist() == [0, 0, 0]
+    assert candidatos["Candidato"].tolist() == ["200", "500", "300"]
+    assert candidatos["Origen"].tolist() == ["Detalle", "Base", "Detalle"]
+    assert candidatos["Rango"].tolist() == [1, 2, 3]
+    assert candidatos.loc[0, "Ajuste_Cantidad"].tolist() == [-2.0, -2.0, -1.0]
+
+    mejor = emparejar_candidatos_canje(diferencias_canje, indice, por_faltante=1)
+    assert mejor["Candidato"].tolist() == ["200"]
+
+
+def test_emparejar_candidatos_sin_indice_base(diferencias_canje):
+    # Sobrantes of the detail are candidates even when they are missing from the Base index
+    for indice in (None, _indice_base({}), _indice_base({"999": ["OTRO", 1.0, 0.0, ""]})):
+        candidatos = emparejar_candidatos_canje(diferencias_canje, indice)
+        assert candidatos["Candidato"].tolist() == ["200", "300"]
+        assert set(candidatos["Origen"]) == {"Detalle"}
+
+    sin_faltantes = diferencias_canje.assign(Diferencia=[1, 2, 1])
+    assert emparejar_candidatos_canje(sin_faltantes, None).empty
+    assert emparejar_candidatos_canje(None, None).empty
+
+
+def test_emparejar_candidatos_ventana_de_costos():
+    df_dif = pd.DataFrame({
+        "__row_pos__": range(7),
+        C_ART: ["100", "201", "202", "203", "204", "205", "206"],
+        C_DESC: "",
+        C_COSTO: [1000.0, 10.0, 20.0, 30.0, 990.0, 1010.0, 5000.0],
+        "Diferencia": [-1, 1, 1, 1, 1, 1, 1],
+    })
+
+    todos = emparejar_candidatos_canje(df_dif, None, por_faltante=10)
+    cercanos = emparejar_candidatos_canje(df_dif, None, por_faltante=10, ventana=1)
+
+    assert len(todos) == 6
+    # ventana=1 only scores the nearest candidate cost on each side of the faltante
+    assert sorted(cercanos["Candidato"]) == ["204", "205"]
+
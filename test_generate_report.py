@@ -1,8 +1,13 @@
-import pandas as pd
-import datetime
 import io
+import zipfile
+
+import pandas as pd
+import pytest
 from openpyxl import load_workbook
 
+from calculos_inventario import calcular_resultados_inventario
+from reportes import build_report_xlsx, export_dataframe_to_excel, exportar_analitico, exportar_reportes_zip
+
 # Construir df_det de ejemplo con las columnas que usa la app
 cols = [
     "ID_Inventario", "Concesionaria", "Sucursal", "Locación", "Artículo", "Descripción", "Stock", "Cto.Rep.", "Conteo_Fisico", "Diferencia"
@@ -15,128 +20,121 @@ rows = [
 ]
 
 df_det = pd.DataFrame(rows, columns=cols)
-
-# Copiar la función de report building desde app.py (ligeramente adaptada)
-from openpyxl import Workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-
-C_STOCK = "Stock"
-C_COSTO = "Cto.Rep."
+# Todas las diferencias validadas como ajuste por el auditor
+df_det["Tipo_Ajuste"] = "Ajuste"
+df_det["Ajuste_Cantidad"] = df_det["Diferencia"]
 
 
 def generate_report(df_det, id_sel, output_path):
-    dfr = df_det.copy()
-    stock_col = C_STOCK if C_STOCK in dfr.columns else None
-    costo_col = C_COSTO if C_COSTO in dfr.columns else None
-    dfr["_stock_num"] = pd.to_numeric(dfr.get(stock_col, 0), errors="coerce").fillna(0)
-    dfr["_costo_num"] = pd.to_numeric(dfr.get(costo_col, 0), errors="coerce").fillna(0)
-    dif = pd.to_numeric(dfr.get("Diferencia", 0), errors="coerce").fillna(0)
-
-    muestra_cnt = int(dfr["_stock_num"].sum())
-    valor_muestra = (dfr["_stock_num"] * dfr["_costo_num"]).sum()
-
-    value_faltantes = ((-dif[dif < 0]) * dfr.loc[dif < 0, "_costo_num"]).sum()
-    value_sobrantes = ((dif[dif > 0]) * dfr.loc[dif > 0, "_costo_num"]).sum()
-    value_neta = (dif * dfr["_costo_num"]).sum()
-    value_absoluta = (dif.abs() * dfr["_costo_num"]).sum()
-
-    pct_absoluto = (abs(value_neta) / valor_muestra * 100) if valor_muestra else 0
-
-    escala = [(0.00, 100), (0.10, 94), (0.80, 82), (1.60, 65), (2.40, 35), (3.30, 0)]
-    escala_sorted = sorted(escala, key=lambda x: x[0])
-    grado = 0
-    for th, g in escala_sorted:
-        if pct_absoluto >= th:
-            grado = g
-
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Resultado"
-
-    title_font = Font(size=14, bold=True)
-    light_red = PatternFill(start_color="FFF2F2", end_color="FFF2F2", fill_type="solid")
-    bold = Font(bold=True)
-    center = Alignment(horizontal="center", vertical="center")
-    money_fmt = "#,##0.00"
-    thin = Side(border_style="thin", color="000000")
-    border = Border(left=thin, right=thin, top=thin, bottom=thin)
-
-    ws.merge_cells("A1:D1")
-    ws["A1"] = "4. Resultado Inventario Rotativo"
-    ws["A1"].font = title_font
-    ws["A1"].alignment = center
-
-    ws["A3"] = "El resultado del inventario rotativo es el siguiente:"
-
-    start_row = 5
-    ws[f"A{start_row}"] = "Detalle"
-    ws[f"B{start_row}"] = "Cant. de Art."
-    ws[f"C{start_row}"] = "$"
-    ws[f"D{start_row}"] = "%"
-    for col in ["A","B","C","D"]:
-        cell = ws[f"{col}{start_row}"]
-        cell.font = bold
-        cell.alignment = center
-        cell.border = border
-
-    rows = [
-        ("Muestra", muestra_cnt, valor_muestra, 1.0),
-        ("Faltantes", int(dfr.loc[dif < 0, "_stock_num"].sum()), value_faltantes, (value_faltantes / valor_muestra) if valor_muestra else 0),
-        ("Sobrantes", int(dfr.loc[dif > 0, "_stock_num"].sum()), value_sobrantes, (value_sobrantes / valor_muestra) if valor_muestra else 0),
-        ("Diferencia Neta", int(dfr["Diferencia"].sum()), value_neta, (value_neta / valor_muestra) if valor_muestra else 0),
-        ("Diferencia Absoluta", int(dfr["Diferencia"].abs().sum()), value_absoluta, (value_absoluta / valor_muestra) if valor_muestra else 0),
-    ]
-
-    for i, r in enumerate(rows, start=start_row + 1):
-        ws[f"A{i}"] = r[0]
-        ws[f"B{i}"] = r[1]
-        ws[f"C{i}"] = r[2]
-        ws[f"D{i}"] = r[3]
-        ws[f"B{i}"].alignment = center
-        ws[f"C{i}"].number_format = money_fmt
-        ws[f"D{i}"].number_format = "0.00%"
-        ws[f"A{i}"].border = border
-        ws[f"B{i}"].border = border
-        ws[f"C{i}"].border = border
-        ws[f"D{i}"].border = border
-
-    diff_rows = [start_row + 3, start_row + 4]
-    for r in diff_rows:
-        for col in ["B","C","D"]:
-            ws[f"{col}{r}"].fill = light_red
-
-    pct_cell_row = start_row + 1
-    ws.merge_cells(f"F{pct_cell_row}:G{pct_cell_row}")
-    ws[f"F{pct_cell_row}"] = f"{grado}%"
-    ws[f"F{pct_cell_row}"].font = Font(size=12, bold=True)
-    ws[f"F{pct_cell_row}"].alignment = center
-
-    escala_start = start_row + 7
-    ws[f"B{escala_start}"] = "Dif. Abs. desde"
-    ws[f"C{escala_start}"] = "Grado de cumplim."
-    ws[f"B{escala_start}"].font = bold
-    ws[f"C{escala_start}"].font = bold
-
-    for j, (th, g) in enumerate(escala_sorted, start=escala_start + 1):
-        ws[f"B{j}"] = f"{th:.2f}%"
-        ws[f"C{j}"] = f"{g}%"
-        ws[f"B{j}"].alignment = center
-        ws[f"C{j}"].alignment = center
-
-    ws2 = wb.create_sheet(title="Detalle")
-    for r in dataframe_to_rows(df_det, index=False, header=True):
-        ws2.append(r)
-
-    for column_cells in ws.columns:
-        try:
-            length = max(len(str(cell.value)) if cell.value is not None else 0 for cell in column_cells)
-            col_letter = column_cells[0].column_letter
-            ws.column_dimensions[col_letter].width = min(40, length + 4)
-        except:
-            pass
-
-    wb.save(output_path)
+    resultados = calcular_resultados_inventario(df_det)
+    with open(output_path, "wb") as f:
+        f.write(build_report_xlsx(df_det, resultados).getvalue())
+    return resultados
+
+
+def test_reporte_resultado_usa_diferencia_absoluta():
+    resultados = calcular_resultados_inventario(df_det)
+    ws = load_workbook(build_report_xlsx(df_det, resultados))["Resultado"]
+
+    assert resultados["pct_absoluto"] == resultados["pct_dif_absoluta"]
+    assert resultados["valor_dif_absoluta"] > abs(resultados["valor_dif_neta"])
+    assert ws["A1"].value == "4. Resultado Inventario Rotativo"
+    assert [ws[f"A{i}"].value for i in range(6, 11)] == ["Muestra", "Faltantes", "Sobrantes", "Dif Neta", "Dif Absoluta"]
+    assert ws["C10"].value == resultados["valor_dif_absoluta"]
+    assert ws["D10"].value == resultados["pct_dif_absoluta"] / 100
+    assert ws["D10"].number_format == "0.00%"
+    assert ws["F6"].value == f"{resultados['grado']}%"
+    assert "F6:G6" in [str(r) for r in ws.merged_cells.ranges]
+
+
+def test_reporte_detalle_con_numeros_formateados():
+    ws = load_workbook(build_report_xlsx(df_det, calcular_resultados_inventario(df_det)))["Detalle"]
+
+    assert [c.value for c in ws[1]] == list(df_det.columns)
+    assert ws.max_row == len(df_det) + 1
+    costo = ws.cell(row=2, column=cols.index("Cto.Rep.") + 1)
+    assert costo.value == 10000 and costo.number_format == "#,##0.00"
+    assert ws.cell(row=2, column=cols.index("Descripción") + 1).number_format == "General"
+
+
+def test_export_dataframe_con_titulo_y_anchos():
+    ws = load_workbook(export_dataframe_to_excel(df_det, sheet_name="Detalle", title="Detalle INV-TEST"))["Detalle"]
+
+    assert ws["A1"].value == "Detalle INV-TEST"
+    assert [c.value for c in ws[3]][:len(cols) + 2] == list(df_det.columns)
+    assert ws.cell(row=4, column=cols.index("Stock") + 1).number_format == "#,##0.00"
+    ancho_descripcion = ws.column_dimensions["F"].width
+    assert ancho_descripcion == df_det["Descripción"].str.len().max() + 2
+
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_exportacion_masiva_zip(max_workers):
+    otro = df_det.assign(ID_Inventario="INV-20260210-0002", Diferencia=0, Ajuste_Cantidad=0)
+    trabajos = (t for t in [
+        ("INV-20260210-0001", df_det, None),
+        ("INV-20260210-0002", otro, None),
+        ("INV-SIN-DETALLE", pd.DataFrame(), None),
+    ])
+    avance = []
+    destino = io.BytesIO()
+
+    omitidos = exportar_reportes_zip(trabajos, destino, total=3, resumen=df_det[["ID_Inventario", "Sucursal"]], max_workers=max_workers, progreso=lambda hechos, total: avance.append((hechos, total)))
+
+    archivo = zipfile.ZipFile(destino)
+    assert omitidos == ["INV-SIN-DETALLE"]
+    assert avance == [(1, 3), (2, 3), (3, 3)]
+    assert sorted(archivo.namelist()) == ["Reporte_INV-20260210-0001.xlsx", "Reporte_INV-20260210-0002.xlsx", "Resumen.xlsx"]
+    ws = load_workbook(io.BytesIO(archivo.read("Reporte_INV-20260210-0002.xlsx")))["Resultado"]
+    assert ws["F6"].value == "100%"
+
+
+
+@pytest.mark.parametrize("formato", ["parquet", "csv"])
+def test_exportacion_analitica_tipada_por_bloques(formato):
+    otro = df_det.assign(ID_Inventario="INV-20260210-0002", **{"Cto.Rep.": "1.234,50"})
+    otro.loc[0, ["Tipo_Ajuste", "Canje_Articulo", "Canje_Costo_Rep", "Canje_Ajuste_Cantidad"]] = ["Canje", "X-1", 900, 3]
+    df_hist = pd.DataFrame({
+        "ID_Inventario": ["INV-20260210-0001", "INV-20260210-0002", "INV-OTRO"],
+        "Cierre_Fecha": ["2026-02-12 10:00", "", "2026-02-13 09:30"],
+        "Cierre_Exactitud": [94, "", 100],
+    })
+    destino = io.BytesIO()
+
+    filas = exportar_analitico(df_hist, pd.concat([df_det, otro]), ["INV-20260210-0001", "INV-20260210-0002"], destino, formato=formato, filas_por_bloque=3)
+
+    assert filas == {"historial": 2, "detalle": 8, "canjes": 2}
+    archivo = zipfile.ZipFile(destino)
+    leer = pd.read_parquet if formato == "parquet" else pd.read_csv
+    historial = leer(io.BytesIO(archivo.read(f"historial.{formato}")))
+    detalle = leer(io.BytesIO(archivo.read(f"detalle.{formato}")))
+    canjes = leer(io.BytesIO(archivo.read(f"canjes.{formato}")))
+    assert historial["Cierre_Exactitud"].tolist()[0] == 94
+    assert detalle["Cto.Rep."].iloc[-1] == 1234.5
+    assert canjes["ID_Inventario"].unique().tolist() == ["INV-20260210-0002"]
+    assert canjes["Cantidad"].tolist() == [-3, 3]
+    assert canjes["Valor Total"].iloc[1] == 3 * 900
+    if formato == "parquet":
+        assert str(historial["Cierre_Fecha"].dtype).startswith("datetime64")
+        assert str(detalle["Stock"].dtype) == "Float64"
+
+
+def test_exportacion_analitica_identificadores_como_texto():
+    det = df_det.assign(**{"Artículo": [12345, 12346, 12347, 12348], "Canje_Articulo": [None, "00123", 555.0, None]})
+    det.loc[1, "Tipo_Ajuste"] = "Canje"
+    df_hist = pd.DataFrame({"ID_Inventario": ["INV-20260210-0001"]})
+    destino = io.BytesIO()
+
+    exportar_analitico(df_hist, det, ["INV-20260210-0001"], destino)
+
+    archivo = zipfile.ZipFile(destino)
+    detalle = pd.read_parquet(io.BytesIO(archivo.read("detalle.parquet")))
+    canjes = pd.read_parquet(io.BytesIO(archivo.read("canjes.parquet")))
+    assert detalle["Artículo"].tolist() == ["12345", "12346", "12347", "12348"]
+    assert detalle["Canje_Articulo"].iloc[1:3].tolist() == ["00123", "555"]
+    assert detalle["Canje_Articulo"].isna().iloc[[0, 3]].all()
+    assert canjes["Artículo"].tolist() == ["12346", "00123"]
+    assert str(detalle["Stock"].dtype) == "Float64"
 
 
 if __name__ == '__main__':